@@ -1,25 +1,165 @@
 #!/usr/bin/env python
-from __future__ import absolute_import 
+from __future__ import absolute_import
 
 
+import argparse
+import multiprocessing
 import threading
 import webbrowser
-import time
-from paperstream.marking_server import app
-import waitress
 
 
-def launch_browser():
-    """Launches the app"""
-    time.sleep(3)
-    webbrowser.open("http://localhost:8000/static/index.html", new=0, autoraise=True)
+def positive_int(value):
+    """Parses an argument that must be an integer of at least 1"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, not {}".format(value))
+    return number
+
+def launch_browser(ready, port):
+    """Launches the app once the server is listening"""
+    ready.wait()
+    webbrowser.open("http://localhost:{}/static/index.html".format(port), new=0, autoraise=True)
+
+def serve(args):
+    """Runs the web app"""
+    import paperstream.server as server
+
+    ready = threading.Event()
+    if args.browser:
+        LAUNCH_THREAD = threading.Thread(target=launch_browser, args=(ready, args.port), daemon=True)
+        LAUNCH_THREAD.start()
+    server.serve(args.host, args.port, workers=args.workers, threads=args.threads, ready=ready)
+
+def encode(args):
+    """Encodes a batch of diaries from the command line"""
+    import paperstream.encode_diary as encode_diary
+
+    with open(args.rubric, 'r') as rubric_file:
+        rubric = rubric_file.read().strip()
+    combined_answers, results = encode_diary.encode_diaries(args.diaries, args.template, rubric, args.date,
+                                                            workers=args.workers, combined_name=args.output,
+                                                            sparse=args.sparse, coarse=args.coarse)
+    for result in results:
+        if result["error"] is None:
+            print("{diary}: {answers} ({pages} pages)".format(**result))
+        else:
+            print("{diary}: ERROR {error}".format(**result))
+    encoded = len([result for result in results if result["error"] is None])
+    print("Encoded {} of {} diaries, all the answers saved to {}".format(encoded, len(results), combined_answers))
+
+def create(args):
+    """Creates the documents of a cohort of participants from the command line"""
+    import paperstream.create_diary as create_diary
+
+    results = create_diary.create_diaries(args.templates, args.pages, args.date, email=args.email,
+                                          font=args.font, workers=args.workers)
+    for result in results:
+        if result["error"] is None:
+            print("{template}: {a4_document}, {a5_booklet} ({seconds:.1f}s)".format(**result))
+        else:
+            print("{template}: ERROR {error}".format(**result))
+
+def benchmark(args):
+    """Runs the benchmark suite from the command line, exits with an error if there are regressions"""
+    import json
+    import sys
+    import paperstream.benchmark as benchmark_suite
+
+    results = benchmark_suite.run_benchmarks(args.benchmarks, args.dpi, args.pages, repeat=args.repeat,
+                                             output=args.output)
+    for result in results["results"]:
+        print(benchmark_suite.describe_result(result))
+    print("Results saved to {}".format(args.output))
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = benchmark_suite.compare_with_baseline(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION {}".format(regression))
+        if regressions:
+            sys.exit(1)
+
+def parse_arguments(argv):
+    """Parses the command line arguments, running the web app is the default command"""
+    from paperstream.settings import (BENCHMARKS, BENCHMARK_DPIS, BENCHMARK_PAGES, DIARIES_TO_CREATE_DIR,
+                                      DIARIES_TO_ENCODE_DIR, REGRESSION_TOLERANCE, SERVER_HOST, SERVER_PORT,
+                                      SERVER_THREADS, TEMPLATE_DIR)
+
+    parser = argparse.ArgumentParser(prog="paperstream",
+                                     description="Create and encode paper diaries or surveys automatically")
+    parser.set_defaults(command=serve, host=SERVER_HOST, port=SERVER_PORT, workers=1, threads=SERVER_THREADS,
+                        browser=True)
+    commands = parser.add_subparsers()
+
+    serve_parser = commands.add_parser("serve", help="run the web app (default)")
+    serve_parser.set_defaults(command=serve)
+    serve_parser.add_argument("--host", default=SERVER_HOST,
+                              help="address the server listens on (e.g. 127.0.0.1 to only serve this machine)")
+    serve_parser.add_argument("--port", type=int, default=SERVER_PORT, help="port the server listens on")
+    serve_parser.add_argument("--workers", type=positive_int, default=1,
+                              help="processes that serve the app, the jobs are shared in a database if more than one")
+    serve_parser.add_argument("--threads", type=int, default=SERVER_THREADS,
+                              help="threads of each process that handle the requests")
+    serve_parser.add_argument("--no-browser", dest="browser", action="store_false",
+                              help="do not open the web interface in the browser")
+
+    encode_parser = commands.add_parser("encode", help="encode a batch of scanned diaries")
+    encode_parser.set_defaults(command=encode)
+    encode_parser.add_argument("diaries", nargs="?", default=DIARIES_TO_ENCODE_DIR,
+                               help="directory or glob pattern of the diaries (tif or zip files) to encode")
+    encode_parser.add_argument("--rubric", required=True,
+                               help="CSV file with the encoding rubric (entryID,variable,value,x,y,radius)")
+    encode_parser.add_argument("--date", required=True,
+                               help="date of the first page of every diary (DD/MM/YYYY)")
+    encode_parser.add_argument("--template", default=TEMPLATE_DIR,
+                               help="directory with the blank page (tif or png file) used as encoding template")
+    encode_parser.add_argument("--workers", type=positive_int, default=None,
+                               help="number of diaries encoded in parallel (default: one per CPU)")
+    encode_parser.add_argument("--output", default="encoded_diaries",
+                               help="name of the CSV file with the answers of all the diaries")
+    encode_parser.add_argument("--sparse", action="store_true",
+                               help="only extract and binarise the regions of the pages around the answer spaces")
+    encode_parser.add_argument("--coarse", action="store_true",
+                               help="search the corner markers of high-DPI pages (600 DPI scans) on a downscaled copy, "
+                                    "faster but the answer areas can move a pixel or two")
+
+    create_parser = commands.add_parser("create", help="create the documents of a cohort of participants")
+    create_parser.set_defaults(command=create)
+    create_parser.add_argument("templates", nargs="*", default=DIARIES_TO_CREATE_DIR,
+                               help="PDF templates (one per participant) or a directory with them")
+    create_parser.add_argument("--pages", type=int, required=True, help="number of pages of each document")
+    create_parser.add_argument("--date", default="",
+                               help="date of the first page (DD/MM/YYYY) or a text printed on every page")
+    create_parser.add_argument("--email", default=None, help="email printed on the cover of each document")
+    create_parser.add_argument("--font", default="Arial", help="font of the header and footer")
+    create_parser.add_argument("--workers", type=positive_int, default=None,
+                               help="number of documents created in parallel (default: one per CPU)")
+
+    benchmark_parser = commands.add_parser("benchmark", help="measure the speed and memory of the encoding and creation")
+    benchmark_parser.set_defaults(command=benchmark)
+    benchmark_parser.add_argument("benchmarks", nargs="*", default=BENCHMARKS,
+                                  help="benchmarks to run: {} (default: all)".format(", ".join(BENCHMARKS)))
+    benchmark_parser.add_argument("--dpi", type=int, nargs="+", default=BENCHMARK_DPIS,
+                                  help="resolutions of the synthetic scanned pages")
+    benchmark_parser.add_argument("--pages", type=int, nargs="+", default=BENCHMARK_PAGES,
+                                  help="number of pages of the documents")
+    benchmark_parser.add_argument("--repeat", type=int, default=1,
+                                  help="runs of each benchmark, the fastest one is reported")
+    benchmark_parser.add_argument("--output", default="benchmark.json", help="JSON file where the results are saved")
+    benchmark_parser.add_argument("--baseline", default=None,
+                                  help="JSON file with the results of a previous run to flag regressions")
+    benchmark_parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE,
+                                  help="relative slowdown or memory growth flagged as a regression")
+
+    return parser.parse_args(argv)
 
 def main(argv=None):
     """Main method for PaperStream"""
-    LAUNCH_THREAD = threading.Thread(target=launch_browser)
-    LAUNCH_THREAD.start()
-    waitress.serve(app, port=8000)
-    LAUNCH_THREAD.join()
+    # Needed by the process pools of the PyInstaller executable on Windows
+    multiprocessing.freeze_support()
+    args = parse_arguments(argv)
+    args.command(args)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,119 @@
+"""
+Answer key of a rubric: the position, radius and black pixels (in the blank template) of every answer
+space, kept as parallel arrays. The entry, variable and value of each answer space are integer codes
+of tables of names, so marking a page is a few array operations and its answers are a dense matrix
+(one row per answered entry, one column per variable) of value codes.
+
+"""
+import io
+import numpy as np
+
+# Codes (in the matrix of answers of a page) and CSV values of the variables of an entry without
+# answer and with more than one answer
+MISSING_CODE = -1
+DUPLICATED_CODE = -2
+MISSING = "MISSING"
+DUPLICATED = "DUPLICATED"
+
+# Fields of each answer space in the npz file of an answer key
+ANSWER_SPACE_DTYPE = np.dtype([("x", np.float64), ("y", np.float64), ("radius", np.float64),
+                               ("black_pixels", np.int64), ("entry", np.int32), ("variable", np.int32),
+                               ("value", np.int32)])
+
+
+def get_codes(names):
+    """Get the table of distinct names (in order of appearance) and the code of each name"""
+    table = list(dict.fromkeys(names))
+    codes = {name: code for code, name in enumerate(table)}
+    return table, np.array([codes[name] for name in names], dtype=np.int32)
+
+
+class AnswerKey(object):
+    """The answer spaces of a rubric on a blank answer area"""
+    def __init__(self, x_coords, y_coords, radii, black_pixels, entry_codes, variable_codes, value_codes,
+                 entries, variables, values):
+        self.x_coords = np.asarray(x_coords, dtype=np.float64)
+        self.y_coords = np.asarray(y_coords, dtype=np.float64)
+        self.radii = np.asarray(radii, dtype=np.float64)
+        self.black_pixels = np.asarray(black_pixels, dtype=np.int64)
+        self.entry_codes = np.asarray(entry_codes, dtype=np.int32)
+        self.variable_codes = np.asarray(variable_codes, dtype=np.int32)
+        self.value_codes = np.asarray(value_codes, dtype=np.int32)
+        self.entries = list(entries)
+        self.variables = list(variables)
+        self.values = list(values)
+
+    @classmethod
+    def from_answer_spaces(cls, answer_spaces, x_coords, y_coords, radii, black_pixels):
+        """Create the answer key of the (entry, variable, value) of each answer space. The variables
+        are sorted by name, as the columns of the encoded diaries"""
+        entries, entry_codes = get_codes([entry for entry, variable, value in answer_spaces])
+        values, value_codes = get_codes([value for entry, variable, value in answer_spaces])
+        variables = sorted(set(variable for entry, variable, value in answer_spaces))
+        variable_codes = [variables.index(variable) for entry, variable, value in answer_spaces]
+        return cls(x_coords, y_coords, radii, black_pixels, entry_codes, variable_codes, value_codes,
+                   entries, variables, values)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Load an answer key saved with to_bytes"""
+        with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+            answer_spaces = arrays["answer_spaces"]
+            names = arrays["names"].tolist()
+            entries_count, variables_count = arrays["tables_sizes"].tolist()
+        return cls(answer_spaces["x"], answer_spaces["y"], answer_spaces["radius"], answer_spaces["black_pixels"],
+                   answer_spaces["entry"], answer_spaces["variable"], answer_spaces["value"],
+                   names[:entries_count], names[entries_count:entries_count + variables_count],
+                   names[entries_count + variables_count:])
+
+    def to_bytes(self):
+        """Save the answer key as a npz file (bytes) with an array of answer spaces and one of the names
+        of the entries, variables and values"""
+        answer_spaces = np.empty(len(self), dtype=ANSWER_SPACE_DTYPE)
+        for field, array in (("x", self.x_coords), ("y", self.y_coords), ("radius", self.radii),
+                             ("black_pixels", self.black_pixels), ("entry", self.entry_codes),
+                             ("variable", self.variable_codes), ("value", self.value_codes)):
+            answer_spaces[field] = array
+        names = np.array(self.entries + self.variables + self.values, dtype=np.str_)
+        data = io.BytesIO()
+        np.savez(data, answer_spaces=answer_spaces, names=names,
+                 tables_sizes=np.array([len(self.entries), len(self.variables)]))
+        return data.getvalue()
+
+    def __len__(self):
+        return len(self.x_coords)
+
+    def mark(self, black_pixels, threshold):
+        """Get the answers of a page from the black pixels counted in each answer space. An answer space
+        is answered if it has more than threshold times the black pixels of the template.
+        Returns the codes of the answered entries (in order of their first answered space) and a matrix
+        with the value code of each of their variables, MISSING_CODE or DUPLICATED_CODE"""
+        answered = np.flatnonzero(np.asarray(black_pixels) > self.black_pixels * threshold)
+        entry_codes = self.entry_codes[answered]
+        variable_codes = self.variable_codes[answered]
+        _, first_answers = np.unique(entry_codes, return_index=True)
+        answered_entries = entry_codes[np.sort(first_answers)]
+
+        # Row of each entry in the matrix of answers
+        rows = np.empty(len(self.entries), dtype=np.intp)
+        rows[answered_entries] = np.arange(len(answered_entries))
+        answers = np.full((len(answered_entries), len(self.variables)), MISSING_CODE, dtype=np.int32)
+        answers[rows[entry_codes], variable_codes] = self.value_codes[answered]
+
+        answers_count = np.zeros(answers.shape, dtype=np.intp)
+        np.add.at(answers_count, (rows[entry_codes], variable_codes), 1)
+        answers[answers_count > 1] = DUPLICATED_CODE
+        return answered_entries, answers
+
+    def get_rows(self, date, answered_entries, answers):
+        """Get the CSV rows (date, entry and the value of each variable) of the answers of a page"""
+        for entry_code, entry_answers in zip(answered_entries, answers):
+            yield [date, self.entries[entry_code]] + [self.get_value(value_code) for value_code in entry_answers]
+
+    def get_value(self, value_code):
+        """Get the CSV value of a value code"""
+        if value_code == MISSING_CODE:
+            return MISSING
+        if value_code == DUPLICATED_CODE:
+            return DUPLICATED
+        return self.values[value_code]
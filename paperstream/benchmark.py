@@ -0,0 +1,437 @@
+"""
+Benchmarks of the extraction, marking and creation of diaries. The diaries are synthetic scans
+(A5 pages with the four L-shaped corner markers of a diary page and a grid of bubbles, some of them
+crossed out) generated at different resolutions, so the results are reproducible on any machine.
+
+Each benchmark runs in a new process to measure its peak memory. The results are saved as JSON and
+can be compared with the results of a previous run (a baseline) to flag regressions.
+
+"""
+import csv
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import get_context
+from pathlib import Path
+from paperstream.settings import BENCHMARK_DPIS, BENCHMARK_PAGES, BENCHMARKS, REGRESSION_TOLERANCE
+
+BENCHMARK_DATE = "01/09/2018"
+
+# Benchmarks that process scanned pages, the rest create PDF documents and do not depend on a resolution
+SCANNED_BENCHMARKS = ("extract_answer_area_from_page", "mark_answer_area", "encode_diary",
+                      "encode_diary_sparse", "encode_diary_coarse", "reencode_diary")
+
+# Benchmarks that encode a whole diary
+ENCODE_BENCHMARKS = ("encode_diary", "encode_diary_sparse", "encode_diary_coarse", "reencode_diary")
+
+# Benchmarks of the startup of the web server, they do not depend on a resolution nor a document length
+STARTUP_BENCHMARKS = ("import_marking_server",)
+# Modules reported as the slowest imports of a startup benchmark
+SLOWEST_IMPORTS = 5
+
+# Size (points) of an A5 diary page, its corner markers (L-shaped, 26 points long and 4 thick) and the
+# position of their top left corners (from the top left corner of the page)
+PAGE_SIZE = (419.52, 595.32)
+MARKER_SIZE = 26
+MARKER_THICKNESS = 4
+MARKERS_POSITIONS = ((25, 16.32), (365, 16.32), (25, 554.32), (365, 554.32))
+
+# Rubric coordinates are relative to an answer area of 570x920 (the canvas of the web interface)
+RUBRIC_SIZE = (570, 920)
+RUBRIC_RADIUS = 12
+RUBRIC_ENTRIES = 3
+RUBRIC_VARIABLES = ("symptom1", "symptom2", "symptom3")
+RUBRIC_VALUES = (0, 1, 2, 3)
+
+
+def points_to_pixels(points, dpi):
+    """Convert a length in points (1/72 inch) to pixels"""
+    return int(round(points * dpi / 72.0))
+
+def get_synthetic_rubric():
+    """Get a rubric (entryID,variable,value,x,y,radius) with a grid of bubbles, a row per variable"""
+    answer_spaces = []
+    for entry in range(RUBRIC_ENTRIES):
+        for row, variable in enumerate(RUBRIC_VARIABLES):
+            for column, value in enumerate(RUBRIC_VALUES):
+                x = 120 + column * 100
+                y = 80 + entry * 290 + row * 80
+                answer_spaces.append("{},{},{},{},{},{}".format(entry, variable, value, x, y, RUBRIC_RADIUS))
+    return "\n".join(answer_spaces)
+
+def get_rubric_page_position(x, y):
+    """Get the position (points) on the page of a rubric coordinate, the answer area of a page is the
+    bounding box of its corner markers"""
+    left, top = MARKERS_POSITIONS[0]
+    right = MARKERS_POSITIONS[3][0] + MARKER_SIZE
+    bottom = MARKERS_POSITIONS[3][1] + MARKER_SIZE
+    return (left + x * (right - left) / RUBRIC_SIZE[0], top + y * (bottom - top) / RUBRIC_SIZE[1])
+
+def create_synthetic_page(dpi, rubric, marked_answers, seed):
+    """Create a scanned page (Open CV image) at dpi with a bubble per answer space of the rubric,
+    the answer spaces in marked_answers ((entry, variable, value) tuples) are crossed out"""
+    import cv2
+    import numpy as np
+
+    generator = np.random.RandomState(seed)
+    width, height = points_to_pixels(PAGE_SIZE[0], dpi), points_to_pixels(PAGE_SIZE[1], dpi)
+    page = np.full((height, width), 245, dtype=np.uint8)
+
+    for corner, (x, y) in enumerate(MARKERS_POSITIONS):
+        left, top = points_to_pixels(x, dpi), points_to_pixels(y, dpi)
+        size, thickness = points_to_pixels(MARKER_SIZE, dpi), points_to_pixels(MARKER_THICKNESS, dpi)
+        # The markers point outwards: top markers have their horizontal arm at the top, left
+        # markers their vertical arm on the left
+        arm_top = top if corner < 2 else top + size - thickness
+        arm_left = left if corner % 2 == 0 else left + size - thickness
+        cv2.rectangle(page, (left, arm_top), (left + size - 1, arm_top + thickness - 1), 0, -1)
+        cv2.rectangle(page, (arm_left, top), (arm_left + thickness - 1, top + size - 1), 0, -1)
+
+    radius = points_to_pixels(RUBRIC_RADIUS * 0.5, dpi)
+    for answer_space in rubric.split("\n"):
+        entry, variable, value, x, y, _ = answer_space.split(",")
+        center = tuple(points_to_pixels(position, dpi)
+                       for position in get_rubric_page_position(float(x), float(y)))
+        cv2.circle(page, center, radius, 60, max(1, points_to_pixels(0.75, dpi)), cv2.LINE_AA)
+        if (entry, variable, value) in marked_answers:
+            # A pen cross over the bubble
+            pen, arm = max(1, points_to_pixels(1.5, dpi)), int(radius * 0.9)
+            for direction in (1, -1):
+                cv2.line(page, (center[0] - arm, center[1] - direction * arm),
+                         (center[0] + arm, center[1] + direction * arm), 40, pen, cv2.LINE_AA)
+
+    # Scanner noise and a small rotation of the paper
+    page = cv2.add(page, generator.randint(0, 12, page.shape, dtype=np.uint8))
+    rotation = cv2.getRotationMatrix2D((width / 2.0, height / 2.0), generator.uniform(-0.5, 0.5), 1)
+    page = cv2.warpAffine(page, rotation, (width, height), borderValue=245)
+    return cv2.cvtColor(cv2.GaussianBlur(page, (3, 3), 0), cv2.COLOR_GRAY2BGR)
+
+def create_synthetic_diary(diary_path, dpi, pages, seed=0):
+    """Create a zip file with the scanned pages (grayscale png files, as scanners produce them) of a
+    diary with one answer per variable and entry. Returns the answers marked in each page as {entry: {variable: value}}"""
+    import cv2
+
+    rubric = get_synthetic_rubric()
+    generator = random.Random(seed)
+    diary_answers = []
+    with zipfile.ZipFile(str(diary_path), 'w') as diary_zip:
+        for page in range(pages):
+            page_answers = {str(entry): {variable: str(generator.choice(RUBRIC_VALUES))
+                                         for variable in RUBRIC_VARIABLES}
+                            for entry in range(RUBRIC_ENTRIES)}
+            marked_answers = {(entry, variable, value) for entry, answers in page_answers.items()
+                              for variable, value in answers.items()}
+            page_image = cv2.cvtColor(create_synthetic_page(dpi, rubric, marked_answers, seed + page + 1),
+                                      cv2.COLOR_BGR2GRAY)
+            diary_zip.writestr("page_{:04d}.png".format(page), cv2.imencode(".png", page_image)[1].tobytes())
+            diary_answers.append(page_answers)
+    return diary_answers
+
+def create_template_page(template_dir, dpi):
+    """Save a blank scanned page (without marked answers) to encode the synthetic diaries"""
+    import cv2
+
+    os.makedirs(str(template_dir), exist_ok=True)
+    template_path = os.path.join(str(template_dir), "template.png")
+    template_page = create_synthetic_page(dpi, get_synthetic_rubric(), set(), seed=0)
+    cv2.imwrite(template_path, cv2.cvtColor(template_page, cv2.COLOR_BGR2GRAY))
+    return template_path
+
+def create_pdf_template(pdf_path):
+    """Create the PDF template of a diary page (one A5 page with a few entries to fill in)"""
+    from reportlab.pdfgen import canvas
+
+    pdf_canvas = canvas.Canvas(str(pdf_path), pagesize=PAGE_SIZE)
+    for entry in range(RUBRIC_ENTRIES):
+        top = PAGE_SIZE[1] - 60 - entry * 175
+        pdf_canvas.drawString(50, top, "Entry {}".format(entry + 1))
+        for row, variable in enumerate(RUBRIC_VARIABLES):
+            pdf_canvas.drawString(60, top - 30 - row * 45, variable)
+            for value in RUBRIC_VALUES:
+                pdf_canvas.circle(160 + value * 60, top - 26 - row * 45, 8)
+    pdf_canvas.showPage()
+    pdf_canvas.save()
+    return pdf_path
+
+def get_peak_rss():
+    """Get the peak resident memory (MB) of this process or None if it cannot be measured"""
+    # On Linux ru_maxrss is inherited from the parent process, the peak of this process is VmHWM
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # macOS reports bytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024.0 * 1024.0)
+
+def get_encoded_pages(encoded_diary):
+    """Get the answers of each page of an encoded diary (CSV file) as {entry: {variable: value}}"""
+    first_date = datetime.datetime.strptime(BENCHMARK_DATE, "%d/%m/%Y")
+    pages_answers = {}
+    with open(str(encoded_diary), newline='') as encoded_file:
+        rows = csv.reader(encoded_file)
+        headers = next(rows)[2:]
+        for row in rows:
+            page = (datetime.datetime.strptime(row[0], "%Y-%m-%d") - first_date).days
+            pages_answers.setdefault(page, {})[row[1]] = {variable: value for variable, value
+                                                          in zip(headers, row[2:]) if value != "MISSING"}
+    return pages_answers
+
+def get_marked_pages(marked_pages, answer_key):
+    """Get the answers of each marked page (the results of mark_answer_area) as {entry: {variable: value}}"""
+    from paperstream.answer_key import MISSING
+
+    pages_answers = {}
+    for page, page_answers in enumerate(marked_pages):
+        rows = answer_key.get_rows(page_answers["date"], page_answers["entries"], page_answers["answers"])
+        pages_answers[page] = {row[1]: {variable: value for variable, value in zip(answer_key.variables, row[2:])
+                                        if value != MISSING} for row in rows}
+    return pages_answers
+
+def count_correct_pages(pages_answers, diary_answers):
+    """Count the pages whose answers ({page: {entry: {variable: value}}}) are the ones marked in the diary"""
+    return sum(1 for page, answers in enumerate(diary_answers) if pages_answers.get(page) == answers)
+
+def get_import_times(module, work_dir=None):
+    """Import module in a new interpreter (started in work_dir), returns the seconds it took to start
+    and the cumulative import time (seconds) of each module imported, as reported by -X importtime
+    (Python 3.7 and later)"""
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [package_dir, os.environ.get("PYTHONPATH")])))
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module], cwd=work_dir,
+                             env=env, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    seconds = time.perf_counter() - start
+
+    # Lines "import time: self [us] | cumulative | imported package"
+    import_times = {}
+    for line in process.stderr.splitlines():
+        if line.startswith("import time:") and not line.endswith("imported package"):
+            _, cumulative, imported = line[len("import time:"):].split("|")
+            import_times[imported.strip()] = int(cumulative) / 1e6
+    return seconds, import_times
+
+def run_startup_case(benchmark, case_dir):
+    """Run a startup benchmark, returns the time to import the web server and its slowest imports"""
+    seconds, import_times = get_import_times("paperstream.marking_server", work_dir=case_dir)
+    # Packages, their submodules are part of their cumulative time
+    slowest_imports = sorted((imported for imported in import_times
+                              if "." not in imported and imported != "paperstream"),
+                             key=import_times.get, reverse=True)[:SLOWEST_IMPORTS]
+    return {"seconds": seconds, "pages_per_second": None, "peak_rss_mb": None, "correct_pages": None,
+            "slowest_imports": [[imported, import_times[imported]] for imported in slowest_imports]}
+
+@contextmanager
+def case_output_dirs(case_dir):
+    """Point the output folders of encode_diary and create_diary to case_dir inside the with block,
+    the previous ones are restored afterwards"""
+    import paperstream.create_diary as create
+    import paperstream.encode_diary as encode
+
+    case_dir = Path(case_dir)
+    output_dirs = [(encode, "EXTRACTED_PAGES_DIR", str(case_dir / "diary_pages") + os.sep),
+                   (encode, "EXTRACTED_AREAS_DIR", str(case_dir / "answers_areas") + os.sep),
+                   (encode, "ENCODED_DIARIES_DIR", case_dir),
+                   (encode, "ANSWER_KEYS_DIR", case_dir / "answer_keys"),
+                   (encode, "BINARY_AREAS_DIR", case_dir / "binary_areas"),
+                   (encode, "TEMPLATE_AREAS_DIR", case_dir / "template_areas"),
+                   (encode, "ENCODING_STATE_DIR", case_dir / "encoding_state"),
+                   (create, "CREATED_DIARIES_DIR", case_dir)]
+    previous_dirs = [(module, name, getattr(module, name)) for module, name, case_output_dir in output_dirs]
+    try:
+        for module, name, case_output_dir in output_dirs:
+            setattr(module, name, case_output_dir)
+        yield
+    finally:
+        for module, name, previous_dir in previous_dirs:
+            setattr(module, name, previous_dir)
+
+def run_case(benchmark, case_dir, pages):
+    """Run a benchmark on the inputs prepared in case_dir in this process, returns its time, peak
+    memory and, for the benchmarks that encode pages, how many pages were encoded correctly.
+    The peak memory is the one of the whole process, run_benchmarks calls it in a new process"""
+    if benchmark in STARTUP_BENCHMARKS:
+        return run_startup_case(benchmark, case_dir)
+    with case_output_dirs(case_dir):
+        return measure_case(benchmark, Path(case_dir), pages)
+
+def measure_case(benchmark, case_dir, pages):
+    """Run a benchmark with the output folders pointing to case_dir, see run_case"""
+    import paperstream.create_diary as create
+    import paperstream.encode_diary as encode
+    import paperstream.extract_framed_area as frame
+
+    if benchmark != "reencode_diary":
+        # Only re-encoding reuses the answer areas binarised by previous runs
+        shutil.rmtree(str(encode.BINARY_AREAS_DIR), ignore_errors=True)
+    diary_path = str(case_dir / "diary.zip")
+    date = encode.valid_date(BENCHMARK_DATE)
+    if benchmark == "mark_answer_area":
+        from paperstream.answer_key import AnswerKey
+
+        with open(str(case_dir / "answer_key.npz"), 'rb') as answer_key_file:
+            answer_key = AnswerKey.from_bytes(answer_key_file.read())
+        with open(str(case_dir / "answer_areas.json")) as answer_areas_file:
+            answer_areas = json.load(answer_areas_file)
+
+    start = time.perf_counter()
+    if benchmark == "extract_answer_area_from_page":
+        frame.extract_answer_area_from_page(diary_path, encode.EXTRACTED_PAGES_DIR, encode.EXTRACTED_AREAS_DIR)
+    elif benchmark == "mark_answer_area":
+        marked_pages = [encode.mark_answer_area(answer_area, answer_key, date) for answer_area in answer_areas]
+    elif benchmark in ENCODE_BENCHMARKS:
+        encoded_diary = encode.encode_diary(diary_path, str(case_dir / "template"), get_synthetic_rubric(),
+                                            BENCHMARK_DATE, sparse=benchmark == "encode_diary_sparse",
+                                            coarse=benchmark == "encode_diary_coarse")
+    elif benchmark == "create_a4_diary":
+        create.create_a4_diary(str(case_dir / "template.pdf"), pages, BENCHMARK_DATE)
+    elif benchmark == "convert_to_a5_booklet":
+        create.convert_to_a5_booklet(str(case_dir / "template_document.pdf"))
+    seconds = time.perf_counter() - start
+
+    result = {"seconds": seconds, "pages_per_second": pages / seconds, "peak_rss_mb": get_peak_rss(),
+              "correct_pages": None}
+    if benchmark == "mark_answer_area" or benchmark in ENCODE_BENCHMARKS:
+        with open(str(case_dir / "diary_answers.json")) as diary_answers_file:
+            diary_answers = json.load(diary_answers_file)
+        if benchmark == "mark_answer_area":
+            pages_answers = get_marked_pages(marked_pages, answer_key)
+        else:
+            pages_answers = get_encoded_pages(encoded_diary)
+        result["correct_pages"] = count_correct_pages(pages_answers, diary_answers)
+    return result
+
+def prepare_case(benchmark, case_dir, dpi, pages):
+    """Create in case_dir the inputs of a benchmark (and the answers marked in the scanned pages)"""
+    case_dir = Path(case_dir)
+    os.makedirs(str(case_dir), exist_ok=True)
+    if benchmark in STARTUP_BENCHMARKS:
+        return
+
+    import paperstream.create_diary as create
+    import paperstream.encode_diary as encode
+    import paperstream.extract_framed_area as frame
+
+    if benchmark in SCANNED_BENCHMARKS:
+        create_template_page(case_dir / "template", dpi)
+        diary_answers = create_synthetic_diary(case_dir / "diary.zip", dpi, pages)
+        with open(str(case_dir / "diary_answers.json"), 'w') as diary_answers_file:
+            json.dump(diary_answers, diary_answers_file)
+        if benchmark == "mark_answer_area":
+            # Marking works on extracted answer areas, they are extracted beforehand
+            areas_dir = str(case_dir / "answers_areas") + os.sep
+            answer_areas = frame.extract_answer_area_from_page(str(case_dir / "diary.zip"),
+                                                               str(case_dir / "diary_pages") + os.sep, areas_dir)
+            template_area = frame.extract_answer_area_from_page(str(case_dir / "template" / "template.png"),
+                                                                str(case_dir / "diary_pages") + os.sep, areas_dir)[0]
+            with case_output_dirs(case_dir):
+                answer_key = encode.get_answer_key(template_area, get_synthetic_rubric())
+            with open(str(case_dir / "answer_key.npz"), 'wb') as answer_key_file:
+                answer_key_file.write(answer_key.to_bytes())
+            with open(str(case_dir / "answer_areas.json"), 'w') as answer_areas_file:
+                json.dump(answer_areas, answer_areas_file)
+        elif benchmark == "reencode_diary":
+            # The diary is encoded once (e.g. before fixing the rubric) to cache its binarised answer areas
+            with case_output_dirs(case_dir):
+                encode.encode_diary(str(case_dir / "diary.zip"), str(case_dir / "template"),
+                                    get_synthetic_rubric(), BENCHMARK_DATE)
+        return
+
+    create_pdf_template(case_dir / "template.pdf")
+    if benchmark == "convert_to_a5_booklet":
+        with case_output_dirs(case_dir):
+            create.create_a4_diary(str(case_dir / "template.pdf"), pages, BENCHMARK_DATE)
+
+def run_benchmarks(benchmarks=BENCHMARKS, dpis=BENCHMARK_DPIS, pages_counts=BENCHMARK_PAGES, repeat=1,
+                   output=None):
+    """Run every benchmark at every resolution (if it processes scanned pages) and document length.
+    Each run is repeated in a new process, the fastest one is reported. Returns the results as a
+    dictionary and saves them as JSON to output if it is given"""
+    for benchmark in benchmarks:
+        if benchmark not in BENCHMARKS:
+            raise ValueError("Unknown benchmark {}, choose from {}".format(benchmark, ", ".join(BENCHMARKS)))
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="paperstream_benchmark_") as work_dir:
+        for benchmark in benchmarks:
+            for dpi in (dpis if benchmark in SCANNED_BENCHMARKS else [None]):
+                for pages in (pages_counts if benchmark not in STARTUP_BENCHMARKS else [None]):
+                    case_dir = os.path.join(work_dir, "{}_{}_{}".format(benchmark, dpi, pages))
+                    prepare_case(benchmark, case_dir, dpi, pages)
+                    runs = []
+                    for _ in range(repeat):
+                        # A new process per run, its peak memory is the one of the benchmark
+                        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                            runs.append(executor.submit(run_case, benchmark, case_dir, pages).result())
+                    best_run = min(runs, key=lambda run: run["seconds"])
+                    best_run["peak_rss_mb"] = max(run["peak_rss_mb"] or 0 for run in runs) or None
+                    results.append(dict({"benchmark": benchmark, "dpi": dpi, "pages": pages}, **best_run))
+
+    benchmark_results = {"date": datetime.datetime.now().isoformat(timespec="seconds"),
+                         "python": platform.python_version(), "platform": platform.platform(),
+                         "cpus": os.cpu_count(), "results": results}
+    if output is not None:
+        with open(str(output), 'w') as output_file:
+            json.dump(benchmark_results, output_file, indent=2)
+    return benchmark_results
+
+def describe_result(result):
+    """Get a line of text with the throughput and peak memory of a benchmark"""
+    if result["benchmark"] in STARTUP_BENCHMARKS:
+        return "{}: {:.2f} s, slowest imports {}".format(
+            result["benchmark"], result["seconds"],
+            ", ".join("{} ({:.2f} s)".format(imported, seconds) for imported, seconds in result["slowest_imports"]))
+
+    description = "{} ({} pages".format(result["benchmark"], result["pages"])
+    if result["dpi"] is not None:
+        description += ", {} dpi".format(result["dpi"])
+    description += "): {:.2f} pages/s".format(result["pages_per_second"])
+    if result["peak_rss_mb"] is not None:
+        description += ", {:.0f} MB peak memory".format(result["peak_rss_mb"])
+    if result["correct_pages"] is not None:
+        description += ", {}/{} pages encoded correctly".format(result["correct_pages"], result["pages"])
+    return description
+
+def compare_with_baseline(benchmark_results, baseline_results, tolerance=REGRESSION_TOLERANCE):
+    """Get the regressions (descriptions) of the results: a throughput, a startup time or a peak memory
+    worse than the one of the same benchmark, resolution and length in the baseline by more than tolerance"""
+    baseline = {(result["benchmark"], result["dpi"], result["pages"]): result
+                for result in baseline_results["results"]}
+    regressions = []
+    for result in benchmark_results["results"]:
+        baseline_result = baseline.get((result["benchmark"], result["dpi"], result["pages"]))
+        if baseline_result is None:
+            continue
+        name = "{} ({} dpi, {} pages)".format(result["benchmark"], result["dpi"], result["pages"])
+        if baseline_result["pages_per_second"] and result["pages_per_second"] is not None and \
+           result["pages_per_second"] < baseline_result["pages_per_second"] * (1 - tolerance):
+            regressions.append("{}: {:.2f} pages/s, baseline {:.2f} pages/s".format(
+                name, result["pages_per_second"], baseline_result["pages_per_second"]))
+        if result["benchmark"] in STARTUP_BENCHMARKS and \
+           result["seconds"] > baseline_result["seconds"] * (1 + tolerance):
+            regressions.append("{}: {:.2f} s, baseline {:.2f} s".format(name, result["seconds"],
+                                                                        baseline_result["seconds"]))
+        if result["correct_pages"] is not None and result["correct_pages"] < result["pages"]:
+            regressions.append("{}: {} of {} pages encoded correctly".format(
+                name, result["correct_pages"], result["pages"]))
+        if baseline_result["peak_rss_mb"] and result["peak_rss_mb"] is not None and \
+           result["peak_rss_mb"] > baseline_result["peak_rss_mb"] * (1 + tolerance):
+            regressions.append("{}: {:.0f} MB peak memory, baseline {:.0f} MB".format(
+                name, result["peak_rss_mb"], baseline_result["peak_rss_mb"]))
+    return regressions
@@ -0,0 +1,160 @@
+"""
+File-based caches of the intermediate results of the encoding pipeline. Each entry is a file named
+after the hash of everything it depends on, it is written atomically (so several processes can share
+a cache) and the least recently used entries are evicted when the cache grows over its limits.
+
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from functools import lru_cache
+
+
+def get_umask():
+    """Get the file mode creation mask of the process"""
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+# Permissions of the files written atomically, the ones open would give them (0o644 with the usual
+# umask) instead of the 0o600 of temporary files. The umask is read once, changing it is not thread safe
+FILE_PERMISSIONS = 0o666 & ~get_umask()
+
+# Fraction of the limits of a cache removed by an eviction, so the directory is not scanned again
+# until that many entries are added
+EVICTION_FRACTION = 0.1
+
+
+def hash_key(*parts):
+    """Get a key (hex digest) that identifies parts, each one bytes or a value with a stable repr"""
+    hash_object = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = repr(part).encode()
+        # Prefix each part with its length so different splits of the same bytes get different keys
+        hash_object.update(str(len(part)).encode() + b":")
+        hash_object.update(part)
+    return hash_object.hexdigest()
+
+def create_temporal_file(directory, suffix=".tmp"):
+    """Create a temporary file in directory with FILE_PERMISSIONS, so it can replace another file.
+    Returns its descriptor (open for writing) and path"""
+    descriptor, temporal_path = tempfile.mkstemp(dir=directory, suffix=suffix)
+    try:
+        os.chmod(temporal_path, FILE_PERMISSIONS)
+    except BaseException:
+        os.close(descriptor)
+        os.remove(temporal_path)
+        raise
+    return descriptor, temporal_path
+
+def atomic_write(path, data):
+    """Write data (bytes) to path, readers never see a partially written file"""
+    directory = os.path.dirname(str(path))
+    os.makedirs(directory, exist_ok=True)
+    descriptor, temporal_path = create_temporal_file(directory)
+    try:
+        with os.fdopen(descriptor, 'wb') as temporal_file:
+            temporal_file.write(data)
+        os.replace(temporal_path, str(path))
+    except BaseException:
+        os.remove(temporal_path)
+        raise
+
+
+@lru_cache(maxsize=None)
+def get_disk_cache(directory, extension, max_entries=None, max_bytes=None):
+    """Get the DiskCache of directory shared by the threads of this process, so the size it tracks
+    is kept between the entries added"""
+    return DiskCache(directory, extension, max_entries, max_bytes)
+
+if hasattr(os, "register_at_fork"):
+    # A forked process could inherit the lock of a cache held by a thread that does not exist in it
+    os.register_at_fork(after_in_child=get_disk_cache.cache_clear)
+
+
+class DiskCache(object):
+    """A directory of cache entries (one file per key) with least recently used eviction.
+    The entries and bytes of the cache are counted as entries are added, the directory is only
+    scanned when they go over a limit. Then the least recently used entries are evicted until the
+    cache is EVICTION_FRACTION under its limits. The entries added by other processes are counted on
+    the next scan, until then the cache can go over its limits by what they add"""
+    def __init__(self, directory, extension, max_entries=None, max_bytes=None):
+        self.directory = str(directory)
+        self.extension = extension
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Entries and bytes of the cache since the last scan, None until it is scanned
+        self.entries_count = None
+        self.total_bytes = None
+        self.lock = threading.Lock()
+
+    def get_path(self, key):
+        """Get the path of the file of the entry key"""
+        return os.path.join(self.directory, key + self.extension)
+
+    def get(self, key):
+        """Get the content (bytes) of the entry key or None if it is not cached"""
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as entry:
+                data = entry.read()
+            # The modification time of an entry is the last time it was used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key, data):
+        """Save data (bytes) as the entry key and evict the entries over the limits of the cache"""
+        path = self.get_path(key)
+        atomic_write(path, data)
+        with self.lock:
+            if self.entries_count is None or self.over_limits(self.entries_count + 1, self.total_bytes + len(data)):
+                self.evict()
+            else:
+                self.entries_count += 1
+                self.total_bytes += len(data)
+        return path
+
+    def over_limits(self, entries_count, total_bytes, margin=False):
+        """Whether entries_count entries of total_bytes are over the limits of the cache or, with margin,
+        over the limits less EVICTION_FRACTION of them (rounded down)"""
+        max_entries, max_bytes = self.max_entries, self.max_bytes
+        if margin and max_entries is not None:
+            max_entries -= int(max_entries * EVICTION_FRACTION)
+        if margin and max_bytes is not None:
+            max_bytes -= int(max_bytes * EVICTION_FRACTION)
+        return ((max_entries is not None and entries_count > max_entries) or
+                (max_bytes is not None and total_bytes > max_bytes))
+
+    def get_entries(self):
+        """Get the (path, size, last time used) of every entry, least recently used first"""
+        entries = []
+        if os.path.isdir(self.directory):
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(self.extension) and entry.is_file():
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self):
+        """Scan the cache and, if it is over its limits, remove the least recently used entries until
+        it is EVICTION_FRACTION under them"""
+        entries = self.get_entries()
+        total_bytes = sum(size for path, size, last_used in entries)
+        margin = self.over_limits(len(entries), total_bytes)
+        while entries and self.over_limits(len(entries), total_bytes, margin):
+            path, size, last_used = entries.pop(0)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another process evicted it first
+                pass
+            total_bytes -= size
+        self.entries_count = len(entries)
+        self.total_bytes = total_bytes
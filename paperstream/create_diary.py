@@ -5,11 +5,19 @@ Julio Vega
 """
 import datetime
 import math
+import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
 from io import BytesIO
 from pathlib import Path
 
+from natsort import natsorted, ns
 from PyPDF2 import PdfFileReader, PdfFileWriter
+from PyPDF2.generic import (ArrayObject, DecodedStreamObject, DictionaryObject, NameObject,
+                            RectangleObject)
+from PyPDF2.pdf import ContentStream, PageObject
 from reportlab.lib.pagesizes import A5, A4
 from reportlab.lib.utils import ImageReader
 from reportlab.pdfbase import pdfmetrics
@@ -27,6 +35,10 @@ LOGO_PATH = resource_path(CORNER_DIR / Path("logo.png"))
 DEFAULT_FONT = resource_path(CORNER_DIR / Path('FreeSansLocal.ttf'))
 CREATED_DIARIES_DIR = resource_path("output/created_diaries/")
 
+# Operator that stands in for the content of a template while a diary page is merged and scaled,
+# so the content of the template (usually large) is parsed only once per diary
+TEMPLATE_CONTENT_PLACEHOLDER = b"PaperStreamTemplateContent"
+
 #############################################################
 #############################################################
 #############################################################
@@ -104,40 +116,87 @@ def add_double_page(writer, page_size, print_page):
         page.mergeTranslatedPage(r_page, width / 2, 0)
 
 
-def convert_to_a5_booklet(input_file, blanks=0):
-    '''Converts a PDF into a double sided A5 file to print as an A4 (two A5 pages per A4 page)'''
-
-    # Create internal dir to save the a5 files    
-    a5_booklets_dir = CREATED_DIARIES_DIR
-    Path.mkdir(a5_booklets_dir, parents=True, exist_ok=True)
-
-    # Create the a5 booklet's name
-    a5_booklet_name = Path(input_file).stem + "_as_a5_booklet"
-    a5_booklet = a5_booklets_dir / Path("{}.pdf".format(a5_booklet_name))
+def get_page_as_form(page):
+    ''' Gets the content and resources of a page as a form XObject (a stream), None if it is empty '''
+    contents = page.getContents()
+    if contents is None:
+        return None
+    if isinstance(contents, ArrayObject):
+        data = b"\n".join(content.getObject().getData() for content in contents)
+    else:
+        data = contents.getData()
+
+    form = DecodedStreamObject()
+    form.setData(data)
+    form.update({NameObject("/Type"): NameObject("/XObject"),
+                 NameObject("/Subtype"): NameObject("/Form"),
+                 NameObject("/BBox"): RectangleObject(page.mediaBox),
+                 NameObject("/Resources"): page["/Resources"]})
+    return form
+
+def add_double_page_as_forms(writer, page_size, print_page):
+    ''' Adds a double page that draws the left and right pages as form XObjects '''
+    width, height = page_size
+    page = writer.insertBlankPage(width=width, height=height, index=writer.getNumPages())
 
-    reader = PdfFileReader(open(input_file, "rb"))
-    pages = [reader.getPage(p) for p in range(0, reader.getNumPages())]
+    # Unlike mergePage, the content streams of the pages are not parsed or renamed. The streams are
+    # added as direct objects, the writer turns them into indirect objects when it writes the document
+    forms = DictionaryObject()
+    operations = []
+    for name, half_page, x_offset in (("/Left", print_page.left.page, 0),
+                                      ("/Right", print_page.right.page, width / 2)):
+        form = None if half_page is None else get_page_as_form(half_page)
+        if form is not None:
+            forms[NameObject(name)] = form
+            operations.append("q 1 0 0 1 {} 0 cm {} Do Q".format(x_offset, name))
+
+    content = DecodedStreamObject()
+    content.setData("\n".join(operations).encode())
+    page[NameObject("/Resources")] = DictionaryObject({NameObject("/XObject"): forms})
+    page[NameObject("/Contents")] = content
+
+def write_a5_booklet(pages, output_stream, blanks=0, as_forms=False):
+    '''Writes pages (A4 PageObjects) as a double sided A5 booklet to print as an A4 to output_stream.
+    With as_forms each A4 page is drawn as a form XObject, much faster than merging their contents'''
+    pages = list(pages)
+    first_page = pages[0]
     for index in range(0, blanks):
         pages.insert(0, None)
 
     sheets = build_booklet(pages)
 
     writer = PdfFileWriter()
-    firs_page = reader.getPage(0)
-    input_width = firs_page.mediaBox.getWidth()
+    input_width = first_page.mediaBox.getWidth()
     output_width = input_width * 2
-    input_height = firs_page.mediaBox.getHeight()
+    input_height = first_page.mediaBox.getHeight()
     output_height = input_height
 
     page_size = (output_width, output_height)
 
     # We want to group fronts and backs together.
+    add_page = add_double_page_as_forms if as_forms else add_double_page
     for sheet in sheets:
-        add_double_page(writer, page_size, sheet.back)
-        add_double_page(writer, page_size, sheet.front)
+        add_page(writer, page_size, sheet.back)
+        add_page(writer, page_size, sheet.front)
+
+    writer.write(output_stream)
+
+def convert_to_a5_booklet(input_file, blanks=0):
+    '''Converts a PDF into a double sided A5 file to print as an A4 (two A5 pages per A4 page)'''
+
+    # Create internal dir to save the a5 files    
+    a5_booklets_dir = CREATED_DIARIES_DIR
+    Path.mkdir(a5_booklets_dir, parents=True, exist_ok=True)
+
+    # Create the a5 booklet's name
+    a5_booklet_name = Path(input_file).stem + "_as_a5_booklet"
+    a5_booklet = a5_booklets_dir / Path("{}.pdf".format(a5_booklet_name))
+
+    reader = PdfFileReader(open(input_file, "rb"))
+    pages = [reader.getPage(p) for p in range(0, reader.getNumPages())]
 
     with open(a5_booklet, "wb") as a5_booklet_stream:
-        writer.write(a5_booklet_stream)
+        write_a5_booklet(pages, a5_booklet_stream, blanks)
     return a5_booklet
 
 #############################################################
@@ -148,6 +207,47 @@ def convert_to_a5_booklet(input_file, blanks=0):
 #############################################################
 #############################################################
 
+@lru_cache(maxsize=None)
+def load_image(image_path):
+    """Load an image (corners and logo) once, it is shared by all the pages of the diaries"""
+    return ImageReader(image_path)
+
+class DiaryTemplate(object):
+    """First page of a PDF template, read and parsed once to create all the pages of a diary"""
+    def __init__(self, pdf_template):
+        with open(pdf_template, "rb") as template_file:
+            self.data = template_file.read()
+        page = self.read_page()
+        self.content = None
+        if page.getContents() is not None:
+            self.content = ContentStream(page.getContents(), page.pdf).getData()
+
+    def read_page(self):
+        """Get a new copy of the template page, its resources are not shared with other copies"""
+        return PdfFileReader(BytesIO(self.data)).getPage(0)
+
+    def create_page(self, page_additions):
+        """Merge page_additions on top of a copy of the template page and scale it to A4"""
+        new_page = self.read_page()
+        if self.content is None:
+            new_page.mergePage(page_additions)
+            new_page.scaleTo(A4[0], A4[1])
+            return new_page
+
+        # Merge and scale the page with a placeholder instead of the template content and put the
+        # content back afterwards, the result is the same as merging and scaling the template itself
+        placeholder = DecodedStreamObject()
+        placeholder.setData(TEMPLATE_CONTENT_PLACEHOLDER)
+        new_page[NameObject("/Contents")] = placeholder
+        new_page.mergePage(page_additions)
+        new_page.scaleTo(A4[0], A4[1])
+
+        content = DecodedStreamObject()
+        content.setData(new_page.getContents().getData().replace(TEMPLATE_CONTENT_PLACEHOLDER + b"\n",
+                                                                 self.content, 1))
+        new_page[NameObject("/Contents")] = content
+        return new_page
+
 def create_diary_cover(participant_id, email, font):
     '''Create cover of the A5 diary'''
 
@@ -157,7 +257,7 @@ def create_diary_cover(participant_id, email, font):
 
     # Centering the logo or participant ID
     if Path.exists(LOGO_PATH):
-        logo = ImageReader(LOGO_PATH)
+        logo = load_image(LOGO_PATH)
         cover_canvas.drawImage(logo, x=(width * (1/6.0)),
                                y=(height/4),
                                width=width * (4/6.0),
@@ -178,6 +278,10 @@ def create_diary_cover(participant_id, email, font):
     return PdfFileReader(packet).getPage(0)
 
 def create_diary_page(pdf_template, font, top_left_text, page_number, top_right_text):
+    """Create a diary page, pdf_template is either the path to a PDF template or a DiaryTemplate"""
+    if not isinstance(pdf_template, DiaryTemplate):
+        pdf_template = DiaryTemplate(pdf_template)
+
     packet = BytesIO()
     diary_canvas = canvas.Canvas(packet, pagesize=A5)
 
@@ -193,7 +297,7 @@ def create_diary_page(pdf_template, font, top_left_text, page_number, top_right_
                 (CORNER_DIR / Path("corner_br.png"), 365, 15)]
     for corner_path, x, y in corners:
         if corner_path.exists():
-            corner = ImageReader(corner_path)
+            corner = load_image(corner_path)
             diary_canvas.drawImage(corner, x=x, y=y, mask='auto')
 
     # Footer
@@ -205,49 +309,155 @@ def create_diary_page(pdf_template, font, top_left_text, page_number, top_right_
     packet.seek(0)
     page_additions = PdfFileReader(packet).getPage(0)
 
-    new_page = PdfFileReader(open(pdf_template, "rb")).getPage(0)
-    new_page.mergePage(page_additions)
-    new_page.scaleTo(A4[0], A4[1])
+    return pdf_template.create_page(page_additions)
 
-    return new_page
+def add_blank_page(pages):
+    """Adds a blank page with the same size as the last page of pages"""
+    last_page = pages[-1]
+    pages.append(PageObject.createBlankPage(None, last_page.mediaBox.getWidth(),
+                                            last_page.mediaBox.getHeight()))
 
-def create_a4_diary(pdf_template, pages, top_left_text, email=None, font='Arial'):
-    """Creates an A4 document with [PAGES] from [STARTING_DATE]"""
+def create_a4_pages(pdf_template, pages, top_left_text, email=None, font='Arial', progress=None):
+    """Creates in memory the pages (PageObjects) of an A4 document with [PAGES] from [STARTING_DATE],
+    progress is called with (pages_done, pages_total) after each page is created"""
 
     starting_date = parse_date(top_left_text)
     font = set_active_font(font)
 
-    # Create output folder/file
     if not Path(pdf_template).exists():
         raise ValueError("Template does not exist {}".format(pdf_template))
 
-    Path.mkdir(CREATED_DIARIES_DIR, parents=True, exist_ok=True)
     a4_document_name = Path(pdf_template).stem
-    a4_document_path = CREATED_DIARIES_DIR / Path("{}_document.pdf".format(a4_document_name))
-
-    pdf_file = PdfFileWriter()
+    diary_template = DiaryTemplate(pdf_template)
 
     # Cover
-    pdf_file.addPage(create_diary_cover(a4_document_name, email, font))
-    pdf_file.addBlankPage()
+    a4_pages = [create_diary_cover(a4_document_name, email, font)]
+    add_blank_page(a4_pages)
 
     # Pages
     for page in range(1, pages+1):
         if starting_date is not None:
             top_left_text = starting_date.strftime('%A, %d %b %Y')
             starting_date += datetime.timedelta(days=1)
-        new_page = create_diary_page(pdf_template, font, top_left_text,page, a4_document_name)
-        pdf_file.addPage(new_page)
+        new_page = create_diary_page(diary_template, font, top_left_text,page, a4_document_name)
+        a4_pages.append(new_page)
+        if progress is not None:
+            progress(page, pages)
 
     # Backcover
-    pdf_file.addBlankPage()
+    add_blank_page(a4_pages)
+
+    return a4_pages
+
+def write_a4_diary(pages, output_stream):
+    """Writes pages (A4 PageObjects) as a PDF document to output_stream"""
+    pdf_file = PdfFileWriter()
+    for page in pages:
+        pdf_file.addPage(page)
+    pdf_file.write(output_stream)
+
+def get_a4_diary_path(pdf_template):
+    """Get the path of the A4 document created from pdf_template"""
+    return CREATED_DIARIES_DIR / Path("{}_document.pdf".format(Path(pdf_template).stem))
+
+def create_a4_diary(pdf_template, pages, top_left_text, email=None, font='Arial'):
+    """Creates an A4 document with [PAGES] from [STARTING_DATE]"""
+    a4_pages = create_a4_pages(pdf_template, pages, top_left_text, email=email, font=font)
 
     # Save a4 document
+    Path.mkdir(CREATED_DIARIES_DIR, parents=True, exist_ok=True)
+    a4_document_path = get_a4_diary_path(pdf_template)
     with open(a4_document_path, "wb") as output_stream:
-        pdf_file.write(output_stream)
+        write_a4_diary(a4_pages, output_stream)
 
     return a4_document_path
 
+def create_diary_and_booklet(pdf_template, pages, top_left_text, email=None, font='Arial',
+                             a4_output=None, a5_output=None, progress=None):
+    """Creates the A4 document and the A5 booklet of a PDF template in a single pass, the booklet is
+    built from the same pages as the A4 document (drawn as form XObjects) instead of reading it
+    back from disk.
+
+    Keyword arguments:
+    a4_output -- path or binary file object (e.g. BytesIO) where the A4 document is written, by
+                 default the same file as create_a4_diary
+    a5_output -- path or binary file object where the A5 booklet is written, by default the same
+                 file as convert_to_a5_booklet
+    progress -- function called with (pages_done, pages_total) after each page is created
+    Returns a4_output and a5_output
+    """
+    a4_pages = create_a4_pages(pdf_template, pages, top_left_text, email=email, font=font,
+                               progress=progress)
+
+    if a4_output is None or a5_output is None:
+        Path.mkdir(CREATED_DIARIES_DIR, parents=True, exist_ok=True)
+    if a4_output is None:
+        a4_output = get_a4_diary_path(pdf_template)
+    if a5_output is None:
+        a5_output = CREATED_DIARIES_DIR / Path("{}_as_a5_booklet.pdf".format(get_a4_diary_path(pdf_template).stem))
+
+    # The booklet is written first, writing a document replaces the references of its pages
+    write_booklet = partial(write_a5_booklet, as_forms=True)
+    for output, write_document in ((a5_output, write_booklet), (a4_output, write_a4_diary)):
+        if hasattr(output, "write"):
+            write_document(a4_pages, output)
+        else:
+            with open(output, "wb") as output_stream:
+                write_document(a4_pages, output_stream)
+
+    return a4_output, a5_output
+
+def create_diary_documents(pdf_template, pages, top_left_text, email=None, font='Arial'):
+    """Creates the A4 document and the A5 booklet of a PDF template.
+    Returns the path of both documents and the seconds it took to create them"""
+    start = time.perf_counter()
+    a4_diary, a5_booklet = create_diary_and_booklet(pdf_template, pages, top_left_text,
+                                                    email=email, font=font)
+    return a4_diary, a5_booklet, time.perf_counter() - start
+
+def get_templates_paths(pdf_templates):
+    """Get the paths of the PDF templates from a directory or a list of paths and directories"""
+    if isinstance(pdf_templates, (str, Path)):
+        pdf_templates = [pdf_templates]
+    templates_paths = []
+    for pdf_template in pdf_templates:
+        if os.path.isdir(str(pdf_template)):
+            templates_paths += natsorted([str(path) for path in Path(pdf_template).glob("**/*.pdf")], alg=ns.PATH)
+        else:
+            templates_paths.append(str(pdf_template))
+    return templates_paths
+
+def create_diaries(pdf_templates, pages, top_left_text, email=None, font='Arial', workers=None, progress=None):
+    """Creates the A4 document and the A5 booklet of a cohort of participants, one per process.
+
+    Keyword arguments:
+    pdf_templates -- a directory or a list with the PDF template of each participant
+    workers -- number of participants whose documents are created in parallel (None to use every CPU)
+    progress -- function called with (participants_done, participants_total) after each participant
+
+    Returns a list with the result of each participant (in the same order as the templates), a dict
+    with its template, a4_document, a5_booklet, seconds and error (None unless it failed)
+    """
+    templates_paths = get_templates_paths(pdf_templates)
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(create_diary_documents, pdf_template, pages, top_left_text,
+                                   email=email, font=font)
+                   for pdf_template in templates_paths]
+        for pdf_template, future in zip(templates_paths, futures):
+            result = {"template": pdf_template, "a4_document": None, "a5_booklet": None,
+                      "seconds": None, "error": None}
+            try:
+                a4_diary, a5_booklet, seconds = future.result()
+                result.update({"a4_document": str(a4_diary), "a5_booklet": str(a5_booklet),
+                               "seconds": seconds})
+            except Exception as error:
+                result["error"] = str(error)
+            results.append(result)
+            if progress is not None:
+                progress(len(results), len(templates_paths))
+    return results
+
 def set_active_font(font):
     """Register the font to use in header and footer of the diary"""
     try:
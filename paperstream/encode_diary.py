@@ -11,13 +11,20 @@ import json
 import numpy as np
 import PyPDF2
 import csv
-import hashlib
+import glob
 import sys
 import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import count, islice, repeat
 from natsort import natsorted, ns
 from pathlib import Path
 from PIL import Image, ImageOps, ImageDraw
+import paperstream.cache as cache
+from paperstream.answer_key import AnswerKey
 import paperstream.extract_framed_area as frame
+import paperstream.metrics as metrics
 import logging
 from logging.config import fileConfig
 
@@ -27,18 +34,46 @@ def resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 DEBUG = False
-fileConfig(resource_path("log_configuration.ini"))
+# The web server configures the logging before importing this module on the first encoding request
+if not logging.getLogger().handlers:
+    fileConfig(resource_path("log_configuration.ini"))
 LOGGER = logging.getLogger()
 
 EXTRACTED_PAGES_DIR = resource_path("output/temporal/diary_pages/")
 EXTRACTED_AREAS_DIR = resource_path("output/temporal/answers_areas/")
 EXTRACTED_MARK_DIR = resource_path("output/temporal/mark_areas/")
 ENCODED_DIARIES_DIR = resource_path("output/encoded_diaries/")
+ANSWER_KEYS_DIR = resource_path("output/temporal/answer_keys/")
+BINARY_AREAS_DIR = resource_path("output/temporal/binary_areas/")
+TEMPLATE_AREAS_DIR = resource_path("output/temporal/template_areas/")
+# Lock and progress files of the diaries being encoded, out of ENCODED_DIARIES_DIR (downloaded by the users)
+ENCODING_STATE_DIR = resource_path("output/temporal/encoding_state/")
 
+# Maximum number of answer keys (one per template and rubric) kept in ANSWER_KEYS_DIR
+ANSWER_KEYS_CACHE_SIZE = 64
+
+# Maximum size (bytes) of the binarised answer areas (one per scanned page) kept in BINARY_AREAS_DIR,
+# each one takes around 60 KB
+BINARY_AREAS_CACHE_BYTES = 256 * 1024 * 1024
+
+# Maximum number of encoding templates whose answer areas (extracted and binarised) are kept in
+# TEMPLATE_AREAS_DIR and in memory
+TEMPLATE_AREAS_CACHE_SIZE = 16
+TEMPLATE_AREAS_MEMORY_SIZE = 4
 
 # Percentage of black pixels that must be different between two answer marks to consider it answered
 MARK_BLACK_THRESHOLD = 1.3
 
+# Aperture of the median blur and block size and constant of the adaptative threshold that binarise
+# an answer area
+MEDIAN_BLUR_SIZE = 5
+ADAPTIVE_THRESHOLD_BLOCK_SIZE = 51
+ADAPTIVE_THRESHOLD_C = 22
+
+# Pixels around an answer space that are warped and binarised with it when a page is encoded in sparse
+# mode, the median blur and the adaptive threshold of the answer space depend on them
+SPARSE_MARGIN = ADAPTIVE_THRESHOLD_BLOCK_SIZE // 2 + MEDIAN_BLUR_SIZE // 2
+
 #############################################################
 #############################################################
 #############################################################
@@ -47,59 +82,128 @@ MARK_BLACK_THRESHOLD = 1.3
 #############################################################
 #############################################################
 
-def create_answer_space(x_coord, y_coord, radius, entry, variable, value, black_pixels):
-    """Create an object representing an answer space"""
-    anser_space = {}
-    anser_space["x"] = x_coord
-    anser_space["y"] = y_coord
-    anser_space["radius"] = radius
-    anser_space["entry"] = entry
-    anser_space["variable"] = variable
-    anser_space["value"] = value
-    anser_space["black_pixels"] = black_pixels
-    return anser_space
-
-
-def load_answer_key_from_file(output_dir, rubric):
-    """Load the answer key from a file """
-    marks_storage = os.path.join(output_dir, "answer_key.json")
-    if os.path.exists(marks_storage):
-        with open(marks_storage, 'r') as file:
-            answer_key = json.load(file)
-            hash_object = hashlib.sha256(rubric.encode())
-            key = hash_object.hexdigest()
-            if key in answer_key:
-                LOGGER.info("Answer key loaded from previous file " + marks_storage)
-                return answer_key[key]
-    return []
-
-def save_answer_key_to_file(output_dir, rubric, answer_key):
+def get_answer_key_hash(answer_area, rubric):
+    """Get the key that identifies the answer key of an answer area (Open CV image) and a rubric.
+    It also depends on every parameter used to extract, binarise and score the answer area"""
+    return cache.hash_key(answer_area.shape, answer_area.tobytes(), rubric.encode(),
+                          frame.MARKERS_THRESHOLDS, frame.AREA_IMAGE_WIDTH, frame.AREA_IMAGE_HEIGHT,
+                          MEDIAN_BLUR_SIZE, ADAPTIVE_THRESHOLD_BLOCK_SIZE, ADAPTIVE_THRESHOLD_C)
+
+def get_answer_keys_cache():
+    """Get the cache of answer keys"""
+    return cache.get_disk_cache(ANSWER_KEYS_DIR, ".npz", max_entries=ANSWER_KEYS_CACHE_SIZE)
+
+def load_answer_key_from_file(key):
+    """Load the answer key from a file, None if it does not exist"""
+    answer_key = get_answer_keys_cache().get(key)
+    if answer_key is not None:
+        LOGGER.info("Answer key loaded from previous file " + key)
+        return AnswerKey.from_bytes(answer_key)
+    return None
+
+def save_answer_key_to_file(key, answer_key):
     """Save the answer key to a file """
-    marks_storage = os.path.join(output_dir, "answer_key.json")
-    with open(marks_storage, 'w') as file:
-        hash_object = hashlib.sha256(rubric.encode())
-        key = hash_object.hexdigest()
-        marks_per_rubric = {}
-        marks_per_rubric[key] = answer_key
-        file.write(json.dumps(marks_per_rubric))
+    get_answer_keys_cache().put(key, answer_key.to_bytes())
+
+def get_binary_area_hash(page_image, coarse=False):
+    """Get the key that identifies the binarised answer area of a diary page (Open CV image).
+    It also depends on every parameter used to extract and binarise the answer area"""
+    coarse_parameters = (frame.COARSE_MARKER_SEARCH_MIN_SIZE, frame.MARKER_SEARCH_SIZE,
+                         frame.REFINE_MARGIN) if coarse else None
+    return cache.hash_key(page_image.shape, page_image.tobytes(), frame.MARKERS_THRESHOLDS,
+                          frame.AREA_IMAGE_WIDTH, frame.AREA_IMAGE_HEIGHT, frame.MARKERS_COLOR, coarse_parameters,
+                          MEDIAN_BLUR_SIZE, ADAPTIVE_THRESHOLD_BLOCK_SIZE, ADAPTIVE_THRESHOLD_C)
+
+def get_binary_areas_cache():
+    """Get the cache of binarised answer areas"""
+    return cache.get_disk_cache(BINARY_AREAS_DIR, ".png", max_bytes=BINARY_AREAS_CACHE_BYTES)
+
+def load_binary_area(key):
+    """Load a binarised answer area from the cache, None if it is not cached"""
+    binary_area = get_binary_areas_cache().get(key)
+    if binary_area is not None:
+        LOGGER.debug("Binarised answer area loaded from previous file " + key)
+        return cv2.imdecode(np.frombuffer(binary_area, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    return None
+
+def save_binary_area(key, binary_area):
+    """Save a binarised answer area to the cache as a bilevel png file"""
+    get_binary_areas_cache().put(key, get_bilevel_png(binary_area))
+
+def get_bilevel_png(binary_area):
+    """Get a binarised answer area as a bilevel png file (bytes)"""
+    ret, binary_area_png = cv2.imencode(".png", binary_area,
+                                        [cv2.IMWRITE_PNG_BILEVEL, 1, cv2.IMWRITE_PNG_COMPRESSION, 1])
+    return binary_area_png.tobytes()
+
+def get_template_area_hash(template_path):
+    """Get the key that identifies the answer areas of an encoding template by the content of its file.
+    It also depends on every parameter used to extract and binarise the answer area"""
+    with open(str(template_path), 'rb') as template_file:
+        template = template_file.read()
+    return cache.hash_key(template, frame.MARKERS_THRESHOLDS, frame.AREA_IMAGE_WIDTH, frame.AREA_IMAGE_HEIGHT,
+                          frame.MARKERS_COLOR, MEDIAN_BLUR_SIZE, ADAPTIVE_THRESHOLD_BLOCK_SIZE,
+                          ADAPTIVE_THRESHOLD_C)
+
+def get_template_areas_cache():
+    """Get the cache of the answer areas of encoding templates, two entries per template"""
+    return cache.get_disk_cache(TEMPLATE_AREAS_DIR, ".png", max_entries=2 * TEMPLATE_AREAS_CACHE_SIZE)
+
+def get_template_areas(template_path):
+    """Get the answer area (Open CV image) of the first page of an encoding template and the answer
+    area binarised. They are only extracted again when the content of the template file changes"""
+    return load_template_areas(get_template_area_hash(template_path), str(template_path))
+
+@lru_cache(maxsize=TEMPLATE_AREAS_MEMORY_SIZE)
+def load_template_areas(key, template_path):
+    """Load the answer areas of the encoding template key from the cache, they are extracted from
+    template_path and cached if they are not. The images are shared, they are read-only"""
+    template_areas_cache = get_template_areas_cache()
+    answer_area = template_areas_cache.get(key + "_area")
+    binary_area = template_areas_cache.get(key + "_binary")
+    if answer_area is not None and binary_area is not None:
+        LOGGER.info("Template answer area loaded from previous file " + key)
+        answer_area = cv2.imdecode(np.frombuffer(answer_area, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        binary_area = cv2.imdecode(np.frombuffer(binary_area, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    else:
+        answer_area = next(frame.extract_answer_areas(template_path, page_limit=1))
+        binary_area = binarize_answer_area(answer_area)
+        ret, answer_area_png = cv2.imencode(".png", answer_area, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        template_areas_cache.put(key + "_area", answer_area_png.tobytes())
+        template_areas_cache.put(key + "_binary", get_bilevel_png(binary_area))
+    answer_area.setflags(write=False)
+    binary_area.setflags(write=False)
+    return answer_area, binary_area
+
+def binarize_answer_area(answer_area):
+    """Clean an answer area (Open CV image) using an adaptative threshold"""
+
+    with metrics.measure("binarize", pages=1):
+        return binarize(answer_area)
+
+def binarize(image):
+    """Clean an Open CV image (an answer area or a region of it) using an adaptative threshold"""
+    # Conver to a gray scale image
+    imgray = frame.get_gray_image(image)
+    # Apply a blur filter
+    cleaned_image = cv2.medianBlur(imgray, MEDIAN_BLUR_SIZE)
+    # Apply the adaptative threshold gaussian correction
+    return cv2.adaptiveThreshold(cleaned_image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
+                                 ADAPTIVE_THRESHOLD_BLOCK_SIZE, ADAPTIVE_THRESHOLD_C)
 
+@metrics.timed("clean_image", pages=1)
 def clean_image(img_path):
     """Clean a tif image using an adaptative threshold"""
 
     image = Image.open(img_path)
-    cleaned_image = np.asarray(image)
-    image.close()    
-    
-    r, g, b = cv2.split(cleaned_image)
-    cleaned_image = cv2.merge([b, g, r])
+    if image.mode in ("1", "L"):
+        cleaned_image = np.asarray(image.convert("L"))
+    else:
+        cleaned_image = cv2.cvtColor(np.asarray(image.convert("RGB")), cv2.COLOR_RGB2GRAY)
+    image.close()
+
+    cleaned_image = binarize_answer_area(cleaned_image)
 
-    # Conver to a gray scale image
-    imgray = cv2.cvtColor(cleaned_image, cv2.COLOR_BGR2GRAY)
-    # Apply a blur filter
-    cleaned_image = cv2.medianBlur(imgray, 5)
-    # Apply the adaptative threshold gaussian correction
-    cleaned_image = cv2.adaptiveThreshold(cleaned_image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-                                        cv2.THRESH_BINARY, 51, 22)
     # Save the processed np array to an new file and load it again as an image
     clean_image_path = img_path.replace(".tif", "_a.tif")
     # clean_image_path = img_path
@@ -131,100 +235,155 @@ def create_answer_spaces_output_dir(answer_area_path):
     return page_output_path
 
 def get_answer_headers(answer_key):
-    headers = {}
-    for answer in answer_key:
-        headers[answer["variable"]] = True
-    return sorted(list(headers.keys()))
+    """Get the variables of an answer key sorted by name"""
+    return list(answer_key.variables)
 
-def get_answer_key(answer_area_path, rubric):
+@metrics.timed("get_answer_key", pages=1, level=logging.INFO)
+def get_answer_key(answer_area_path, rubric, answer_area=None, binary_area=None):
     """Create the answer key to encode a diary based on a blank diary page and a rubirc
 
     Keyword arguments:
     answer_area_path -- the path to an image that contains the answers to be encoded
     rubric -- CSV with the encoding values of all answer spaces (entryID,variable,value,x,y,radius)
+    answer_area -- the answer area as an Open CV image, if given answer_area_path is not read
+    binary_area -- the answer area binarised, if given it is not binarised again
     """
-    answer_spaces_output_path = create_answer_spaces_output_dir(answer_area_path)
+    if answer_area is None:
+        answer_area = cv2.imread(str(answer_area_path), cv2.IMREAD_ANYCOLOR)
 
-    # If the answer_key already existis, use it
-    answer_key = load_answer_key_from_file(answer_spaces_output_path, rubric)
-    if answer_key != []:
+    # If the answer_key already existis for this answer area and rubric, use it
+    key = get_answer_key_hash(answer_area, rubric)
+    answer_key = load_answer_key_from_file(key)
+    if answer_key is not None:
         return answer_key
 
+    if binary_area is None:
+        binary_area = binarize_answer_area(answer_area)
+    answer_key = create_answer_key(binary_area, rubric)
+
+    # Save the answer key to a file to reuse it later
+    save_answer_key_to_file(key, answer_key)
+
+    return answer_key
+
+def load_binary_answer_area(answer_area_path):
+    """Clean the answer area saved in answer_area_path and load it as a np array"""
     answer_area = Image.open(clean_image(answer_area_path))
+    binary_area = np.asarray(answer_area)
+    answer_area.close()
+    return binary_area
+
+@metrics.timed("count_black_pixels", pages=1)
+def count_black_pixels(binary_area, x_coords, y_coords, radii):
+    """Count the black pixels of all the answer spaces of a binarised answer area in one pass
+
+    Each answer space is the square of side 2*radius centred in (x, y). The box is rounded like
+    PIL's Image.crop and the pixels that fall outside of binary_area count as black, so the result
+    is the same as cropping each answer space and counting its black pixels one by one.
+    """
+    return count_black_pixels_in_boxes(binary_area, *get_answer_spaces_boxes(x_coords, y_coords, radii))
+
+def get_answer_spaces_boxes(x_coords, y_coords, radii):
+    """Get the (left, top, right, bottom) pixel boxes of the answer spaces, rounded like PIL's Image.crop"""
+    x_coords = np.asarray(x_coords, dtype=np.float64)
+    y_coords = np.asarray(y_coords, dtype=np.float64)
+    radii = np.asarray(radii, dtype=np.float64)
+
+    left = np.round(x_coords - radii).astype(np.intp)
+    top = np.round(y_coords - radii).astype(np.intp)
+    right = np.maximum(np.round(x_coords + radii).astype(np.intp), left)
+    bottom = np.maximum(np.round(y_coords + radii).astype(np.intp), top)
+    return left, top, right, bottom
+
+def count_black_pixels_in_boxes(binary_area, left, top, right, bottom):
+    """Count the black pixels of each box of a binarised image, the pixels of a box that fall outside
+    of binary_area count as black"""
+    height, width = binary_area.shape[:2]
+
+    # Summed-area table of the black pixels, integral[y, x] is the count of black pixels above
+    # and to the left of (x, y)
+    integral = cv2.integral((binary_area == 0).astype(np.uint8))
+
+    inner_left = np.clip(left, 0, width)
+    inner_right = np.clip(right, 0, width)
+    inner_top = np.clip(top, 0, height)
+    inner_bottom = np.clip(bottom, 0, height)
+    black_inside = (integral[inner_bottom, inner_right] - integral[inner_top, inner_right] -
+                    integral[inner_bottom, inner_left] + integral[inner_top, inner_left])
+    pixels_outside = ((right - left) * (bottom - top) -
+                      (inner_right - inner_left) * (inner_bottom - inner_top))
+    return black_inside + pixels_outside
+
+@metrics.timed("count_black_pixels_sparse", pages=1)
+def count_black_pixels_sparse(page_image, transform, answer_key):
+    """Count the black pixels of all the answer spaces of the answer area of a page (Open CV image)
+    without extracting the whole answer area. The region around each answer space (SPARSE_MARGIN pixels)
+    is warped through transform, the perspective transform from the page to its answer area, and
+    binarised on its own"""
+    left, top, right, bottom = get_answer_spaces_boxes(answer_key.x_coords, answer_key.y_coords, answer_key.radii)
+    black = np.empty(len(answer_key), dtype=np.int64)
+    for index in range(len(answer_key)):
+        # The regions are cropped to the answer area, its borders are binarised as in the whole area
+        region_left = min(max(left[index] - SPARSE_MARGIN, 0), frame.AREA_IMAGE_WIDTH)
+        region_top = min(max(top[index] - SPARSE_MARGIN, 0), frame.AREA_IMAGE_HEIGHT)
+        region_right = max(min(right[index] + SPARSE_MARGIN, frame.AREA_IMAGE_WIDTH), region_left)
+        region_bottom = max(min(bottom[index] + SPARSE_MARGIN, frame.AREA_IMAGE_HEIGHT), region_top)
+        if region_left == region_right or region_top == region_bottom:
+            # The answer space is outside of the answer area, all its pixels count as black
+            black[index] = (right[index] - left[index]) * (bottom[index] - top[index])
+            continue
+
+        region = frame.warp_answer_area_region(page_image, transform, region_left, region_top,
+                                               region_right, region_bottom)
+        black[index] = count_black_pixels_in_boxes(binarize(region),
+                                                   left[index:index + 1] - region_left,
+                                                   top[index:index + 1] - region_top,
+                                                   right[index:index + 1] - region_left,
+                                                   bottom[index:index + 1] - region_top)[0]
+    return black
+
+def create_answer_key(binary_area, rubric):
+    """Create the answer key of a binarised blank answer area (np array) based on a rubric"""
 
     # Calculate the factor scale, due the rubric being created at a resolution of 920x570
     base_height = 920
     base_width = 570
-    height_scale = (float(answer_area.size[1])/base_height)
-    width_scale = (float(answer_area.size[0])/base_width)
-
-    for answer_space in rubric.split("\n"):
-        # Parse the rubric
-        answer_space = answer_space.split(",")
-        radius = float(answer_space[5]) * height_scale
-        x = (float(answer_space[3])) * width_scale
-        y = (float(answer_space[4])) * height_scale
-        answer_space_pixels = answer_area.crop((x - radius, y - radius, x + radius, y + radius))
-
-        # Count the number of black pixels in the answer space
-        black_pixels = 0
-        for pixel in answer_space_pixels.getdata():
-            if pixel == 0:
-                black_pixels += 1
-
-        # Save the answer_space image for debuggin purposes
-        # answer_space_pixels.save(answer_spaces_output_path + \
-        #                         "/img{0}-{1}-{2}.png".format(answer_space[0],
-        #                                                      answer_space[1], answer_space[2]))
-
-        # Save the created answer space to the answer key
-        answer_key.append(create_answer_space(x, y, radius, answer_space[0], answer_space[1],
-                                              answer_space[2], black_pixels))
+    height_scale = (float(binary_area.shape[0])/base_height)
+    width_scale = (float(binary_area.shape[1])/base_width)
 
-    answer_area.close()
-    # Save the answer key to a file to reuse it later
-    save_answer_key_to_file(answer_spaces_output_path, rubric, answer_key)
+    # Parse the rubric
+    answer_spaces = [answer_space.split(",") for answer_space in rubric.split("\n")]
+    radii = [float(answer_space[5]) * height_scale for answer_space in answer_spaces]
+    x_coords = [(float(answer_space[3])) * width_scale for answer_space in answer_spaces]
+    y_coords = [(float(answer_space[4])) * height_scale for answer_space in answer_spaces]
 
-    return answer_key
+    # Count the number of black pixels in every answer space
+    black_pixels = count_black_pixels(binary_area, x_coords, y_coords, radii)
 
+    # Save the (entry, variable, value) of the answer spaces to the answer key
+    return AnswerKey.from_answer_spaces([tuple(answer_space[:3]) for answer_space in answer_spaces],
+                                        x_coords, y_coords, radii, black_pixels)
+
+@metrics.timed("mark_answer_area", pages=1)
 def mark_answer_area(answer_area_path, answer_key, date):
     """Encode an answer_area based on an answer_key"""
+    return mark_binary_answer_area(load_binary_answer_area(answer_area_path), answer_key, date)
 
-    encoded_answers = {}
-    answer_area = Image.open(clean_image(answer_area_path))
+def mark_binary_answer_area(binary_area, answer_key, date):
+    """Encode a binarised answer area (np array) based on an answer_key"""
 
-    for answer in answer_key:
-        answer_space = answer_area.crop((answer["x"] - answer["radius"],
-                                         answer["y"] - answer["radius"],
-                                         answer["x"] + answer["radius"],
-                                         answer["y"] + answer["radius"]))
-
-        # Count the number of pixels in the answer space
-        black = 0
-        for pixel in answer_space.getdata():
-            if pixel == 0: #Pixel is either 0 or 255
-                black += 1
-
-        # If the number of black pixels is bigger than the template count times MARK_BLACK_THRESHOLD
-        # count this answer as positive
-        if black > (answer["black_pixels"] * MARK_BLACK_THRESHOLD):
-            answer_key = "{}#{}".format(date.strftime("%Y-%m-%d"), answer["entry"])
-            if answer_key not in encoded_answers:
-                encoded_answers[answer_key] = {answer["variable"]: answer["value"]}
-            else:
-                if answer["variable"] not in encoded_answers[answer_key]:
-                    encoded_answers[answer_key].update({answer["variable"]: answer["value"]})
-                else:
-                    encoded_answers[answer_key].update({answer["variable"]: "DUPLICATED"})
-
-        # Save the answer_space image for debuggin purposes
-        # answer_spaces_output_path = create_answer_spaces_output_dir(answer_area_path)
-        # answer_space.save(answer_spaces_output_path + \
-        #                "/img-{0}-{1}-{2}.png".format(answer["entry"],
-        #                                              answer["variable"],
-        #                                              answer["value"]))
-    answer_area.close()
-    return encoded_answers
+    # Count the number of pixels in every answer space
+    black = count_black_pixels(binary_area, answer_key.x_coords, answer_key.y_coords, answer_key.radii)
+    return encode_answers(black, answer_key, date)
+
+def encode_answers(black, answer_key, date):
+    """Encode the answers of a page from the black pixels counted in each answer space of answer_key.
+    Returns the date of the page, the codes of its answered entries and the matrix of their answers"""
+
+    # If the number of black pixels is bigger than the template count times MARK_BLACK_THRESHOLD
+    # count this answer as positive
+    entries, answers = answer_key.mark(black, MARK_BLACK_THRESHOLD)
+    return {"date": date.strftime("%Y-%m-%d"), "entries": entries, "answers": answers}
 
 def get_files_in_directory(directory_path, extension):
     """Get all files in a directory with extension"""
@@ -232,59 +391,332 @@ def get_files_in_directory(directory_path, extension):
     files = natsorted(files, alg=ns.PATH) 
     return files
 
-def save_diary_answers(file_name, diary_answers, headers):
-    """Saves diary_answers to a CSV file_name"""
+def get_encoded_diary_path(file_name):
+    """Get the path of the CSV file with the answers of the diary file_name"""
+    return ENCODED_DIARIES_DIR / Path(file_name + ".csv")
+
+def get_encoding_key(diary_path, answer_key, date, sparse, coarse=False):
+    """Get the key that identifies the encoding of a diary file (by its size and modification time)
+    with an answer key, starting date and modes. A partial encoding is only resumed with the same key"""
+    diary_stat = os.stat(str(diary_path))
+    return cache.hash_key(str(diary_path), diary_stat.st_size, diary_stat.st_mtime_ns, answer_key.to_bytes(),
+                          date.isoformat(), sparse, coarse)
+
+
+def lock_exclusively(lock_file):
+    """Lock an open file for this file object only, raises OSError if it is already locked (by any
+    process or thread). The lock is released when the file is closed or its process ends"""
+    if os.name == "nt":
+        import msvcrt
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+class DiaryWriter(object):
+    """Writes the answers of a diary to its CSV file page by page, as the pages are encoded.
+
+    The rows are written to a partial file next to the CSV file, which replaces the CSV file once all
+    the pages are written, so the CSV file is always a complete encoding. The partial file is flushed
+    after each page and a progress file records the pages written and the size of the partial file
+    with them. If the encoding fails, encoding the diary again with the same key resumes it after the
+    last page written. A lock file makes sure only one encoding writes the answers of a diary at a time,
+    another one fails straight away. The progress and lock files are kept in ENCODING_STATE_DIR, named
+    after the path of the CSV file. The lock file is not removed, another encoding could be waiting
+    to open it
+    """
+    def __init__(self, encoded_diary_path, answer_key, key=None, resume=True):
+        self.path = Path(encoded_diary_path)
+        self.partial_path = Path(str(self.path) + ".partial")
+        state_name = cache.hash_key(os.path.abspath(str(self.path)))
+        self.progress_path = Path(ENCODING_STATE_DIR) / (state_name + ".progress")
+        self.answer_key = answer_key
+        self.key = key
+
+        os.makedirs(str(self.path.parent), exist_ok=True)
+        os.makedirs(str(ENCODING_STATE_DIR), exist_ok=True)
+        self.lock_file = open(str(Path(ENCODING_STATE_DIR) / (state_name + ".lock")), 'a')
+        try:
+            lock_exclusively(self.lock_file)
+        except OSError:
+            self.lock_file.close()
+            raise RuntimeError("The answers of {} are already being written by another encoding".format(self.path.stem))
+
+        try:
+            self.pages, size = self.load_progress() if resume and key is not None else (0, 0)
+            if self.pages > 0:
+                LOGGER.info("Resuming the encoding of {} after page {}".format(self.path, self.pages))
+                # Discard the rows written after the last page recorded
+                os.truncate(str(self.partial_path), size)
+                self.file = open(str(self.partial_path), 'a', newline='')
+                self.writer = csv.writer(self.file, quoting=csv.QUOTE_MINIMAL)
+            else:
+                self.file = open(str(self.partial_path), 'w', newline='')
+                self.writer = csv.writer(self.file, quoting=csv.QUOTE_MINIMAL)
+                self.writer.writerow(["date", "entry"] + get_answer_headers(answer_key))
+        except BaseException:
+            self.lock_file.close()
+            raise
+
+    def load_progress(self):
+        """Get the pages written and the size of the partial file with them by a previous encoding with
+        the same key, (0, 0) if there is not any"""
+        try:
+            with open(str(self.progress_path), 'r') as progress_file:
+                progress = json.load(progress_file)
+            if progress["key"] == self.key and self.partial_path.stat().st_size >= progress["size"]:
+                return progress["pages"], progress["size"]
+        except (OSError, ValueError, KeyError):
+            pass
+        return 0, 0
+
+    def write_page(self, page_answers):
+        """Write the rows of the answers of a page (the result of encode_answers) and record them"""
+        for row in self.answer_key.get_rows(page_answers["date"], page_answers["entries"], page_answers["answers"]):
+            self.writer.writerow(row)
+        self.file.flush()
+        self.pages += 1
+        if self.key is not None:
+            progress = {"key": self.key, "pages": self.pages, "size": os.fstat(self.file.fileno()).st_size}
+            cache.atomic_write(self.progress_path, json.dumps(progress).encode())
+
+    def write_pages(self, pages_answers):
+        """Write the answers of each page as they are encoded, returns the number of pages written"""
+        pages = 0
+        for page_answers in pages_answers:
+            self.write_page(page_answers)
+            pages += 1
+        return pages
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.file.close()
+            if exc_type is None:
+                os.replace(str(self.partial_path), str(self.path))
+                if self.progress_path.exists():
+                    os.remove(str(self.progress_path))
+        finally:
+            self.lock_file.close()
+
+
+@metrics.timed("encode_page", pages=1)
+def encode_page(page_image, answer_key, date, sparse=False, coarse=False):
+    """Extract, binarise and encode the answer area of a diary page (Open CV image). In sparse mode
+    only the regions around the answer spaces are extracted and binarised, in coarse mode the corner
+    markers of high-DPI pages are searched on a downscaled copy.
+    The binarised answer areas are cached by the content of the page, a page encoded before (e.g.
+    with another rubric) is only marked. Sparse mode uses the cached areas but does not cache any"""
+    # The key is computed before the corner markers are drawn on the page
+    key = get_binary_area_hash(page_image, coarse)
+    binary_area = load_binary_area(key)
+    if binary_area is not None:
+        return mark_binary_answer_area(binary_area, answer_key, date)
+
+    if sparse:
+        transform = frame.get_answer_area_transform(page_image, coarse=coarse)
+        return encode_answers(count_black_pixels_sparse(page_image, transform, answer_key), answer_key, date)
+    binary_area = binarize_answer_area(frame.get_answer_area(page_image, coarse=coarse))
+    save_binary_area(key, binary_area)
+    return mark_binary_answer_area(binary_area, answer_key, date)
+
+def get_template_answer_key(template_path, rubric, debug=DEBUG):
+    """Get the answer key of the first tif or png file in template_path (it should not have any pen marks)"""
+    templates = get_files_in_directory(template_path, ".tif") + get_files_in_directory(template_path, ".png")
+    encoding_template = templates[0]
 
-    encoded_diary_path = ENCODED_DIARIES_DIR / Path(file_name + ".csv")
-    with open(encoded_diary_path, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(["date","entry"] + headers)
-        for page_id, answers_entries in diary_answers.items():
-            for date_entry, answers in answers_entries.items():
-                row = date_entry.split("#") + [answers.get(variable, None) for variable in headers]
+    if debug:
+        # Get the answer area framed by the L-shaped markers of the encoding template
+        answer_area_template = frame.extract_answer_area_from_page(encoding_template, EXTRACTED_PAGES_DIR, EXTRACTED_AREAS_DIR)[0]
+
+        # Get the answer key to encode a diary (image coordinates with a black-pixels threshold)
+        return get_answer_key(answer_area_template, rubric)
+
+    answer_area_template, binary_area_template = get_template_areas(encoding_template)
+    return get_answer_key(frame.get_answer_area_path(encoding_template, EXTRACTED_AREAS_DIR, 0),
+                          rubric, answer_area_template, binary_area_template)
 
-                # If there is a missing value, make it explicit
-                row = ['MISSING' if value is None else value for value in row]
-                writer.writerow(row)
-    return encoded_diary_path
+def encode_diary_pages(diary_path, answer_key, date, workers=1, progress=None, sparse=False, resume=True,
+                       coarse=False):
+    """Encode in memory the pages of diary_path and write their answers to its CSV file as they are
+    encoded. Pages are decoded one at a time, only the pages being encoded are kept in memory.
+    Returns the path of the CSV file and the number of pages encoded.
 
-def encode_diary(diary_path, template_path,  rubric, starting_date):
+    Keyword arguments:
+    workers -- number of processes that encode the pages in parallel (None to use every CPU)
+    progress -- function called with (pages_done, pages_total) after each page is encoded
+    sparse -- only extract and binarise the regions of the pages around the answer spaces
+    resume -- skip the pages written by a previous encoding of the diary that did not finish
+    coarse -- search the corner markers of high-DPI pages on a downscaled copy
+    """
+    encoded_diary_path = get_encoded_diary_path(Path(diary_path).stem)
+    key = get_encoding_key(diary_path, answer_key, date, sparse, coarse)
+    with DiaryWriter(encoded_diary_path, answer_key, key, resume) as writer:
+        first_page = writer.pages
+        pages = frame.iter_pages(diary_path, first_page)
+        dates = islice(get_pages_dates(date), first_page, None)
+        if workers == 1:
+            pages_answers = map(encode_page, pages, repeat(answer_key), dates, repeat(sparse), repeat(coarse))
+            pages_encoded = writer.write_pages(report_progress(pages_answers, diary_path, progress, first_page))
+            return encoded_diary_path, pages_encoded
+
+        # The results are returned in the same order as the pages
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # The stages measured in the worker processes are added to the metrics of this process
+            pages_answers = map_in_order(executor, metrics.collect, repeat(encode_page), pages,
+                                         repeat(answer_key), dates, repeat(sparse), repeat(coarse),
+                                         prefetch=2 * (workers or os.cpu_count()))
+            pages_answers = metrics.merge_collected(pages_answers)
+            pages_encoded = writer.write_pages(report_progress(pages_answers, diary_path, progress, first_page))
+            return encoded_diary_path, pages_encoded
+
+def report_progress(pages_answers, diary_path, progress, pages_skipped=0):
+    """Call progress with (pages_done, pages_total) as the pages of diary_path are encoded, the first
+    pages_skipped pages count as done"""
+    if progress is None:
+        return pages_answers
+
+    def reporting_progress():
+        pages_total = frame.count_pages(diary_path)
+        progress(pages_skipped, pages_total)
+        for pages_done, page_answers in enumerate(pages_answers, start=pages_skipped + 1):
+            progress(pages_done, pages_total)
+            yield page_answers
+    return reporting_progress()
+
+def map_in_order(executor, function, *iterables, prefetch):
+    """Like executor.map but the iterables are consumed lazily, at most prefetch calls are
+    submitted and not yet returned at any time"""
+    pending = deque()
+    for arguments in zip(*iterables):
+        if len(pending) >= prefetch:
+            yield pending.popleft().result()
+        pending.append(executor.submit(function, *arguments))
+    while pending:
+        yield pending.popleft().result()
+
+def encode_diary(diary_path, template_path,  rubric, starting_date, debug=DEBUG, workers=1, progress=None,
+                 sparse=False, resume=True, coarse=False):
     """Encodes a diary_path based on a rubric (from the web interface)
 
     Keyword arguments:
     diary_path -- the path to a multi-page tiff file (the scanned diary)
     rubric -- CSV with the encoding values of all answer spaces (entryID,variable,value,x,y,radius)
     starting_date -- each page of the encoded diary will be asigned a date starting from this value
+    debug -- save the pages and answer areas of the diary to disk at every step of the encoding,
+             otherwise they are processed in memory
+    workers -- number of processes that encode the pages in parallel (None to use every CPU),
+               ignored in debug mode
+    progress -- function called with (pages_done, pages_total) after each page is encoded
+    sparse -- only extract and binarise the regions of the pages around the answer spaces, faster
+              but the black pixels can differ slightly from the ones of the whole answer areas,
+              ignored in debug mode
+    resume -- if a previous encoding of the diary (with the same template, rubric, date and mode)
+              did not finish, only encode the pages it did not write, ignored in debug mode
+    coarse -- search the corner markers of high-DPI pages (600 DPI scans) on a downscaled copy, faster
+              but the answer areas can move a pixel or two, ignored in debug mode
     """
-    # Get the first tif or png file in template_path (it should not have any pen marks)
-    templates = get_files_in_directory(template_path, ".tif") + get_files_in_directory(template_path, ".png")
-    encoding_template = templates[0]
-
     diary_path = Path(diary_path)
     LOGGER.info("Encoding {}".format(diary_path))
-    
+    date = valid_date(starting_date)
+
+    with metrics.measure("encode_diary", level=logging.INFO) as measurement:
+        answer_key = get_template_answer_key(template_path, rubric, debug)
+
+        if debug:
+            # Get the answer areas from each page of the diary to encode
+            answer_areas_all_pages = frame.extract_answer_area_from_page(diary_path, EXTRACTED_PAGES_DIR, EXTRACTED_AREAS_DIR)
+            dates = get_pages_dates(date)
+            pages_answers = map(mark_answer_area, answer_areas_all_pages, repeat(answer_key), dates)
+            diary_answers_file = get_encoded_diary_path(diary_path.stem)
+            with DiaryWriter(diary_answers_file, answer_key) as writer:
+                measurement["pages"] = writer.write_pages(report_progress(pages_answers, diary_path, progress))
+        else:
+            diary_answers_file, measurement["pages"] = encode_diary_pages(diary_path, answer_key, date, workers,
+                                                                          progress, sparse, resume, coarse)
+    return diary_answers_file
+
+def get_diaries_paths(diaries):
+    """Get the paths of the diaries to encode from a directory, a glob pattern or a list of paths"""
+    if isinstance(diaries, (str, Path)):
+        if os.path.isdir(str(diaries)):
+            return get_files_in_directory(diaries, ".tif") + get_files_in_directory(diaries, ".zip")
+        return natsorted(glob.glob(str(diaries), recursive=True), alg=ns.PATH)
+    return [str(diary) for diary in diaries]
+
+def encode_diaries(diaries, template_path, rubric, starting_date, workers=None, combined_name="encoded_diaries",
+                   sparse=False, progress=None, coarse=False):
+    """Encodes a batch of diaries based on the same template and rubric
+
+    The answer key is created once and the diaries are encoded concurrently, one per process.
+    Each diary is saved to its own CSV file and all of them to a combined CSV file with an extra
+    diary column. Diaries that cannot be encoded are logged and left out of the combined file,
+    encoding them again resumes them after their last page written.
+    Returns the path of the combined CSV file and a list with the result of each diary (in the same
+    order as the diaries), a dict with its diary, answers (the path of its CSV file), pages and error
+    (None unless it failed)
 
-    # Get the answer area framed by the L-shaped markers of the encoding template
-    answer_area_template = frame.extract_answer_area_from_page(encoding_template, EXTRACTED_PAGES_DIR, EXTRACTED_AREAS_DIR)[0]
-    
-    # Get the answer key to encode a diary (image coordinates with a black-pixels threshold)
-    answer_key = get_answer_key(answer_area_template, rubric)
+    Keyword arguments:
+    diaries -- a directory, a glob pattern or a list with the paths of the diaries to encode
+    workers -- number of diaries encoded in parallel (None to use every CPU)
+    combined_name -- name of the combined CSV file
+    sparse -- only extract and binarise the regions of the pages around the answer spaces
+    progress -- function called with (diaries_done, diaries_total) after each diary is encoded
+    coarse -- search the corner markers of high-DPI pages on a downscaled copy
+    """
+    diaries_paths = get_diaries_paths(diaries)
+    if not diaries_paths:
+        raise ValueError("There are no diaries to encode in {}".format(diaries))
+
+    answer_key = get_template_answer_key(template_path, rubric)
     file_headers = get_answer_headers(answer_key)
-    
-    # Get the answer areas from each page of the diary to encode
-    answer_areas_all_pages = frame.extract_answer_area_from_page(diary_path, EXTRACTED_PAGES_DIR, EXTRACTED_AREAS_DIR)
-    
-    page_id = 1
-    diary_answers = {}
     date = valid_date(starting_date)
-    
-    for answer_area in answer_areas_all_pages:
-        diary_answers[str(page_id)] = mark_answer_area(answer_area, answer_key, date)
-        page_id += 1
-        date += datetime.timedelta(days=1)
 
-    diary_answers_file = save_diary_answers(diary_path.stem, diary_answers, file_headers)
-    return diary_answers_file
+    results = []
+    combined_diaries_path = ENCODED_DIARIES_DIR / Path(combined_name + ".csv")
+    with ProcessPoolExecutor(max_workers=workers) as executor, \
+         open(combined_diaries_path, 'w', newline='') as csvfile:
+        futures = [executor.submit(metrics.collect, encode_diary_pages, diary_path, answer_key, date,
+                                   1, None, sparse, True, coarse)
+                   for diary_path in diaries_paths]
+
+        writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(["diary", "date", "entry"] + file_headers)
+        if progress is not None:
+            progress(0, len(diaries_paths))
+        for diaries_done, (diary_path, future) in enumerate(zip(diaries_paths, futures), start=1):
+            diary_name = Path(diary_path).stem
+            result = {"diary": str(diary_path), "answers": None, "pages": None, "error": None}
+            results.append(result)
+            try:
+                (encoded_diary_path, pages_encoded), diary_metrics = future.result()
+                metrics.merge(diary_metrics)
+                result.update({"answers": str(encoded_diary_path), "pages": pages_encoded})
+            except Exception as error:
+                LOGGER.error("Error encoding {}".format(diary_path), exc_info=True)
+                result["error"] = str(error)
+                continue
+            finally:
+                if progress is not None:
+                    progress(diaries_done, len(diaries_paths))
+
+            # Copy the rows of the diary (written by its worker) to the combined file
+            with open(str(encoded_diary_path), 'r', newline='') as encoded_diary_file:
+                rows = csv.reader(encoded_diary_file)
+                next(rows)
+                for row in rows:
+                    writer.writerow([diary_name] + row)
+            LOGGER.info("Document encoded {}".format(diary_name))
+
+    return combined_diaries_path, results
+
+def get_pages_dates(starting_date):
+    """Yield the date assigned to each one of the pages of a diary"""
+    for page in count():
+        yield starting_date + datetime.timedelta(days=page)
 
 def valid_date(string_date):
     """Get a valid date from a string in format DD/MM/YYY"""
@@ -6,6 +6,7 @@ import zipfile
 from pathlib import Path
 from natsort import natsorted, ns
 from PIL import Image, ImageOps, ImageDraw
+import paperstream.metrics as metrics
 import logging
 from logging.config import fileConfig
 
@@ -27,11 +28,29 @@ AREA_IMAGE_WIDTH = 2048
 # Separation between horizontal L-shaped corner marks is 340, between vertical ones is 548
 AREA_IMAGE_HEIGHT = math.ceil(AREA_IMAGE_WIDTH * (548/340.0))
 
+# Color (BGR) of the corner markers drawn on the pages, they are drawn on grayscale pages with its gray level
+MARKERS_COLOR = (0, 255, 0)
+MARKERS_GRAY_LEVEL = int(cv2.cvtColor(np.uint8([[MARKERS_COLOR]]), cv2.COLOR_BGR2GRAY)[0, 0])
+
+# In coarse mode, high-DPI pages (longer side of COARSE_MARKER_SEARCH_MIN_SIZE pixels or more) look for
+# their corner markers on a copy with a longer side of MARKER_SEARCH_SIZE pixels (an A5 page at 150
+# DPI), then refine each marker in a window of the full resolution page with REFINE_MARGIN pixels
+# around it. It is faster but the answer area can move a pixel or two, so it is opt-in
+COARSE_MARKER_SEARCH_MIN_SIZE = 3000
+MARKER_SEARCH_SIZE = 1240
+REFINE_MARGIN = 16
+
 
 
 def normalize(im):
     return cv2.normalize(im, np.zeros(im.shape), 0, 255, norm_type=cv2.NORM_MINMAX)
 
+def get_gray_image(image):
+    """Get an Open CV image (BGR or grayscale) in grayscale, grayscale images are returned as they are"""
+    if image.ndim == 2:
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
 def get_approx_contour(contour, tol=.01):
     """Get rid of 'useless' points in the contour"""
     epsilon = tol * cv2.arcLength(contour, True)
@@ -65,6 +84,103 @@ def get_corners(contours):
         contours,
         key=lambda c: features_distance(MARKERS_THRESHOLDS, get_features(c)))[:4]
 
+def get_scaled_features(contour, scale=1):
+    """Get the features of a contour of an image scaled by scale as if it were at full resolution"""
+    area, perimeter, bounding_rect_area = get_features(contour)
+    return (area / scale ** 2, perimeter / scale, bounding_rect_area / scale ** 2)
+
+def get_features_lower_bounds(contours, scale=1, reference=MARKERS_THRESHOLDS):
+    """Get a lower bound of the distance between the features of each contour (once approximated) and
+    the reference features. It is computed for all the contours at once from their bounding boxes: the
+    approximated contour is inside the bounding box, so its area is at most the area of the box and
+    the area of its (integer) bounding rectangle is at most the area of the box grown by a pixel"""
+    lengths = np.fromiter(map(len, contours), dtype=np.intp, count=len(contours))
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    points = np.concatenate(contours).reshape(-1, 2).astype(np.int64)
+    widths = np.maximum.reduceat(points[:, 0], starts) - np.minimum.reduceat(points[:, 0], starts) + 1
+    heights = np.maximum.reduceat(points[:, 1], starts) - np.minimum.reduceat(points[:, 1], starts) + 1
+
+    area_distance = np.maximum(reference[0] - widths * heights / scale ** 2, 0)
+    bounding_rect_distance = np.maximum(reference[2] - (widths + 2) * (heights + 2) / scale ** 2, 0)
+    return np.sqrt(area_distance.astype(np.float64) ** 2 + bounding_rect_distance.astype(np.float64) ** 2)
+
+def find_corners(image_gray, markers=4, scale=1, reference=MARKERS_THRESHOLDS):
+    """Get the four corner markers of image_gray, the same ones as get_corners(get_contours(image_gray))
+    but only the contours that could be among the four closest to MARKERS_THRESHOLDS are approximated
+    and have their features computed (noise and small marks are discarded by their bounding box)
+
+    Keyword arguments:
+    markers -- number of markers to find
+    scale -- scale of image_gray relative to the scanned page, the features are compared at full resolution
+    reference -- features of the markers, by default MARKERS_THRESHOLDS
+    """
+    im2, contours, hierarchy = cv2.findContours(
+        image_gray, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    if len(contours) == 0:
+        return []
+
+    lower_bounds = get_features_lower_bounds(contours, scale, reference)
+    # (distance, index, approximated contour) of the closest contours so far, ties are broken by the
+    # order of the contours as the stable sort of get_corners does
+    closest = []
+    for index in np.argsort(lower_bounds, kind="stable"):
+        if len(closest) == markers and lower_bounds[index] > closest[-1][0]:
+            break
+        contour = get_approx_contour(contours[index])
+        closest.append((features_distance(reference, get_scaled_features(contour, scale)), index, contour))
+        closest = sorted(closest, key=lambda candidate: candidate[:2])[:markers]
+    return [contour for distance, index, contour in closest]
+
+def get_marker_search_scale(image):
+    """Get the scale of the copy of a page where its corner markers are searched, 1 (the page itself)
+    unless it is a high-DPI scan"""
+    longer_side = max(image.shape[:2])
+    if longer_side < COARSE_MARKER_SEARCH_MIN_SIZE:
+        return 1
+    return MARKER_SEARCH_SIZE / float(longer_side)
+
+def threshold_page(blurred_image, value_range=None):
+    """Normalise and threshold a blurred grayscale page (or a region of it) to find its corner markers.
+    value_range is the (min, max) used to normalise it, by default the ones of blurred_image"""
+    if value_range is None:
+        normalised_image = normalize(blurred_image)
+    else:
+        minimum, maximum = value_range
+        normalised_image = np.rint((blurred_image.astype(np.float32) - minimum) * (255.0 / max(maximum - minimum, 1)))
+        normalised_image = np.clip(normalised_image, 0, 255).astype(np.uint8)
+    ret, binary_image = cv2.threshold(normalised_image, 127, 255, cv2.THRESH_BINARY)
+    return binary_image
+
+def refine_corner(original_image, coarse_corner, scale, value_range):
+    """Find at full resolution a corner marker found in a copy of original_image scaled by scale. Only
+    the window around the marker is binarised (as the whole page would be) and the marker is the
+    contour of the window most similar to the one found in the copy"""
+    x, y, width, height = cv2.boundingRect(coarse_corner)
+    margin = int(math.ceil(1 / scale)) + REFINE_MARGIN
+    left, top = max(int(x / scale) - margin, 0), max(int(y / scale) - margin, 0)
+    right = min(int(math.ceil((x + width) / scale)) + margin, original_image.shape[1])
+    bottom = min(int(math.ceil((y + height) / scale)) + margin, original_image.shape[0])
+
+    window = cv2.GaussianBlur(original_image[top:bottom, left:right], (11, 11), 10)
+    binary_window = threshold_page(get_gray_image(window), value_range)
+    corners = find_corners(binary_window, markers=1, reference=get_scaled_features(coarse_corner, scale))
+    if not corners:
+        return np.int32(np.rint(coarse_corner / scale))
+    return corners[0] + np.array([left, top], dtype=corners[0].dtype)
+
+def find_corners_coarse_to_fine(original_image, scale):
+    """Get the four corner markers of a high-DPI page searching them in a grayscale copy scaled by
+    scale and refining them at full resolution"""
+    coarse_image = cv2.resize(get_gray_image(original_image), None, fx=scale, fy=scale,
+                              interpolation=cv2.INTER_AREA)
+    # Same blur as the full resolution page, scaled
+    blurred_image = cv2.GaussianBlur(coarse_image, (0, 0), 10 * scale)
+    coarse_corners = find_corners(threshold_page(blurred_image), scale=scale)
+
+    # The blurred copy keeps the range of values of the blurred page
+    minimum, maximum, _, _ = cv2.minMaxLoc(blurred_image)
+    return [refine_corner(original_image, corner, scale, (minimum, maximum)) for corner in coarse_corners]
+
 def order_points(points):
     """Order points counter-clockwise-ly."""
     origin = np.mean(points, axis=0)
@@ -87,8 +203,8 @@ def get_outmost_points(contours):
     all_points = np.concatenate(contours)
     return get_bounding_rect(all_points)
 
-def perspective_transform(img, points):
-    """Transform img so that points are the new corners"""
+def get_perspective_transform(points):
+    """Get the perspective transform that maps points to the corners of the answer area"""
     source = np.array(
         points,
         dtype="float32")
@@ -99,16 +215,25 @@ def perspective_transform(img, points):
         [0, 0],
         [AREA_IMAGE_WIDTH, 0]],
                     dtype="float32")
+    return cv2.getPerspectiveTransform(source, dest)
 
-    img_dest = img.copy()
-    transf = cv2.getPerspectiveTransform(source, dest)
+def perspective_transform(img, points):
+    """Transform img so that points are the new corners"""
+    transf = get_perspective_transform(points)
     warped = cv2.warpPerspective(img, transf, (AREA_IMAGE_WIDTH, AREA_IMAGE_HEIGHT))
     return warped
 
+def warp_answer_area_region(img, transf, left, top, right, bottom):
+    """Get the region [left, right) x [top, bottom) of the answer area of img (transformed by transf)
+    without warping the rest of the answer area. Its pixels can differ by a gray level from the ones
+    of the whole answer area due to rounding"""
+    translation = np.array([[1, 0, -left], [0, 1, -top], [0, 0, 1]], dtype=np.float64)
+    return cv2.warpPerspective(img, translation.dot(transf), (right - left, bottom - top))
+
 def get_first_page_answer_area(source_file, EXTRACTED_PAGES_DIR, EXTRACTED_AREAS_DIR):
     """Get the answer area of the first page of source_file as an image"""
     areas_path = extract_answer_area_from_page(source_file, EXTRACTED_PAGES_DIR, EXTRACTED_AREAS_DIR, page_limit=1)
-    return cv2.imread(areas_path[0])
+    return cv2.imread(areas_path[0], cv2.IMREAD_ANYCOLOR)
 
 def get_files_in_directory(directory_path, extension):
     """Get all files in a directory with extension"""
@@ -117,6 +242,7 @@ def get_files_in_directory(directory_path, extension):
     return files
 
 
+@metrics.timed("split_pages", pages=len)
 def save_individual_pages_to_disk(diary, EXTRACTED_PAGES_DIR):
     file_name, extension = os.path.splitext(os.path.basename(diary))
     save_dir = os.path.join(EXTRACTED_PAGES_DIR, file_name)
@@ -141,6 +267,124 @@ def save_individual_pages_to_disk(diary, EXTRACTED_PAGES_DIR):
                 images_paths.append(page_path)
     return images_paths
 
+def iter_pages(source_file, first_page=0):
+    """Decode the pages of source_file (a tif, png or zip of pngs) one at a time, starting from
+    first_page (the pages before it are not decoded).
+    Yields each page as an Open CV image, only the current page is kept in memory. Grayscale and
+    bilevel pages are decoded as grayscale images (one channel), the rest as BGR images.
+    """
+    extension = os.path.splitext(str(source_file))[1]
+    if extension == ".png" and first_page == 0:
+        with metrics.measure("decode_page", pages=1):
+            page = cv2.imread(str(source_file), cv2.IMREAD_ANYCOLOR)
+        yield page
+    elif extension == ".zip":
+        with zipfile.ZipFile(str(source_file), 'r') as zip_ref:
+            # Same order as the pages extracted by save_individual_pages_to_disk
+            members = [name for name in zip_ref.namelist() if name.endswith(".png")]
+            for member in natsorted(members, alg=ns.PATH)[first_page:]:
+                with metrics.measure("decode_page", pages=1):
+                    buffer = np.frombuffer(zip_ref.read(member), dtype=np.uint8)
+                    page = cv2.imdecode(buffer, cv2.IMREAD_ANYCOLOR)
+                yield page
+    elif extension == ".tif":
+        with Image.open(str(source_file)) as tif_img:
+            for i in range(first_page, tif_img.n_frames):
+                with metrics.measure("decode_page", pages=1):
+                    tif_img.seek(i)
+                    if tif_img.mode in ("1", "L"):
+                        page = np.array(tif_img.convert("L"))
+                    else:
+                        page = cv2.cvtColor(np.asarray(tif_img.convert("RGB")), cv2.COLOR_RGB2BGR)
+                yield page
+
+def count_pages(source_file):
+    """Count the pages of source_file (a tif, png or zip of pngs) without decoding them"""
+    extension = os.path.splitext(str(source_file))[1]
+    if extension == ".png":
+        return 1
+    elif extension == ".zip":
+        with zipfile.ZipFile(str(source_file), 'r') as zip_ref:
+            return len([name for name in zip_ref.namelist() if name.endswith(".png")])
+    elif extension == ".tif":
+        with Image.open(str(source_file)) as tif_img:
+            return tif_img.n_frames
+    return 0
+
+def get_answer_area_path(source_file, EXTRACTED_AREAS_DIR, page_number):
+    """Get the path where the answer area of page_number of source_file is saved"""
+    diary_file_name = os.path.splitext(os.path.basename(str(source_file)))[0]
+    return os.path.join(EXTRACTED_AREAS_DIR, diary_file_name, "answer_area_page_{}.tif".format(page_number))
+
+def get_answer_area_transform(original_image, contours_image_path=None, coarse=False):
+    """Get the perspective transform from a page (an Open CV image) to the answer area framed by its
+    four corner markers. The corner markers are drawn on original_image, if contours_image_path is
+    given the page with the markers is saved to that path for debugging purposes. In coarse mode the
+    markers of high-DPI pages are searched on a downscaled copy
+    """
+    scale = get_marker_search_scale(original_image) if coarse else 1
+    if scale < 1:
+        with metrics.measure("find_corners_coarse_to_fine", pages=1):
+            corners = find_corners_coarse_to_fine(original_image, scale)
+    else:
+        # Transform the image
+        with metrics.measure("gaussian_blur", pages=1):
+            blurred_image = cv2.GaussianBlur(original_image, (11, 11), 10)
+            binary_image = threshold_page(get_gray_image(blurred_image))
+
+        # Identify the corners from the image black contours
+        with metrics.measure("find_corners", pages=1):
+            corners = find_corners(binary_image)
+
+    # Save the image with contours for debuggin purposes
+    markers_color = MARKERS_GRAY_LEVEL if original_image.ndim == 2 else MARKERS_COLOR
+    cv2.drawContours(original_image, corners, -1, markers_color, 3)
+    if contours_image_path is not None:
+        cv2.imwrite(contours_image_path, original_image)
+
+    # Get the area_markers that frame the answer area of a page
+    area_markers = order_points(get_outmost_points(corners))
+    return get_perspective_transform(area_markers)
+
+def get_answer_area(original_image, contours_image_path=None, coarse=False):
+    """Get the answer area of a page (an Open CV image) framed by its four corner markers.
+    The corner markers are drawn on original_image, if contours_image_path is given the page
+    with the markers is saved to that path for debugging purposes. In coarse mode the markers of
+    high-DPI pages are searched on a downscaled copy
+    """
+    transf = get_answer_area_transform(original_image, contours_image_path, coarse)
+
+    # Get the answer area of a pge
+    with metrics.measure("warp_perspective", pages=1):
+        return cv2.warpPerspective(original_image, transf, (AREA_IMAGE_WIDTH, AREA_IMAGE_HEIGHT))
+
+def save_answer_area(answer_area, source_file, EXTRACTED_AREAS_DIR, page_number):
+    """Save the answer area of page_number of source_file to a file and return its path"""
+    extracted_answer_area_path = get_answer_area_path(source_file, EXTRACTED_AREAS_DIR, page_number)
+
+    # Create folder to save the individual answer areas
+    extracted_pages_folder = os.path.dirname(extracted_answer_area_path)
+    if not os.path.exists(extracted_pages_folder):
+        os.makedirs(extracted_pages_folder)
+
+    cv2.imwrite(extracted_answer_area_path, answer_area)
+    return extracted_answer_area_path
+
+def extract_answer_areas(source_file, EXTRACTED_AREAS_DIR=None, page_limit=0):
+    """Extracts in memory the answer areas of each page of source_file (a tif, png or zip file)
+    Yields each answer area as an Open CV image, pages are decoded one at a time. No intermediate
+    files are written, the answer areas are only saved to EXTRACTED_AREAS_DIR (for debugging
+    purposes) if it is given
+    """
+    for page_number, original_image in enumerate(iter_pages(source_file)):
+        if page_limit > 0 and page_number >= page_limit:
+            break
+        extracted_area = get_answer_area(original_image)
+        if EXTRACTED_AREAS_DIR is not None:
+            save_answer_area(extracted_area, source_file, EXTRACTED_AREAS_DIR, page_number)
+        yield extracted_area
+
+@metrics.timed("extract_answer_area_from_page", pages=len, level=logging.INFO)
 def extract_answer_area_from_page(source_file, EXTRACTED_PAGES_DIR, EXTRACTED_AREAS_DIR, print_corner_markers=False, page_limit=0):
     """Extracts as single images the answer areas of each page of source_fle (a tiff file)
     Returns a list with the path to each area file.abs
@@ -164,41 +408,18 @@ def extract_answer_area_from_page(source_file, EXTRACTED_PAGES_DIR, EXTRACTED_AR
         if page_limit == 0 or (page_limit > 0 and page_number < page_limit):
             try:
                 # Load page as an Open CV image
-                original_image = cv2.imread(page_path)
-
-                # Transform the image
-                blurred_image = cv2.GaussianBlur(original_image, (11, 11), 10)
-                normalised_image = normalize(cv2.cvtColor(blurred_image, cv2.COLOR_BGR2GRAY))
-                ret, binary_image = cv2.threshold(normalised_image, 127, 255, cv2.THRESH_BINARY)
-
-                # Get the image black contours
-                contours = get_contours(binary_image)
+                original_image = cv2.imread(page_path, cv2.IMREAD_ANYCOLOR)
 
-                # Identify the corners from the contours
-                corners = get_corners(contours)
-
-                # Save the image with contours for debuggin purposes
-                cv2.drawContours(original_image, corners, -1, (0, 255, 0), 3)
+                contours_image_path = None
                 if print_corner_markers:
-                    cv2.imwrite(EXTRACTED_PAGES_DIR + "page_contours{}.tif".format(page_number), original_image)
-
-                # Get the area_markers that frame the answer area of a page
-                area_markers = order_points(get_outmost_points(corners))
-
-                # Get the answer area of a pge
-                extracted_area = perspective_transform(original_image, area_markers)
-
-                # Get the path to save the answer area
-                diary_file_name = os.path.splitext(os.path.basename(source_file))[0]
+                    contours_image_path = EXTRACTED_PAGES_DIR + "page_contours{}.tif".format(page_number)
 
-                # Create folder to save the individual answer areas
-                extracted_pages_folder = os.path.join(EXTRACTED_AREAS_DIR, diary_file_name)
-                if not os.path.exists(extracted_pages_folder):
-                    os.makedirs(extracted_pages_folder)
+                # Get the answer area of a page
+                extracted_area = get_answer_area(original_image, contours_image_path)
 
                 # Save the current answer_area to a file
-                extracted_answer_area_path = os.path.join(extracted_pages_folder, "answer_area_page_{}.tif".format(page_number))
-                cv2.imwrite(extracted_answer_area_path, extracted_area)
+                extracted_answer_area_path = save_answer_area(extracted_area, source_file,
+                                                              EXTRACTED_AREAS_DIR, page_number)
 
                 # Save the path of the extracted answer area
                 extracted_answer_area_paths.append(extracted_answer_area_path)
@@ -208,4 +429,4 @@ def extract_answer_area_from_page(source_file, EXTRACTED_PAGES_DIR, EXTRACTED_AR
                 LOGGER = logging.getLogger()
                 LOGGER.error("Error extracting answer areas" , exc_info=True)
         page_number += 1
-    return extracted_answer_area_paths
\ No newline at end of file
+    return extracted_answer_area_paths
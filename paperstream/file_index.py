@@ -0,0 +1,123 @@
+"""
+In-memory index of the files of a directory tree, for the listings polled by the web interface.
+The tree is walked once, afterwards only the directories whose modification time changed (a file
+was added, removed or renamed in them) are listed again, so a listing costs a stat per directory
+instead of a walk per extension. The size, modification time and hash of the files are cached too.
+
+"""
+import hashlib
+import os
+import threading
+import time
+from natsort import natsorted, ns
+
+# Modification times of some file systems (FAT, network drives) have a resolution of 2 seconds, a
+# directory modified less than this before it was listed is listed again on the next refresh
+MTIME_RESOLUTION = 2.0
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def scan_directory(directory):
+    """Get the names of the files and of the subdirectories of a directory. Links to directories are
+    not followed, as in a recursive glob, so a link to a parent directory does not repeat the files"""
+    files, subdirectories = [], []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.name)
+                elif entry.is_file():
+                    files.append(entry.name)
+            except OSError:
+                # Removed while it was listed
+                continue
+    return files, subdirectories
+
+def hash_file(path):
+    """Get the SHA-256 (hex digest) of the content of a file"""
+    hash_object = hashlib.sha256()
+    with open(str(path), 'rb') as indexed_file:
+        for chunk in iter(lambda: indexed_file.read(HASH_CHUNK_SIZE), b""):
+            hash_object.update(chunk)
+    return hash_object.hexdigest()
+
+
+class DirectoryIndex(object):
+    """The files of a directory tree, refreshed by the modification time of its directories"""
+    def __init__(self, root):
+        self.root = str(root)
+        self.lock = threading.Lock()
+        # {directory: (modification time or None to list it again, file names, subdirectory names)}
+        self.directories = {}
+        # {extension: naturally sorted paths}, cleared when a directory changes
+        self.listings = {}
+        # {path: (size, modification time, SHA-256)} of the files whose information was requested
+        self.files_info = {}
+
+    def refresh(self):
+        """List again the directories modified since the last refresh, returns whether any changed"""
+        changed = False
+        found = set()
+        pending = [self.root]
+        while pending:
+            directory = pending.pop()
+            try:
+                mtime = os.stat(directory).st_mtime
+                listed = self.directories.get(directory)
+                if listed is None or listed[0] is None or listed[0] != mtime:
+                    scan_time = time.time()
+                    files, subdirectories = scan_directory(directory)
+                    changed = changed or listed is None or listed[1:] != (files, subdirectories)
+                    listed = (mtime if scan_time - mtime > MTIME_RESOLUTION else None, files, subdirectories)
+                    self.directories[directory] = listed
+            except OSError:
+                # Removed, or unreadable (e.g. a folder of a network drive without permission), it is
+                # skipped as a recursive glob skips it
+                continue
+            found.add(directory)
+            pending.extend(os.path.join(directory, name) for name in listed[2])
+
+        for directory in set(self.directories) - found:
+            del self.directories[directory]
+            changed = True
+        if changed:
+            self.listings = {}
+            paths = set(self.iter_paths())
+            self.files_info = {path: info for path, info in self.files_info.items() if path in paths}
+        return changed
+
+    def iter_paths(self):
+        """Iterate over the paths of the files indexed"""
+        for directory, (mtime, files, subdirectories) in self.directories.items():
+            for name in files:
+                yield os.path.join(directory, name)
+
+    def get_files(self, extension):
+        """Get the paths (naturally sorted) of the files of the tree with extension"""
+        with self.lock:
+            self.refresh()
+            if extension not in self.listings:
+                self.listings[extension] = natsorted((path for path in self.iter_paths() if path.endswith(extension)),
+                                                     alg=ns.PATH)
+            return list(self.listings[extension])
+
+    def get_file_info(self, path):
+        """Get the size, modification time and SHA-256 of a file of the tree as a dictionary. The file is
+        only hashed again if its size or modification time changed"""
+        path = str(path)
+        stat = os.stat(path)
+        with self.lock:
+            info = self.files_info.get(path)
+        if info is None or info[:2] != (stat.st_size, stat.st_mtime_ns):
+            # Hashed without the lock, listing the files does not wait for it
+            info = (stat.st_size, stat.st_mtime_ns, hash_file(path))
+            with self.lock:
+                self.files_info[path] = info
+        return {"path": path, "size": info[0], "mtime": info[1] / 1e9, "sha256": info[2]}
+
+    def add_file_info(self, path, sha256):
+        """Record the SHA-256 of a file of the tree hashed as it was written, so it is not hashed again"""
+        path = str(path)
+        stat = os.stat(path)
+        with self.lock:
+            self.files_info[path] = (stat.st_size, stat.st_mtime_ns, sha256)
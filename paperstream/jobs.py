@@ -0,0 +1,188 @@
+"""
+Background jobs of the web app. Encoding or creating a document can take minutes, so the requests
+that start them get a job id straight away and poll /jobs/{id} for its state, progress and result.
+Jobs run on a bounded pool of workers so many users can submit work without starving the server.
+When several server processes share the work, their jobs are kept in a SQLite database so any of
+them can answer the polls of a job started by another one.
+
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+
+# Maximum number of jobs that run at the same time, the rest wait in the queue
+JOB_WORKERS = int(os.environ.get("PAPERSTREAM_JOB_WORKERS", 2))
+
+# Seconds that a finished job is kept before it is forgotten
+JOB_RETENTION = 24 * 60 * 60
+
+# Environment variable with the path of the SQLite database of the jobs shared by several server
+# processes, the jobs are kept in memory if it is not set
+JOB_STORE_ENV = "PAPERSTREAM_JOB_STORE"
+# Seconds that a process waits for another one that is writing to the database
+JOB_STORE_TIMEOUT = 30
+
+# States of a job
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def get_job_store():
+    """Get the store of the jobs of this process, the database in JOB_STORE_ENV if it is set"""
+    path = os.environ.get(JOB_STORE_ENV)
+    return MemoryJobStore() if not path else SQLiteJobStore(path)
+
+
+class MemoryJobStore(object):
+    """The jobs of a single process, as dictionaries"""
+    def __init__(self):
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def add(self, job):
+        """Add a new job"""
+        with self.lock:
+            self.jobs[job["id"]] = job
+
+    def update(self, job_id, fields):
+        """Update the fields of a job"""
+        with self.lock:
+            self.jobs[job_id].update(fields)
+
+    def get(self, job_id):
+        """Get a copy of a job or None if it does not exist"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return None if job is None else dict(job)
+
+    def forget_finished(self, oldest):
+        """Remove the jobs that finished before oldest (a timestamp)"""
+        with self.lock:
+            for job_id in [job_id for job_id, job in self.jobs.items()
+                           if job["finished"] is not None and job["finished"] < oldest]:
+                del self.jobs[job_id]
+
+    def fail_unfinished(self, pid, error):
+        """Mark as failed the jobs of the process pid that are pending or running, returns their ids"""
+        with self.lock:
+            failed = [job_id for job_id, job in self.jobs.items()
+                      if job.get("pid") == pid and job["state"] in (PENDING, RUNNING)]
+            for job_id in failed:
+                self.jobs[job_id].update(state=FAILED, error=error, finished=time.time())
+        return failed
+
+
+class SQLiteJobStore(object):
+    """The jobs of several processes in a SQLite database, each job is saved as JSON"""
+    def __init__(self, path):
+        self.path = str(path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with closing(self.connect()) as connection:
+            # Readers do not wait for the writers
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, job TEXT NOT NULL, finished REAL)")
+
+    def connect(self):
+        """Open a connection to the database, each operation opens its own so threads never share one"""
+        return sqlite3.connect(self.path, timeout=JOB_STORE_TIMEOUT, isolation_level=None)
+
+    @contextmanager
+    def transaction(self):
+        """Open a connection with a write transaction, it is committed if there are no errors"""
+        with closing(self.connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def add(self, job):
+        """Add a new job"""
+        with self.transaction() as connection:
+            connection.execute("INSERT INTO jobs (id, job, finished) VALUES (?, ?, ?)",
+                               (job["id"], json.dumps(job), job["finished"]))
+
+    def update(self, job_id, fields):
+        """Update the fields of a job"""
+        with self.transaction() as connection:
+            job = json.loads(connection.execute("SELECT job FROM jobs WHERE id = ?", (job_id,)).fetchone()[0])
+            job.update(fields)
+            connection.execute("UPDATE jobs SET job = ?, finished = ? WHERE id = ?",
+                               (json.dumps(job), job["finished"], job_id))
+
+    def get(self, job_id):
+        """Get a job or None if it does not exist"""
+        with closing(self.connect()) as connection:
+            row = connection.execute("SELECT job FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def forget_finished(self, oldest):
+        """Remove the jobs that finished before oldest (a timestamp)"""
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM jobs WHERE finished < ?", (oldest,))
+
+    def fail_unfinished(self, pid, error):
+        """Mark as failed the jobs of the process pid that are pending or running (e.g. because it
+        died), returns their ids"""
+        failed = []
+        with self.transaction() as connection:
+            for job_id, job_json in connection.execute("SELECT id, job FROM jobs WHERE finished IS NULL").fetchall():
+                job = json.loads(job_json)
+                if job.get("pid") == pid and job["state"] in (PENDING, RUNNING):
+                    job.update(state=FAILED, error=error, finished=time.time())
+                    connection.execute("UPDATE jobs SET job = ?, finished = ? WHERE id = ?",
+                                       (json.dumps(job), job["finished"], job_id))
+                    failed.append(job_id)
+        return failed
+
+
+class JobQueue(object):
+    """Runs jobs on a bounded pool of workers and keeps track of their state in a store (in memory
+    unless another one is given)"""
+    def __init__(self, workers=JOB_WORKERS, store=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.store = store if store is not None else MemoryJobStore()
+
+    def submit(self, kind, function, *args, **kwargs):
+        """Queue function(*args, progress=callback, **kwargs) and return the id of its job.
+        The function reports its progress calling callback(pages_done, pages_total) and its result
+        must be serializable to JSON"""
+        job_id = uuid.uuid4().hex
+        # The process that runs the job, its jobs are failed if it dies
+        job = {"id": job_id, "kind": kind, "state": PENDING, "pages_done": 0, "pages_total": None,
+               "result": None, "error": None, "submitted": time.time(), "finished": None, "pid": os.getpid()}
+        self.store.forget_finished(time.time() - JOB_RETENTION)
+        self.store.add(job)
+        self.executor.submit(self.run, job_id, function, args, kwargs)
+        return job_id
+
+    def run(self, job_id, function, args, kwargs):
+        """Run the function of a job and save its result or error"""
+        def progress(pages_done, pages_total):
+            self.update(job_id, pages_done=pages_done, pages_total=pages_total)
+
+        self.update(job_id, state=RUNNING)
+        try:
+            result = function(*args, progress=progress, **kwargs)
+            self.update(job_id, state=DONE, result=result, finished=time.time())
+        except Exception as error:
+            logging.getLogger().error("Error running job {}".format(job_id), exc_info=True)
+            self.update(job_id, state=FAILED, error=str(error), finished=time.time())
+
+    def update(self, job_id, **fields):
+        """Update the fields of a job"""
+        self.store.update(job_id, fields)
+
+    def get(self, job_id):
+        """Get a copy of a job or None if it does not exist"""
+        return self.store.get(job_id)
@@ -3,11 +3,12 @@
 # Let's get this party started!
 import os
 import falcon
+import hashlib
 import json
-import paperstream.encode_diary as encode
-import paperstream.create_diary as create
-import paperstream.extract_framed_area as extract
-import cv2
+import paperstream.cache as cache
+import paperstream.file_index as file_index
+import paperstream.jobs as jobs
+import paperstream.metrics as metrics
 import traceback
 import zipfile
 import sys
@@ -15,6 +16,10 @@ import logging
 from logging.config import fileConfig
 
 from falcon_multipart.middleware import MultipartMiddleware
+from paperstream.settings import DIARIES_TO_CREATE_DIR, DIARIES_TO_ENCODE_DIR, TEMPLATE_DIR
+
+# The encoding and creation modules (and OpenCV, NumPy, PIL, PyPDF2 and reportlab with them) are
+# imported by the first request that needs them, so the server starts listening straight away
 
 def resource_path(relative_path):
     """ Get absolute path to resource, works for dev and for PyInstaller """
@@ -23,13 +28,53 @@ def resource_path(relative_path):
 
 # These paths are for the web interface, don't call resource_path
 WEB_ANSWER_AREA_PATH = resource_path("static/template.png")
-DOWNLOADS_DIR = r"static/downloads"
-DIARIES_TO_CREATE_DIR = resource_path("input/1_diaries_to_create/")
-TEMPLATE_DIR = resource_path("input/2_template_to_encode/")
-DIARIES_TO_ENCODE_DIR = resource_path("input/3_diaries_to_encode/")
+# Files compressed inside downloaded zip files, the rest (PDF, PNG) are stored
+COMPRESSED_EXTENSIONS = {".csv"}
+ZIP_CHUNK_SIZE = 1024 * 1024
+# Uploaded files are copied in chunks of this size, they are never loaded whole in memory
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Template (path and SHA-256) whose answer area is saved in WEB_ANSWER_AREA_PATH, removed when a
+# template is uploaded or deleted. It is a file so every server process sees the same one
+WEB_ANSWER_AREA_TEMPLATE_PATH = resource_path("output/temporal/web_answer_area_template.json")
+# Jobs shared by the processes of a multi-process server
+JOB_STORE_PATH = resource_path("output/temporal/jobs.sqlite")
+# Metrics of the processes of a multi-process server
+METRICS_SHARED_DIR = resource_path("output/temporal/metrics/")
 
 fileConfig(resource_path("log_configuration.ini"))
 
+# The listings of the input folders are served from memory, the folders are only listed again when
+# their modification time changes
+DIARIES_TO_CREATE_INDEX = file_index.DirectoryIndex(DIARIES_TO_CREATE_DIR)
+TEMPLATE_INDEX = file_index.DirectoryIndex(TEMPLATE_DIR)
+DIARIES_TO_ENCODE_INDEX = file_index.DirectoryIndex(DIARIES_TO_ENCODE_DIR)
+
+# Folder and index of each kind of upload
+UPLOAD_FOLDERS = {"creation": (DIARIES_TO_CREATE_DIR, DIARIES_TO_CREATE_INDEX),
+                  "encodingTemplate": (TEMPLATE_DIR, TEMPLATE_INDEX),
+                  "encodingDiaries": (DIARIES_TO_ENCODE_DIR, DIARIES_TO_ENCODE_INDEX)}
+
+# Encoding and creating documents run in the background, the web interface polls /jobs/{id}. The jobs
+# are kept in memory unless the server processes share them in a database
+JOBS = jobs.JobQueue(store=jobs.get_job_store())
+
+
+def load_web_answer_area_template():
+    """Get the template (path and SHA-256) whose answer area is saved in WEB_ANSWER_AREA_PATH, None if
+    it has not been saved or a template was uploaded or deleted since"""
+    try:
+        with open(WEB_ANSWER_AREA_TEMPLATE_PATH, 'r') as template_file:
+            return json.load(template_file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def clear_web_answer_area_template():
+    """Forget the template whose answer area is saved in WEB_ANSWER_AREA_PATH"""
+    try:
+        os.remove(WEB_ANSWER_AREA_TEMPLATE_PATH)
+    except FileNotFoundError:
+        pass
+
 
 class TemplateResource(object):
     def on_get(self, req, resp):
@@ -50,23 +95,31 @@ class TemplateResource(object):
                 resp.body = json.dumps({"template": ""})
 
     def extract_template_answer_area():
-        """ Extracts the answer area from a TIF or PNG file """
-        tif_files = encode.get_files_in_directory(TEMPLATE_DIR, ".tif")
-        png_files = encode.get_files_in_directory(TEMPLATE_DIR, ".png")
+        """ Extracts the answer area from a TIF or PNG file, unless it is the one already extracted """
+        tif_files = TEMPLATE_INDEX.get_files(".tif")
+        png_files = TEMPLATE_INDEX.get_files(".png")
         files = tif_files + png_files
 
         # If there is at least one tif or png file in the template dir
         if files:
             template_path = files[0]
             try:
-                template_answer_area = cv2.imread(extract.extract_answer_area_from_page(template_path, 
-                                                  encode.EXTRACTED_PAGES_DIR, 
-                                                  encode.EXTRACTED_AREAS_DIR,
-                                                  page_limit=1)[0])
-                image_saved = cv2.imwrite(WEB_ANSWER_AREA_PATH, template_answer_area)
+                template = {"path": template_path, "sha256": TEMPLATE_INDEX.get_file_info(template_path)["sha256"]}
+                if load_web_answer_area_template() == template:
+                    return (True, template_path)
+
+                import cv2
+                import paperstream.encode_diary as encode
+
+                # The answer areas of the template are cached by its content, encoding diaries reuses them
+                template_answer_area, template_binary_area = encode.get_template_areas(template_path)
+                # Written atomically, another server process may be serving the previous one
+                image_saved, template_answer_area_png = cv2.imencode(".png", template_answer_area)
                 if not image_saved:
                     return (False, "saving")
                 else:
+                    cache.atomic_write(WEB_ANSWER_AREA_PATH, template_answer_area_png.tobytes())
+                    cache.atomic_write(WEB_ANSWER_AREA_TEMPLATE_PATH, json.dumps(template).encode())
                     return (True, template_path)
             except OSError:
                 return (False, "encoding")
@@ -78,8 +131,8 @@ class ScannedDiariesResource(object):
     def on_get(self, req, resp):
         """Returns a list of all of the tif files (diaries) present in DIARIES_TO_ENCODE_DIR"""
         resp.set_header('Content-Type', 'text/json')
-        tif_paths = encode.get_files_in_directory(DIARIES_TO_ENCODE_DIR, ".tif")
-        zip_paths = encode.get_files_in_directory(DIARIES_TO_ENCODE_DIR, ".zip")
+        tif_paths = DIARIES_TO_ENCODE_INDEX.get_files(".tif")
+        zip_paths = DIARIES_TO_ENCODE_INDEX.get_files(".zip")
         diaries_paths = tif_paths + zip_paths
         def extract_file_name(path): return os.path.basename(path)
         resp.body = json.dumps({"diaries": list(map(extract_file_name, diaries_paths)),
@@ -90,7 +143,7 @@ class PDFTemplateDiariesResource(object):
     def on_get(self, req, resp):
         """Returns a list of all of the PDF files (templates) present in DIARIES_TO_CREATE_DIR"""
         resp.set_header('Content-Type', 'text/json')
-        diaries_paths = encode.get_files_in_directory(DIARIES_TO_CREATE_DIR, ".pdf")
+        diaries_paths = DIARIES_TO_CREATE_INDEX.get_files(".pdf")
 
         def extract_file_name(path): return os.path.basename(path)
         resp.body = json.dumps({"templates_file_names": list(map(extract_file_name, diaries_paths)),
@@ -98,10 +151,19 @@ class PDFTemplateDiariesResource(object):
 
 
 class EncodeResource(object):
+    def encode_diary(diary_path, rubric, date, progress=None):
+        """Encodes a diary and returns the path of its answers"""
+        import paperstream.encode_diary as encode
+
+        encoded_diary = encode.encode_diary(diary_path, TEMPLATE_DIR, rubric, date, progress=progress)
+        logging.getLogger().info("Document encoded {}".format(encoded_diary.stem))
+        return str(encoded_diary)
+
     def on_post(self, req, resp):
         """
-        Encodes a diary (tif or zip file) based on a rubric (created in the web interface) and a blank 
-        page of the diary (tif or zip file) present in TEMPLATE_DIR
+        Starts encoding a diary (tif or zip file) based on a rubric (created in the web interface) and a
+        blank page of the diary (tif or zip file) present in TEMPLATE_DIR. Returns the id of the job, 
+        its result is the path of the encoded diary
         """
         LOGGER = logging.getLogger()
         
@@ -114,9 +176,10 @@ class EncodeResource(object):
             diary_path = content.get("diary")
             date = content.get("date")
 
-            encoded_diary = encode.encode_diary(diary_path, TEMPLATE_DIR, rubric, date)
-            resp.body = json.dumps(str(encoded_diary))
-            LOGGER.info("Document encoded {}".format(encoded_diary.stem))
+            job_id = JOBS.submit("encode", EncodeResource.encode_diary, diary_path, rubric, date)
+            resp.status = falcon.HTTP_202
+            resp.body = json.dumps({"job": job_id})
+            LOGGER.info("Document queued for encoding {} (job {})".format(diary_path, job_id))
         except Exception as e:
             LOGGER.error("Error encoding document" , exc_info=True)
             raise falcon.HTTPInternalServerError(title="Error encoding document: " + str(type(e)),
@@ -124,9 +187,62 @@ class EncodeResource(object):
                                                               ','.join(traceback.format_tb(e.__traceback__))))
 
 
+class EncodeDiariesResource(object):
+    def encode_diaries(diaries, rubric, date, progress=None):
+        """Encodes a batch of diaries and returns the path of the combined answers and the result of
+        each diary (the path of its answers or its error)"""
+        import paperstream.encode_diary as encode
+
+        combined_answers, results = encode.encode_diaries(diaries, TEMPLATE_DIR, rubric, date, progress=progress)
+        logging.getLogger().info("Documents encoded {}".format(combined_answers.stem))
+        return {"combined": str(combined_answers), "diaries": results}
+
+    def on_post(self, req, resp):
+        """
+        Starts encoding a batch of diaries (all the tif or zip files in DIARIES_TO_ENCODE_DIR unless a
+        list of diaries is given) with the same rubric and blank page present in TEMPLATE_DIR. Returns
+        the id of the job, its progress is the diaries encoded and its result the path of the combined
+        answers and the answers or the error of each diary
+        """
+        LOGGER = logging.getLogger()
+
+        resp.set_header('Content-Type', 'text/json')
+        raw_json = req.stream.read().decode('utf-8')
+        content = json.loads(raw_json, encoding='utf-8')
+
+        try:
+            rubric = content.get("rubric")
+            diaries = content.get("diaries", DIARIES_TO_ENCODE_DIR)
+            date = content.get("date")
+
+            job_id = JOBS.submit("encode", EncodeDiariesResource.encode_diaries, diaries, rubric, date)
+            resp.status = falcon.HTTP_202
+            resp.body = json.dumps({"job": job_id})
+            LOGGER.info("Documents queued for encoding {} (job {})".format(diaries, job_id))
+        except Exception as e:
+            LOGGER.error("Error encoding documents" , exc_info=True)
+            raise falcon.HTTPInternalServerError(title="Error encoding documents: " + str(type(e)),
+                                                 description=(str(e) +
+                                                              ','.join(traceback.format_tb(e.__traceback__))))
+
+
 class CreateResource(object):
+    def create_diary(pdf_template, pages, starting_date, email, font, progress=None):
+        """Creates the A4 document and A5 booklet of a PDF template and returns their paths"""
+        import paperstream.create_diary as create
+
+        a4_diary, a5_booklet = create.create_diary_and_booklet(pdf_template,
+                                                               pages,
+                                                               starting_date,
+                                                               email=email,
+                                                               font=font,
+                                                               progress=progress)
+        logging.getLogger().info("Document created {}".format(pdf_template))
+        return [str(a4_diary), str(a5_booklet)]
+
     def on_post(self, req, resp):
-        """Creates a diary based on a PDF template"""
+        """Starts creating a diary based on a PDF template. Returns the id of the job, its result is
+        the paths of the A4 document and the A5 booklet"""
         LOGGER = logging.getLogger()
         
         resp.set_header('Content-Type', 'text/json')
@@ -142,15 +258,11 @@ class CreateResource(object):
             email = content.get("email")
             font = content.get("font")
 
-            a4_diary = create.create_a4_diary(pdf_template,
-                                                 pages,
-                                                 starting_date,
-                                                 email=email,
-                                                 font=font)
-
-            a5_booklet = create.convert_to_a5_booklet(a4_diary)
-            resp.body = json.dumps([str(a4_diary), str(a5_booklet)])
-            LOGGER.info("Document created {}".format(pdf_template))            
+            job_id = JOBS.submit("create", CreateResource.create_diary,
+                                 pdf_template, pages, starting_date, email, font)
+            resp.status = falcon.HTTP_202
+            resp.body = json.dumps({"job": job_id})
+            LOGGER.info("Document queued for creation {} (job {})".format(pdf_template, job_id))
         except Exception as e:
             LOGGER.error("Error creating document" , exc_info=True)
             raise falcon.HTTPInternalServerError(title="Error creating document: " + str(type(e)),
@@ -158,72 +270,208 @@ class CreateResource(object):
                                                               ','.join(traceback.format_tb(e.__traceback__))))
 
 
-class DownloadFilesResource(object):
-    def compress_files(files, zip_name):
-        "Compress [files] into a zip file named [zip_name]"
-
-        if files and len(files) > 0:
-            zip_path = os.path.join(DOWNLOADS_DIR, zip_name)
-            authorised_folders = ["encoded_diaries", "created_diaries"]
-            with zipfile.ZipFile(resource_path(zip_path), 'w') as myzip:
-
-                if isinstance(files[0], list):
-                    for a4_document, a5_document in files:
-                        base_folder_a4 = os.path.basename(os.path.dirname(a4_document))
-                        base_folder_a5 = os.path.basename(os.path.dirname(a5_document))
-                        if base_folder_a4 in authorised_folders:
-                            myzip.write(a4_document, "a4_documents/" + (os.path.basename(a4_document)))
-                        if base_folder_a5 in authorised_folders:
-                            myzip.write(a5_document, "a5_documents(to print on A4 paper)/" + (os.path.basename(a5_document)))
-                
-                elif isinstance(files[0], str):
-                    for answers_file in files:
-                        base_folder = os.path.basename(os.path.dirname(answers_file))
-                        if base_folder in authorised_folders:
-                            myzip.write(answers_file, (os.path.basename(answers_file)))
-                
-            return zip_path
-        else:
-            raise Exception("There are no diaries to encode")
+class CreateDiariesResource(object):
+    def create_diaries(pdf_templates, pages, starting_date, email, font, progress=None):
+        """Creates the documents of a cohort of participants and returns the result of each one"""
+        import paperstream.create_diary as create
+
+        results = create.create_diaries(pdf_templates, pages, starting_date, email=email, font=font,
+                                        progress=progress)
+        logging.getLogger().info("Documents created {}".format(len(results)))
+        return results
 
     def on_post(self, req, resp):
-        """Handles the compression of files into a zip file"""
+        """
+        Starts creating the diaries of a cohort of participants, one per PDF template (all the PDF
+        files in DIARIES_TO_CREATE_DIR unless a list of templates is given). Returns the id of the job,
+        its progress is the participants done and its result the documents of each participant
+        """
         LOGGER = logging.getLogger()
-        
+
         resp.set_header('Content-Type', 'text/json')
+
         raw_json = req.stream.read().decode('utf-8')
         content = json.loads(raw_json, encoding='utf-8')
 
         try:
-            files = content.get("files")
-            zip_name = content.get("name")
-            zip_file = DownloadFilesResource.compress_files(files, zip_name)
-            resp.body = json.dumps({'file': zip_file})
-            LOGGER.info("Zip created and ready to download")
+            # Parse parameters
+            pdf_templates = content.get("pdf_templates", DIARIES_TO_CREATE_DIR)
+            pages = int(content.get("pages"))
+            starting_date = content.get("date")
+            email = content.get("email")
+            font = content.get("font")
+
+            job_id = JOBS.submit("create", CreateDiariesResource.create_diaries,
+                                 pdf_templates, pages, starting_date, email, font)
+            resp.status = falcon.HTTP_202
+            resp.body = json.dumps({"job": job_id})
+            LOGGER.info("Documents queued for creation {} (job {})".format(pdf_templates, job_id))
+        except Exception as e:
+            LOGGER.error("Error creating documents" , exc_info=True)
+            raise falcon.HTTPInternalServerError(title="Error creating documents: " + str(type(e)),
+                                                 description=(str(e) +
+                                                              ','.join(traceback.format_tb(e.__traceback__))))
+
+
+class JobResource(object):
+    def on_get(self, req, resp, job_id):
+        """
+        Returns the state (pending, running, done or failed) of a job, the pages done out of the total
+        and its result (or error) once it finishes
+        """
+        job = JOBS.get(job_id)
+        if job is None:
+            raise falcon.HTTPNotFound(title="Job not found", description="There is no job {}".format(job_id))
+
+        resp.set_header('Content-Type', 'text/json')
+        resp.body = json.dumps(job)
+
+
+class ZipStream(object):
+    """Unseekable file object that keeps what a ZipFile writes until it is taken out with read_written"""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def read_written(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class MetricsResource(object):
+    def on_get(self, req, resp):
+        """Returns the wall time histograms, CPU time and pages of the stages of the encoding pipeline
+        in the Prometheus text format, the ones of every server process if there are several"""
+        resp.content_type = 'text/plain; version=0.0.4'
+        shared_directory = os.environ.get(metrics.METRICS_DIR_ENV)
+        snapshot = metrics.get_shared_snapshot(shared_directory) if shared_directory else None
+        resp.body = metrics.get_metrics_text(snapshot)
+
+
+class DownloadFilesResource(object):
+    def get_zip_members(files):
+        "Get the (path, name inside the zip) of [files] that are in an authorised folder"
+
+        if not files or len(files) < 1:
+            raise Exception("There are no diaries to encode")
+
+        authorised_folders = ["encoded_diaries", "created_diaries"]
+        members = []
+        if isinstance(files[0], list):
+            for a4_document, a5_document in files:
+                members.append((a4_document, "a4_documents/" + (os.path.basename(a4_document))))
+                members.append((a5_document, "a5_documents(to print on A4 paper)/" + (os.path.basename(a5_document))))
+
+        elif isinstance(files[0], str):
+            for answers_file in files:
+                members.append((answers_file, (os.path.basename(answers_file))))
+
+        members = [(path, name) for path, name in members
+                   if os.path.basename(os.path.dirname(path)) in authorised_folders]
+        for path, name in members:
+            if not os.path.isfile(path):
+                raise Exception("File does not exist {}".format(path))
+        return members
+
+    def get_zip_name(zip_name):
+        "Get the name of the zip file for the Content-Disposition header from the one requested"
+        if not isinstance(zip_name, str):
+            return "files.zip"
+        # Without folders, quotes, control or non-ASCII characters that would break the header
+        zip_name = os.path.basename(zip_name.replace("\\", "/"))
+        zip_name = "".join(character for character in zip_name if " " <= character <= "~" and character != '"')
+        return zip_name.strip() or "files.zip"
+
+    def stream_zip(members):
+        "Yield the bytes of a zip file with [members] as it is built, CSV files are the only ones compressed"
+        zip_stream = ZipStream()
+        with zipfile.ZipFile(zip_stream, 'w') as myzip:
+            for path, name in members:
+                member = zipfile.ZipInfo.from_file(path, name)
+                if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+                    member.compress_type = zipfile.ZIP_DEFLATED
+                # PDF and PNG files barely shrink, they are stored as they are
+                with open(path, 'rb') as member_file, myzip.open(member, 'w') as zip_member:
+                    for chunk in iter(lambda: member_file.read(ZIP_CHUNK_SIZE), b""):
+                        zip_member.write(chunk)
+                        yield zip_stream.read_written()
+                yield zip_stream.read_written()
+        # The central directory is written when the zip file is closed
+        yield zip_stream.read_written()
+
+    def on_post(self, req, resp):
+        """
+        Streams a zip file with the files requested, either in a JSON body or in the fields (files as
+        JSON and name) of a form so the browser can save the response while it is being built
+        """
+        LOGGER = logging.getLogger()
+
+        try:
+            if req.get_param("files") is not None:
+                files = json.loads(req.get_param("files"))
+                zip_name = req.get_param("name")
+            else:
+                raw_json = req.stream.read().decode('utf-8')
+                content = json.loads(raw_json, encoding='utf-8')
+                files = content.get("files")
+                zip_name = content.get("name")
+            members = DownloadFilesResource.get_zip_members(files)
+            zip_name = DownloadFilesResource.get_zip_name(zip_name)
         except Exception as e:
             LOGGER.error("Error creating zip file" , exc_info=True)
             raise falcon.HTTPInternalServerError(title="Error downloading files: " + str(type(e)),
                                                  description=(str(e) +
                                                               ','.join(traceback.format_tb(e.__traceback__))))
 
+        resp.content_type = 'application/zip'
+        resp.set_header('Content-Disposition', 'attachment; filename="{}"'.format(zip_name))
+        resp.stream = DownloadFilesResource.stream_zip(members)
+        LOGGER.info("Streaming zip file with {} files".format(len(members)))
+
 
 class UploadFilesResource(object):
+    def save_upload(upload, directory):
+        """
+        Copies an uploaded file (the spooled part of the multipart form) to directory in chunks, hashing
+        it as it is written. It is written to a temporary file that replaces the destination once it is
+        complete, so the listings never show a partial upload. Returns its path and SHA-256
+        """
+        path = os.path.join(directory, os.path.basename(upload.filename))
+        hash_object = hashlib.sha256()
+        descriptor, temporal_path = cache.create_temporal_file(directory, suffix=".part")
+        try:
+            with os.fdopen(descriptor, 'wb') as writer:
+                for chunk in iter(lambda: upload.file.read(UPLOAD_CHUNK_SIZE), b""):
+                    hash_object.update(chunk)
+                    writer.write(chunk)
+            os.replace(temporal_path, path)
+        except BaseException:
+            os.remove(temporal_path)
+            raise
+        return path, hash_object.hexdigest()
+
     def on_post(self, req, resp):
+        """Saves an uploaded file (PDF template, encoding template or scanned diary) to the folder of its kind"""
+        resp.set_header('Content-Type', 'text/json')
         file = req.get_param('file')
         folder = req.get_param('folder')
-        if folder == "creation":
-            filename = file.filename
-            with(open(os.path.join(DIARIES_TO_CREATE_DIR, filename), 'wb')) as writer:
-                writer.write(file.file.read())
-        elif folder == "encodingTemplate":
-            filename = file.filename
-            with(open(os.path.join(TEMPLATE_DIR, filename), 'wb')) as writer:
-                writer.write(file.file.read())
-            # UploadFilesResource.reload_template()
-        elif folder == "encodingDiaries":
-            filename = file.filename
-            with(open(os.path.join(DIARIES_TO_ENCODE_DIR, filename), 'wb')) as writer:
-                writer.write(file.file.read())
+        if folder in UPLOAD_FOLDERS:
+            directory, index = UPLOAD_FOLDERS[folder]
+            path, sha256 = UploadFilesResource.save_upload(file, directory)
+            index.add_file_info(path, sha256)
+            if folder == "encodingTemplate":
+                clear_web_answer_area_template()
+                # UploadFilesResource.reload_template()
+            logging.getLogger().info("File uploaded {} ({})".format(path, sha256))
+            resp.body = json.dumps({"file": os.path.basename(path), "sha256": sha256})
+
     def reload_template():
         success, code = TemplateResource.extract_template_answer_area()
         # TODO feedback this errors to GUI
@@ -248,6 +496,7 @@ class DeleteFilesResource(object):
         elif folder == "encodingTemplate":
             DeleteFilesResource.delete_all_files_in_dir(".tif", TEMPLATE_DIR)
             DeleteFilesResource.delete_all_files_in_dir(".png", TEMPLATE_DIR)
+            clear_web_answer_area_template()
         elif folder == "encodingDiaries":
             DeleteFilesResource.delete_all_files_in_dir(".tif", DIARIES_TO_ENCODE_DIR)
             DeleteFilesResource.delete_all_files_in_dir(".zip", DIARIES_TO_ENCODE_DIR)
@@ -281,7 +530,11 @@ app.add_route('/encoding_template', TemplateResource())
 app.add_route('/scanned_diaries', ScannedDiariesResource())
 app.add_route('/pdf_template_diaries', PDFTemplateDiariesResource())
 app.add_route('/encode_diary', EncodeResource())
+app.add_route('/encode_diaries', EncodeDiariesResource())
 app.add_route('/create_diary', CreateResource())
+app.add_route('/create_diaries', CreateDiariesResource())
+app.add_route('/jobs/{job_id}', JobResource())
+app.add_route('/metrics', MetricsResource())
 app.add_route('/download_files', DownloadFilesResource())
 app.add_route('/upload_files', UploadFilesResource())
 app.add_route('/delete_files', DeleteFilesResource())
@@ -0,0 +1,179 @@
+"""
+Timing of the stages of the encoding pipeline. Each measure records the wall time, the CPU time and
+the pages processed by a stage, it is logged as a JSON line and added to a histogram per stage that
+the web app exposes in /metrics (Prometheus text format). When several server processes serve the
+app, each one saves its metrics to a shared folder so any of them answers /metrics for all of them.
+
+"""
+import bisect
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+import paperstream.cache as cache
+
+# Upper bounds (seconds) of the buckets of the wall time histograms
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# Stages measured once per call of the pipeline functions are logged as INFO, inner stages as DEBUG
+LOGGER = logging.getLogger()
+
+# Environment variable with the folder where the server processes share their metrics
+METRICS_DIR_ENV = "PAPERSTREAM_METRICS_DIR"
+# Seconds between the saves of the metrics of a process to the shared folder
+METRICS_SHARE_INTERVAL = 5
+
+STAGES = {}
+LOCK = threading.Lock()
+# A snapshot saved after a newer one would make the shared counters go backwards
+SAVE_LOCK = threading.Lock()
+
+
+def reset_lock():
+    """A forked process could inherit the locks held by a thread that does not exist in the child"""
+    global LOCK, SAVE_LOCK
+    LOCK = threading.Lock()
+    SAVE_LOCK = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_lock)
+
+def create_stage():
+    """Create the empty metrics of a stage"""
+    return {"count": 0, "pages": 0, "wall_time": 0.0, "cpu_time": 0.0,
+            "buckets": [0] * len(STAGE_BUCKETS)}
+
+def record(stage, wall_time, cpu_time, pages=0, level=logging.DEBUG):
+    """Add a measure of stage to its metrics and log it"""
+    with LOCK:
+        metrics = STAGES.setdefault(stage, create_stage())
+        metrics["count"] += 1
+        metrics["pages"] += pages
+        metrics["wall_time"] += wall_time
+        metrics["cpu_time"] += cpu_time
+        # Buckets are cumulative, a measure counts in every bucket with an upper bound above it
+        for bucket in range(bisect.bisect_left(STAGE_BUCKETS, wall_time), len(STAGE_BUCKETS)):
+            metrics["buckets"][bucket] += 1
+    LOGGER.log(level, json.dumps({"stage": stage, "wall_time": round(wall_time, 6),
+                                  "cpu_time": round(cpu_time, 6), "pages": pages}))
+
+@contextmanager
+def measure(stage, pages=0, level=logging.DEBUG):
+    """Measure the code run inside the with block as stage. The pages processed can be set in the
+    dictionary returned by the with statement if they are not known beforehand.
+    The CPU time is the one of the whole process, it includes the threads of Open CV"""
+    measurement = {"pages": pages}
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield measurement
+    finally:
+        record(stage, time.perf_counter() - wall_start, time.process_time() - cpu_start,
+               measurement["pages"], level)
+
+def timed(stage, pages=0, level=logging.DEBUG):
+    """Decorator that measures every call of a function as stage, pages is the number of pages
+    processed by a call or a function that counts them from the result of the call"""
+    def decorator(function):
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            with measure(stage, level=level) as measurement:
+                result = function(*args, **kwargs)
+                measurement["pages"] = pages(result) if callable(pages) else pages
+            return result
+        return timed_function
+    return decorator
+
+def get_snapshot():
+    """Get a copy of the metrics of every stage"""
+    with LOCK:
+        return {stage: dict(metrics, buckets=list(metrics["buckets"])) for stage, metrics in STAGES.items()}
+
+def add_snapshot(stages, snapshot):
+    """Add the metrics of a snapshot to the metrics of stages"""
+    for stage, stage_metrics in snapshot.items():
+        metrics = stages.setdefault(stage, create_stage())
+        for field in ("count", "pages", "wall_time", "cpu_time"):
+            metrics[field] += stage_metrics[field]
+        metrics["buckets"] = [bucket_count + other_count for bucket_count, other_count
+                              in zip(metrics["buckets"], stage_metrics["buckets"])]
+
+def merge(snapshot):
+    """Add the metrics of a snapshot (e.g. taken in a worker process) to the metrics of this process"""
+    with LOCK:
+        add_snapshot(STAGES, snapshot)
+
+def reset():
+    """Forget the metrics of every stage"""
+    with LOCK:
+        STAGES.clear()
+
+def collect(function, *args):
+    """Call function in a worker process, returns its result and the metrics recorded by the call
+    so the parent process can merge them"""
+    reset()
+    result = function(*args)
+    return result, get_snapshot()
+
+def merge_collected(collected_results):
+    """Merge the metrics of the results of collect and yield the results of the calls"""
+    for result, snapshot in collected_results:
+        merge(snapshot)
+        yield result
+
+def save_snapshot(directory):
+    """Save the metrics of this process to directory as <pid>.json, the file of a process that stopped
+    is kept so the shared counters never go backwards"""
+    with SAVE_LOCK:
+        cache.atomic_write(os.path.join(directory, "{}.json".format(os.getpid())),
+                           json.dumps(get_snapshot()).encode())
+
+def share_snapshots(directory, interval=METRICS_SHARE_INTERVAL):
+    """Save the metrics of this process to directory every interval seconds in a daemon thread"""
+    def save_periodically():
+        while True:
+            time.sleep(interval)
+            try:
+                save_snapshot(directory)
+            except OSError:
+                LOGGER.warning("Could not save the metrics to {}".format(directory), exc_info=True)
+
+    threading.Thread(target=save_periodically, daemon=True).start()
+
+def get_shared_snapshot(directory):
+    """Get the metrics of every process that saved them to directory, the ones of this process are
+    saved first so they are current. The ones of the other processes are up to their share interval old"""
+    save_snapshot(directory)
+    stages = {}
+    for name in os.listdir(directory):
+        if name.endswith(".json"):
+            with open(os.path.join(directory, name), 'r') as snapshot_file:
+                add_snapshot(stages, json.load(snapshot_file))
+    return stages
+
+def get_metrics_text(snapshot=None):
+    """Get the metrics of every stage (of this process unless a snapshot is given) in the Prometheus
+    text format"""
+    lines = ["# HELP paperstream_stage_wall_seconds Wall time of the stages of the encoding pipeline",
+             "# TYPE paperstream_stage_wall_seconds histogram"]
+    if snapshot is None:
+        snapshot = get_snapshot()
+    for stage, metrics in sorted(snapshot.items()):
+        for bucket, bucket_count in zip(STAGE_BUCKETS, metrics["buckets"]):
+            lines.append('paperstream_stage_wall_seconds_bucket{{stage="{}",le="{}"}} {}'.format(
+                stage, bucket, bucket_count))
+        lines.append('paperstream_stage_wall_seconds_bucket{{stage="{}",le="+Inf"}} {}'.format(
+            stage, metrics["count"]))
+        lines.append('paperstream_stage_wall_seconds_sum{{stage="{}"}} {}'.format(stage, metrics["wall_time"]))
+        lines.append('paperstream_stage_wall_seconds_count{{stage="{}"}} {}'.format(stage, metrics["count"]))
+
+    for name, field, description in (("cpu_seconds_total", "cpu_time", "CPU time of the stages"),
+                                     ("pages_total", "pages", "Pages processed by the stages")):
+        lines.append("# HELP paperstream_stage_{} {} of the encoding pipeline".format(name, description))
+        lines.append("# TYPE paperstream_stage_{} counter".format(name))
+        for stage, metrics in sorted(snapshot.items()):
+            lines.append('paperstream_stage_{}{{stage="{}"}} {}'.format(name, stage, metrics[field]))
+    return "\n".join(lines) + "\n"
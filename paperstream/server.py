@@ -0,0 +1,108 @@
+"""
+Launches the web app. A single process serves it with a pool of threads by default (one user on a
+desktop). Encoding and creating documents is CPU bound and the threads of a process share the GIL,
+so to serve a team from one machine several worker processes accept the connections of a socket
+bound by the launcher. The workers share their state on disk: the jobs in a SQLite database, the
+metrics in a folder, the answer keys and answer areas in the file caches of encode_diary. A worker that
+dies is restarted and its unfinished jobs are failed, unless it dies right after starting (e.g. the
+app cannot be imported), then the launcher stops the others and exits with an error.
+
+"""
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import shutil
+import signal
+import socket
+import sys
+import waitress
+import time
+import paperstream.jobs as jobs
+import paperstream.metrics as metrics
+from paperstream.settings import SERVER_HOST, SERVER_PORT, SERVER_THREADS
+
+# Connections waiting to be accepted by a worker
+SERVER_BACKLOG = 1024
+# Seconds that a worker must run before dying to be restarted, otherwise it would die again
+WORKER_MIN_UPTIME = 10
+
+
+def create_socket(host, port):
+    """Bind a listening TCP socket to host and port"""
+    listening = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if os.name != "nt":
+        # On Windows it would let other processes bind the same port
+        listening.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listening.bind((host, port))
+    listening.listen(SERVER_BACKLOG)
+    return listening
+
+def serve_worker(listening, threads):
+    """Serve the web app on a socket shared with other worker processes"""
+    from paperstream.marking_server import app
+
+    metrics.share_snapshots(os.environ[metrics.METRICS_DIR_ENV])
+    waitress.serve(app, sockets=[listening], threads=threads)
+
+def serve(host=SERVER_HOST, port=SERVER_PORT, workers=1, threads=SERVER_THREADS, ready=None):
+    """Serve the web app with workers processes of threads threads each, ready (an Event) is set
+    once the server is listening"""
+    if workers < 1:
+        raise ValueError("The server needs at least one worker, not {}".format(workers))
+    if workers == 1:
+        from paperstream.marking_server import app
+
+        # The socket is bound and listening once the server is created, before serving the first request
+        server = waitress.create_server(app, host=host, port=port, threads=threads)
+        if ready is not None:
+            ready.set()
+        server.run()
+        return
+
+    from paperstream.marking_server import JOB_STORE_PATH, METRICS_SHARED_DIR
+
+    # The jobs and metrics of a previous run are forgotten, as they are when a single process keeps
+    # them in memory
+    for path in (JOB_STORE_PATH, JOB_STORE_PATH + "-wal", JOB_STORE_PATH + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+    shutil.rmtree(METRICS_SHARED_DIR, ignore_errors=True)
+    os.makedirs(METRICS_SHARED_DIR)
+    os.environ[jobs.JOB_STORE_ENV] = JOB_STORE_PATH
+    os.environ[metrics.METRICS_DIR_ENV] = METRICS_SHARED_DIR
+    job_store = jobs.SQLiteJobStore(JOB_STORE_PATH)
+
+    # Stopping the launcher (e.g. by a service manager) stops the workers too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    listening = create_socket(host, port)
+    # New interpreters, the workers do not inherit the modules (and the in-memory jobs) of this one
+    context = multiprocessing.get_context("spawn")
+
+    def start_worker():
+        process = context.Process(target=serve_worker, args=(listening, threads))
+        process.start()
+        return process, time.monotonic()
+
+    processes = [start_worker() for _ in range(workers)]
+    # The connections wait in the backlog of the socket until a worker accepts them
+    if ready is not None:
+        ready.set()
+    try:
+        while True:
+            multiprocessing.connection.wait([process.sentinel for process, started in processes])
+            for index, (process, started) in enumerate(processes):
+                if process.is_alive():
+                    continue
+                failed = job_store.fail_unfinished(process.pid, "The server process running the job stopped")
+                logging.getLogger().error("Server worker {} stopped with exit code {}, {} jobs failed".format(
+                    process.pid, process.exitcode, len(failed)))
+                if time.monotonic() - started < WORKER_MIN_UPTIME:
+                    logging.getLogger().error("Server worker {} stopped right after starting, stopping "
+                                              "the server".format(process.pid))
+                    sys.exit(1)
+                processes[index] = start_worker()
+    finally:
+        for process, started in processes:
+            process.terminate()
+        listening.close()
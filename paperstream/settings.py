@@ -0,0 +1,30 @@
+"""
+Default folders and settings of the commands. The module only imports the standard library, so the
+command line reads its defaults without importing the web app or the benchmarks.
+
+"""
+import os
+import sys
+
+
+def resource_path(relative_path):
+    """ Get absolute path to resource, works for dev and for PyInstaller """
+    base_path = getattr(sys, '_MEIPASS', os.path.dirname(os.path.abspath(__file__)))
+    return os.path.join(base_path, relative_path)
+
+# Input folders of the web app
+DIARIES_TO_CREATE_DIR = resource_path("input/1_diaries_to_create/")
+TEMPLATE_DIR = resource_path("input/2_template_to_encode/")
+DIARIES_TO_ENCODE_DIR = resource_path("input/3_diaries_to_encode/")
+
+SERVER_HOST = "0.0.0.0"
+SERVER_PORT = 8000
+SERVER_THREADS = 4
+
+BENCHMARK_DPIS = (150, 300, 600)
+BENCHMARK_PAGES = (1, 10)
+BENCHMARKS = ("extract_answer_area_from_page", "mark_answer_area", "encode_diary", "encode_diary_sparse",
+              "encode_diary_coarse", "reencode_diary", "create_a4_diary", "convert_to_a5_booklet",
+              "import_marking_server")
+# Relative change of the throughput or the peak memory from the baseline flagged as a regression
+REGRESSION_TOLERANCE = 0.2
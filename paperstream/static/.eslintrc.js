@@ -8,8 +8,10 @@ module.exports = {
     "globals": {
         "$":false,
         "async":false,
+        "downloadFiles": false,
         "document":false,
         "fabric": false,
-        "Noty": false
+        "Noty": false,
+        "waitForJob": false
     }   
 };
\ No newline at end of file
@@ -50,27 +50,29 @@
     async.eachOfSeries(
       diaryTemplates, (item, key, itemCompleted) => {
         customElement.text(`Creating document ${key + 1}/${diaryTemplates.length}. Please wait and don't refresh the page`);
-        $.post(
+        submitJob(
           '/create_diary',
-          JSON.stringify({
+          {
             pdf_template: item,
             pages,
             date,
             email,
             font,
-          }),
-        )
-          .done((data) => {
-            console.log(`finish ${data}`);
-            diariesToDownload.push(data);
-            itemCompleted(null);
-          })
-          .fail((xhr, status, error) => {
-            console.log(error);
-            // console.log(status);
-            // console.log(xhr);
-            itemCompleted(error);
-          });
+          },
+          (pagesDone, pagesTotal) => {
+            customElement.text(`Creating document ${key + 1}/${diaryTemplates.length} (page ${pagesDone}/${pagesTotal}). Please wait and don't refresh the page`);
+          },
+          (jobError, result) => {
+            if (jobError != null) {
+              console.log(jobError);
+              itemCompleted(jobError);
+            } else {
+              console.log(`finish ${result}`);
+              diariesToDownload.push(result);
+              itemCompleted(null);
+            }
+          },
+        );
       },
       // When all diaries are created
       (error) => {
@@ -80,35 +82,16 @@
           console.log('Error creating diaries');
         } else {
         // Ask the server to zip all the encoding diaries (PDF files)
-          $.post(
-            '/download_files',
-            JSON.stringify({
-              files: diariesToDownload,
-              name: 'documents.zip',
-            }),
-          )
-            .done((data) => {
-            // Trick the browser to download the zip with a link
-              const a = document.createElement('a');
-              a.href = `/${data.file}`;
-              // Give filename you wish to download
-              a.download = 'documents.zip';
-              a.style.display = 'none';
-              document.body.appendChild(a);
-              a.click();
+          downloadFiles(diariesToDownload, 'documents.zip', (errorZip) => {
+            console.log('Error creating zip');
+            console.log(errorZip);
+          });
 
-              new Noty({
-                text: 'Zip file with documents created.',
-                type: 'success',
-                theme: 'metroui',
-              }).show();
-            })
-            .fail((xhr, status, errorZip) => {
-              console.log('Error creating zip');
-              console.log(errorZip);
-              // console.log(status);
-              // console.log(xhr);
-            });
+          new Noty({
+            text: 'Zip file with documents created.',
+            type: 'success',
+            theme: 'metroui',
+          }).show();
         }
       },
     );
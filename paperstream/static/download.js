@@ -0,0 +1,28 @@
+// The server streams zip files while it builds them, a form posted to a hidden iframe lets the
+// browser save the zip as it arrives without leaving the page
+// Milliseconds that the hidden iframe of a download is kept
+const DOWNLOAD_IFRAME_LIFETIME = 60000;
+
+function downloadFiles(files, zipName, onError) {
+  const iframe = $('<iframe>', { name: `download_${Date.now()}`, css: { display: 'none' } });
+  const form = $('<form>', {
+    action: '/download_files',
+    method: 'post',
+    enctype: 'multipart/form-data',
+    target: iframe.attr('name'),
+    css: { display: 'none' },
+  });
+  form.append($('<input>', { type: 'hidden', name: 'files', value: JSON.stringify(files) }));
+  form.append($('<input>', { type: 'hidden', name: 'name', value: zipName }));
+
+  // Downloads do not load the iframe, only error responses do
+  iframe.on('load', () => {
+    onError(iframe.contents().text());
+    iframe.remove();
+  });
+  $('body').append(iframe, form);
+  form.submit();
+  // The request is sent once the form is submitted, the iframe stays until the download starts
+  form.remove();
+  setTimeout(() => iframe.remove(), DOWNLOAD_IFRAME_LIFETIME);
+}
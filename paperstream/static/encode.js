@@ -325,25 +325,35 @@
     // Executes a post request to /encode_diary for each item in diariesToEncode
     async.eachOfSeries(
       diariesToEncode, (item, key, itemCompleted) => {
-        customElement.text(`Encoding document ${key + 1}/${diariesToEncode.length}. Please wait and don't refresh the page`);
-        $.post(
-          '/encode_diary',
-          JSON.stringify({
-            diary: item,
-            rubric,
-            date,
-          }),
-        ).done((data) => {
-          answersToDownload.push(data);
-          itemCompleted(null);
-        }).fail((xhr, status, individualError) => {
+        const documentName = item.split('\\').pop().split('/').pop();
+        const showError = (individualError) => {
           new Noty({
-            text: `Error encoding ${item.split('\\').pop().split('/').pop()} Message: ${individualError}`,
+            text: `Error encoding ${documentName} Message: ${individualError}`,
             type: 'error',
             theme: 'metroui',
           }).show();
           itemCompleted(individualError);
-        });
+        };
+        customElement.text(`Encoding document ${key + 1}/${diariesToEncode.length}. Please wait and don't refresh the page`);
+        submitJob(
+          '/encode_diary',
+          {
+            diary: item,
+            rubric,
+            date,
+          },
+          (pagesDone, pagesTotal) => {
+            customElement.text(`Encoding document ${key + 1}/${diariesToEncode.length} (page ${pagesDone}/${pagesTotal}). Please wait and don't refresh the page`);
+          },
+          (jobError, result) => {
+            if (jobError != null) {
+              showError(jobError);
+            } else {
+              answersToDownload.push(result);
+              itemCompleted(null);
+            }
+          },
+        );
       },
       // When all the encoding is done
       (globalError) => {
@@ -353,32 +363,18 @@
           
         } else {
           // Ask the server to zip all the encoding diaries (CSV files)
-          $.post(
-            '/download_files',
-            JSON.stringify({
-              files: answersToDownload,
-              name: 'answers.zip',
-            }),
-          ).done((data) => {
-            // Trick the browser to download the zip with a link
-            const a = document.createElement('a');
-            a.href = `/${data.file}`;
-            a.download = 'answers.zip';
-            a.style.display = 'none';
-            document.body.appendChild(a);
-            a.click();
-            new Noty({
-              text: `Documents successfully encoded`,
-              type: 'success',
-              theme: 'metroui',
-            }).show();            
-          }).fail((xhr, status, errorZip) => {
+          downloadFiles(answersToDownload, 'answers.zip', (errorZip) => {
             new Noty({
               text: `Error creating zip file. Message: ${errorZip}`,
               type: 'error',
               theme: 'metroui',
             }).show();
-          }); // fail
+          });
+          new Noty({
+            text: `Documents successfully encoded`,
+            type: 'success',
+            theme: 'metroui',
+          }).show();
         } // else
       }, // eachOfSeries arguments
     ); // eachOfSeries
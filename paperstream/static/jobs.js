@@ -0,0 +1,37 @@
+// Encoding and creating documents run as background jobs on the server, the requests that start
+// them return a job id straight away and the page polls /jobs/{id} until the job finishes
+function waitForJob(jobId, onProgress, jobCompleted) {
+  const pollInterval = 1000;
+
+  function poll() {
+    $.get(`/jobs/${jobId}`)
+      .done((job) => {
+        if (job.state === 'done') {
+          jobCompleted(null, job.result);
+        } else if (job.state === 'failed') {
+          jobCompleted(job.error, null);
+        } else {
+          if (job.pages_total) {
+            onProgress(job.pages_done, job.pages_total);
+          }
+          setTimeout(poll, pollInterval);
+        }
+      })
+      .fail((xhr, status, error) => {
+        jobCompleted(error, null);
+      });
+  }
+  poll();
+}
+
+// Starts a job posting body (JSON) to url and waits for it, the endpoints of single documents and of
+// batches (/encode_diaries, /create_diaries) answer with the job id
+function submitJob(url, body, onProgress, jobCompleted) {
+  $.post(url, JSON.stringify(body))
+    .done((data) => {
+      waitForJob(data.job, onProgress, jobCompleted);
+    })
+    .fail((xhr, status, error) => {
+      jobCompleted(error, null);
+    });
+}
@@ -0,0 +1,32 @@
+import unittest
+import numpy as np
+from paperstream.answer_key import AnswerKey
+
+class TestAnswerKey(unittest.TestCase):
+
+    def setUp(self):
+        answer_spaces = [("0", "symptom", "1"), ("0", "symptom", "2"), ("1", "hour", "12"), ("0", "hour", "1")]
+        self.answer_key = AnswerKey.from_answer_spaces(answer_spaces, [10, 20, 30, 40], [5, 5, 5, 5],
+                                                       [4, 4, 4, 4], [10, 10, 10, 10])
+
+    def test_mark(self):
+        # Entries are in order of their first answer, a variable with two answers is duplicated
+        entries, answers = self.answer_key.mark([0, 20, 20, 20], 1.3)
+        rows = list(self.answer_key.get_rows("2018-09-01", entries, answers))
+        self.assertEqual(self.answer_key.variables, ["hour", "symptom"])
+        self.assertEqual(rows, [["2018-09-01", "0", "1", "2"], ["2018-09-01", "1", "12", "MISSING"]])
+
+        entries, answers = self.answer_key.mark([20, 20, 0, 0], 1.3)
+        rows = list(self.answer_key.get_rows("2018-09-01", entries, answers))
+        self.assertEqual(rows, [["2018-09-01", "0", "MISSING", "DUPLICATED"]])
+
+    def test_to_bytes(self):
+        answer_key = AnswerKey.from_bytes(self.answer_key.to_bytes())
+        self.assertTrue(np.array_equal(answer_key.x_coords, self.answer_key.x_coords))
+        self.assertTrue(np.array_equal(answer_key.value_codes, self.answer_key.value_codes))
+        self.assertEqual(answer_key.entries, self.answer_key.entries)
+        self.assertEqual(answer_key.values, self.answer_key.values)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import tempfile
+import unittest
+import paperstream.benchmark as benchmark
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_synthetic_diary_encoded(self):
+        import paperstream.encode_diary as encode
+
+        encoded_diaries_dir = encode.ENCODED_DIARIES_DIR
+        with tempfile.TemporaryDirectory() as case_dir:
+            benchmark.prepare_case("encode_diary", case_dir, 150, 2)
+            result = benchmark.run_case("encode_diary", case_dir, 2)
+
+        self.assertTrue(result["correct_pages"] == 2)
+        self.assertTrue(result["pages_per_second"] > 0)
+        # The output folders of the case (deleted with it) are not used afterwards
+        self.assertTrue(encode.ENCODED_DIARIES_DIR == encoded_diaries_dir)
+
+    def test_compare_with_baseline(self):
+        baseline = {"results": [{"benchmark": "encode_diary", "dpi": 300, "pages": 10, "pages_per_second": 2.0,
+                                 "peak_rss_mb": 100.0, "correct_pages": 10}]}
+        results = {"results": [{"benchmark": "encode_diary", "dpi": 300, "pages": 10, "pages_per_second": 1.0,
+                                "peak_rss_mb": 110.0, "correct_pages": 10},
+                               {"benchmark": "encode_diary", "dpi": 600, "pages": 10, "pages_per_second": 1.0,
+                                "peak_rss_mb": 110.0, "correct_pages": 10}]}
+
+        regressions = benchmark.compare_with_baseline(results, baseline, tolerance=0.2)
+        self.assertTrue(len(regressions) == 1)
+        self.assertTrue("300 dpi" in regressions[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import shutil
+import unittest
+from pathlib import Path
+import paperstream.cache as cache
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.CACHE_DIR = Path("test/output/temporal/cache/")
+        shutil.rmtree(str(self.CACHE_DIR), ignore_errors=True)
+
+    def test_put_and_get(self):
+        disk_cache = cache.DiskCache(self.CACHE_DIR, ".bin")
+        key = cache.hash_key(b"answer area", "rubric")
+
+        self.assertTrue(disk_cache.get(key) is None)
+        disk_cache.put(key, b"answer key")
+        self.assertTrue(disk_cache.get(key) == b"answer key")
+
+    def test_hash_key(self):
+        self.assertTrue(cache.hash_key(b"ab", b"c") != cache.hash_key(b"a", b"bc"))
+        self.assertTrue(cache.hash_key((1, 2), "rubric") == cache.hash_key((1, 2), "rubric"))
+
+    def test_atomic_write(self):
+        path = self.CACHE_DIR / "template.png"
+        cache.atomic_write(path, b"first")
+        cache.atomic_write(path, b"second")
+
+        self.assertTrue(os.listdir(str(self.CACHE_DIR)) == ["template.png"])
+        self.assertTrue(path.read_bytes() == b"second")
+        # The permissions open gives a new file, not the ones of a temporary file
+        umask = os.umask(0o022)
+        os.umask(umask)
+        if os.name != "nt":
+            self.assertTrue(os.stat(str(path)).st_mode & 0o777 == 0o666 & ~umask)
+
+    def test_evict_least_recently_used(self):
+        disk_cache = cache.DiskCache(self.CACHE_DIR, ".bin", max_entries=2)
+        disk_cache.put("first", b"1")
+        disk_cache.put("second", b"2")
+        os.utime(disk_cache.get_path("first"), (0, 0))
+        os.utime(disk_cache.get_path("second"), (1, 1))
+
+        # Using an entry makes it the most recently used one
+        disk_cache.get("first")
+        disk_cache.put("third", b"3")
+
+        self.assertTrue(disk_cache.get("second") is None)
+        self.assertTrue(disk_cache.get("first") == b"1")
+        self.assertTrue(disk_cache.get("third") == b"3")
+
+    def test_evict_by_size(self):
+        disk_cache = cache.DiskCache(self.CACHE_DIR, ".bin", max_bytes=10)
+        disk_cache.put("first", b"123456")
+        os.utime(disk_cache.get_path("first"), (0, 0))
+        disk_cache.put("second", b"123456")
+
+        self.assertTrue(disk_cache.get("first") is None)
+        self.assertTrue(disk_cache.get("second") == b"123456")
+
+
+    def test_scan_only_over_limits(self):
+        disk_cache = cache.DiskCache(self.CACHE_DIR, ".bin", max_entries=10)
+        scans = []
+        get_entries = disk_cache.get_entries
+        disk_cache.get_entries = lambda: scans.append(len(scans)) or get_entries()
+        for entry in range(11):
+            disk_cache.put(str(entry), b"1")
+
+        # The directory is scanned by the first entry and once the cache is full, not on every entry
+        self.assertTrue(len(scans) == 2)
+        self.assertTrue(len(os.listdir(str(self.CACHE_DIR))) == 9)
+        self.assertTrue(cache.get_disk_cache(self.CACHE_DIR, ".bin", 10) is cache.get_disk_cache(self.CACHE_DIR, ".bin", 10))
+
+
+if __name__ == '__main__':
+    unittest.main()
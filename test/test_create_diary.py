@@ -1,7 +1,34 @@
 import unittest
+from io import BytesIO
 from pathlib import Path
+from PyPDF2 import PdfFileReader
+from PyPDF2.pdf import ContentStream
 import paperstream.create_diary as create
 from shutil import copyfile
+
+def get_drawn_content(content, resources, pdf):
+    """Get the strings shown and the images drawn by a content stream, following the forms it draws"""
+    drawn = []
+    for operands, operator in ContentStream(content, pdf).operations:
+        if operator == b"Tj":
+            drawn.append(operands[0])
+        elif operator == b"TJ":
+            drawn.extend(operand for operand in operands[0] if isinstance(operand, str))
+        elif operator == b"Do":
+            xobject = resources["/XObject"][operands[0]].getObject()
+            if xobject["/Subtype"] == "/Form":
+                drawn.extend(get_drawn_content(xobject, xobject["/Resources"].getObject(), pdf))
+            else:
+                drawn.append((xobject["/Width"], xobject["/Height"]))
+    return drawn
+
+def get_booklet_pages(booklet):
+    """Get the media box and the content drawn (sorted) of each page of a booklet"""
+    reader = PdfFileReader(booklet)
+    return [(list(page.mediaBox), sorted(map(repr, get_drawn_content(page.getContents(),
+                                                                     page["/Resources"].getObject(), reader))))
+            for page in reader.pages]
+
 class TestCreateDiary(unittest.TestCase):
 
     def setUp(self):
@@ -39,6 +66,43 @@ class TestCreateDiary(unittest.TestCase):
 
         self.assertTrue(a5_booklet.stat().st_size == test_a5_booklet.stat().st_size)
 
+    def test_create_diary_and_booklet(self):
+        create.LOGO_PATH = create.CORNER_DIR / Path("invalid_path")
+
+        a4_document, a5_booklet = create.create_diary_and_booklet("test/input/P01.pdf", 3, "01/01/2018", font="FreeSansLocal")
+        test_a4_document = Path("test/comparison_files/a4_default_font.pdf")
+
+        self.assertTrue(a4_document.stat().st_size == test_a4_document.stat().st_size)
+        self.assertTrue(a5_booklet.exists())
+
+    def test_booklet_as_forms(self):
+        create.LOGO_PATH = create.CORNER_DIR / Path("logo.png")
+        a4_document = create.create_a4_diary("test/input/P01.pdf", 3, "01/01/2018")
+
+        # The booklet that draws the pages as forms looks like the one that merges their contents
+        merged_booklet = create.convert_to_a5_booklet(str(a4_document))
+        with open(str(a4_document), "rb") as a4_stream:
+            reader = PdfFileReader(a4_stream)
+            forms_booklet = BytesIO()
+            create.write_a5_booklet(reader.pages, forms_booklet, as_forms=True)
+        merged_pages = get_booklet_pages(str(merged_booklet))
+        forms_pages = get_booklet_pages(forms_booklet)
+
+        self.assertTrue(len(forms_pages) == len(merged_pages) == 4)
+        self.assertTrue(forms_pages == merged_pages)
+        # The content of the pages is compared, the booklet is not blank
+        self.assertTrue(any(drawn for media_box, drawn in forms_pages))
+
+    def test_create_diaries(self):
+        create.LOGO_PATH = create.CORNER_DIR / Path("logo.png")
+
+        results = create.create_diaries(["test/input/P01.pdf", "test/input/invalid.pdf"], 3, "01/01/2018", workers=2)
+
+        self.assertTrue(results[0]["error"] is None)
+        self.assertTrue(Path(results[0]["a4_document"]).exists())
+        self.assertTrue(Path(results[0]["a5_booklet"]).exists())
+        self.assertTrue(results[1]["error"] is not None)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
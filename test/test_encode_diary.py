@@ -1,5 +1,8 @@
+import shutil
 import unittest
 from pathlib import Path
+import numpy as np
+from PIL import Image
 import paperstream.encode_diary as encode
 from shutil import copyfile
 
@@ -10,6 +13,13 @@ class TestEncodeDiary(unittest.TestCase):
         encode.EXTRACTED_AREAS_DIR = Path("test/output/temporal/answers_areas/")
         encode.EXTRACTED_MARK_DIR = Path("test/output/temporal/mark_areas/")
         encode.ENCODED_DIARIES_DIR = Path("test/output/")
+        encode.ANSWER_KEYS_DIR = Path("test/output/temporal/answer_keys/")
+        encode.BINARY_AREAS_DIR = Path("test/output/temporal/binary_areas/")
+        shutil.rmtree(str(encode.BINARY_AREAS_DIR), ignore_errors=True)
+        encode.TEMPLATE_AREAS_DIR = Path("test/output/temporal/template_areas/")
+        encode.ENCODING_STATE_DIR = Path("test/output/temporal/encoding_state/")
+        shutil.rmtree(str(encode.TEMPLATE_AREAS_DIR), ignore_errors=True)
+        encode.load_template_areas.cache_clear()
         self.TEMPLATE_DIR = Path("test/input/template/")
         self.RUBRIC = "0,hour,12,78.99300699,176.9956522,12\n0,hour,1,111.98601399,183.9956522,12\n0,hour,2,132,208.0065217,12\n0,hour,3,141.9895105,235.9978261,12\n0,hour,4,132.986014,268.9956522,12\n0,hour,5,112.9895105,291.0065217,12\n0,hour,6,79.99300699,299.9978261,12\n0,hour,7,47.98951049,290,12\n0,hour,8,27.98251748,268.9586957,12\n0,hour,9,19.982517483,237.9913043,12\n0,hour,10,27.9965035,207.9891304,12\n0,hour,11,46.98951049,184.9695652,12\n0,ampm,am,79.99300699,218.9913043,12\n0,ampm,pm,78.98951049,257.9913043,12\n0,minute,0,179.9895105,176.9934783,12\n0,minute,15,180.993007,217.9956522,12\n0,minute,30,179.993007,258.9956522,12\n0,minute,45,180.9895105,300.9956522,12\n0,symptom1,0,369.993007,163.9956522,12\n0,symptom1,1,408.9895105,163.9956522,12\n0,symptom1,2,446.9895105,163.9934783,12\n0,symptom1,3,485.993007,164.9978261,12\n0,symptom2,3,486.9895105,225.9978261,12\n0,symptom2,2,447.9895105,224.9978261,12\n0,symptom2,1,407.9895105,224.9978261,12\n0,symptom2,0,369.993007,224.9978261,12\n0,symptom3,0,370.9895105,287.9978261,12\n0,symptom3,1,408.993007,287.9956522,12\n0,symptom3,2,446.993007,288.9934783,12\n0,symptom3,3,486.9895105,288.9956522,12\n1,hour,12,79.98951049,465.5652174,12\n1,hour,1,112.9825175,472.5652174,12\n1,hour,2,132.99650350000002,496.576087,12\n1,hour,3,142.986014,524.5673913,12\n1,hour,4,133.9825175,557.5652174,12\n1,hour,5,113.986014,579.576087,12\n1,hour,6,80.98951049,588.5673913,12\n1,hour,7,48.98601399,578.5695652,12\n1,hour,8,28.97902098,557.5282609,12\n1,hour,9,20.979020978999998,526.5608696,12\n1,hour,10,28.99300699,496.5586957,12\n1,hour,11,47.98601399,473.5391304,12\n1,ampm,am,80.98951049,507.5608696,12\n1,ampm,pm,79.98601399,546.5608696,12\n1,minute,0,180.986014,465.5630435,12\n1,minute,15,181.9895105,506.5652174,12\n1,minute,30,180.9895105,547.5652174,12\n1,minute,45,181.986014,589.5652174,12\n1,symptom1,0,370.9895105,452.5652174,12\n1,symptom1,1,409.986014,452.5652174,12\n1,symptom1,2,447.986014,452.5630435,12\n1,symptom1,3,486.9895105,453.5673913,12\n1,symptom2,3,487.986014,514.5673913,12\n1,symptom2,2,448.986014,513.5673913,12\n1,symptom2,1,408.986014,513.5673913,12\n1,symptom2,0,370.9895105,513.5673913,12\n1,symptom3,0,371.986014,576.5673913,12\n1,symptom3,1,409.9895105,576.5652174,12\n1,symptom3,2,447.9895105,577.5630435,12\n1,symptom3,3,487.986014,577.5652174,12\n2,hour,12,79.98951049,689.0782609,12\n2,hour,1,112.9825175,696.0782609,12\n2,hour,2,132.99650350000002,720.0891304,12\n2,hour,3,142.986014,748.0804348,12\n2,hour,4,133.9825175,781.0782609,12\n2,hour,5,113.986014,803.0891304,12\n2,hour,6,80.98951049,812.0804348,12\n2,hour,7,48.98601399,802.0826087,12\n2,hour,8,28.97902098,781.0413043,12\n2,hour,9,20.979020978999998,750.073913,12\n2,hour,10,28.99300699,720.0717391,12\n2,hour,11,47.98601399,697.0521739,12\n2,ampm,am,80.98951049,731.073913,12\n2,ampm,pm,79.98601399,770.073913,12\n2,minute,0,180.986014,689.076087,12\n2,minute,15,181.9895105,730.0782609,12\n2,minute,30,180.9895105,771.0782609,12\n2,minute,45,181.986014,813.0782609,12\n2,symptom1,0,370.9895105,676.0782609,12\n2,symptom1,1,409.986014,676.0782609,12\n2,symptom1,2,447.986014,676.076087,12\n2,symptom1,3,486.9895105,677.0804348,12\n2,symptom2,3,487.986014,738.0804348,12\n2,symptom2,2,448.986014,737.0804348,12\n2,symptom2,1,408.986014,737.0804348,12\n2,symptom2,0,370.9895105,737.0804348,12\n2,symptom3,0,371.986014,800.0804348,12\n2,symptom3,1,409.9895105,800.0782609,12\n2,symptom3,2,447.9895105,801.076087,12\n2,symptom3,3,487.986014,801.0782609,12"
 
@@ -18,11 +28,109 @@ class TestEncodeDiary(unittest.TestCase):
         test_answers = Path("test/comparison_files/test_diary_png.csv")
         self.assertTrue(answers.stat().st_size == test_answers.stat().st_size)
 
+    def test_encode_diary_png_debug(self):
+        answers = encode.encode_diary("test/input/test_diary_png.zip", self.TEMPLATE_DIR, self.RUBRIC, "01/09/2018", debug=True)
+        test_answers = Path("test/comparison_files/test_diary_png.csv")
+        self.assertTrue(answers.stat().st_size == test_answers.stat().st_size)
+
+    def test_encode_diary_png_workers(self):
+        answers = encode.encode_diary("test/input/test_diary_png.zip", self.TEMPLATE_DIR, self.RUBRIC, "01/09/2018", workers=2)
+        test_answers = Path("test/comparison_files/test_diary_png.csv")
+        self.assertTrue(answers.stat().st_size == test_answers.stat().st_size)
+
+    def test_encode_diary_png_sparse(self):
+        answers = encode.encode_diary("test/input/test_diary_png.zip", self.TEMPLATE_DIR, self.RUBRIC, "01/09/2018", sparse=True)
+        test_answers = Path("test/comparison_files/test_diary_png.csv")
+        self.assertTrue(answers.stat().st_size == test_answers.stat().st_size)
+
+    def test_encode_diary_png_cached_areas(self):
+        answers = encode.encode_diary("test/input/test_diary_png.zip", self.TEMPLATE_DIR, self.RUBRIC, "01/09/2018")
+        first_answers = answers.read_bytes()
+        self.assertTrue(len(list(encode.BINARY_AREAS_DIR.glob("*.png"))) == 7)
+
+        # The second time the pages are only marked with the binarised answer areas of the cache
+        answers = encode.encode_diary("test/input/test_diary_png.zip", self.TEMPLATE_DIR, self.RUBRIC, "01/09/2018")
+        self.assertTrue(answers.read_bytes() == first_answers)
+
+    def test_get_template_areas_cached(self):
+        template_path = next(self.TEMPLATE_DIR.glob("*.png"))
+        answer_area, binary_area = encode.get_template_areas(template_path)
+        self.assertTrue(len(list(encode.TEMPLATE_AREAS_DIR.glob("*.png"))) == 2)
+
+        # Without the areas in memory they are loaded from the disk instead of extracted again
+        encode.load_template_areas.cache_clear()
+        cached_answer_area, cached_binary_area = encode.get_template_areas(template_path)
+        self.assertTrue(np.array_equal(cached_answer_area, answer_area))
+        self.assertTrue(np.array_equal(cached_binary_area, binary_area))
+
+    def test_encode_diary_png_resume(self):
+        def interrupt(pages_done, pages_total):
+            if pages_done == 3:
+                raise RuntimeError("Encoding interrupted")
+
+        with self.assertRaises(RuntimeError):
+            encode.encode_diary("test/input/test_diary_png.zip", self.TEMPLATE_DIR, self.RUBRIC, "01/09/2018", progress=interrupt)
+
+        # The two pages written before the interruption are not encoded again
+        pages_done = []
+        answers = encode.encode_diary("test/input/test_diary_png.zip", self.TEMPLATE_DIR, self.RUBRIC, "01/09/2018",
+                                      progress=lambda done, total: pages_done.append(done))
+        self.assertTrue(pages_done == [2, 3, 4, 5, 6, 7])
+        # Only the CSV file is left in the folder of the encoded diaries (downloaded by the users)
+        self.assertTrue([path.name for path in answers.parent.glob(answers.name + "*")] == [answers.name])
+        self.assertFalse(any(encode.ENCODING_STATE_DIR.glob("*.progress")))
+
+        resumed_answers = answers.read_bytes()
+        answers = encode.encode_diary("test/input/test_diary_png.zip", self.TEMPLATE_DIR, self.RUBRIC, "01/09/2018", resume=False)
+        self.assertTrue(answers.read_bytes() == resumed_answers)
+
+    def test_diary_writer_locked(self):
+        answer_key = encode.get_template_answer_key(self.TEMPLATE_DIR, self.RUBRIC)
+        encoded_diary_path = encode.get_encoded_diary_path("test_diary_locked")
+        if encoded_diary_path.exists():
+            encoded_diary_path.unlink()
+        with encode.DiaryWriter(encoded_diary_path, answer_key, "first"):
+            # A second encoding of the same diary fails instead of mixing its rows with the first one
+            with self.assertRaises(RuntimeError):
+                encode.DiaryWriter(encoded_diary_path, answer_key, "second")
+            self.assertFalse(encoded_diary_path.exists())
+
+        self.assertTrue(encoded_diary_path.exists())
+        with encode.DiaryWriter(encoded_diary_path, answer_key, "third"):
+            pass
+
+    def test_encode_diaries(self):
+        diaries_done = []
+        combined_answers, results = encode.encode_diaries(["test/input/test_diary_png.zip", "test/input/missing.zip"],
+                                                          self.TEMPLATE_DIR, self.RUBRIC, "01/09/2018", workers=1,
+                                                          progress=lambda done, total: diaries_done.append((done, total)))
+        test_answers = Path("test/comparison_files/test_diary_png.csv")
+        self.assertTrue(diaries_done == [(0, 2), (1, 2), (2, 2)])
+        self.assertTrue(results[0]["error"] is None and results[0]["pages"] == 7)
+        self.assertTrue(Path(results[0]["answers"]).stat().st_size == test_answers.stat().st_size)
+        # A diary that cannot be encoded is reported, not only logged
+        self.assertTrue(results[1]["answers"] is None and results[1]["error"] is not None)
+        self.assertTrue(combined_answers.exists())
+
     def test_encode_diary_tif(self):
         answers = encode.encode_diary("test/input/test_diary_tif.tif", self.TEMPLATE_DIR, self.RUBRIC, "01/09/2018")
         test_answers = Path("test/comparison_files/test_diary_tif.csv")
         self.assertTrue(answers.stat().st_size == test_answers.stat().st_size)
-        
+
+    def test_count_black_pixels(self):
+        random = np.random.RandomState(0)
+        binary_area = np.where(random.rand(300, 200) < 0.4, 0, 255).astype(np.uint8)
+        x_coords = random.uniform(-20, 220, 200)
+        y_coords = random.uniform(-20, 320, 200)
+        radii = random.uniform(0, 30, 200)
+
+        black_pixels = encode.count_black_pixels(binary_area, x_coords, y_coords, radii)
+
+        answer_area = Image.fromarray(binary_area)
+        for x, y, radius, black in zip(x_coords, y_coords, radii, black_pixels):
+            answer_space = answer_area.crop((x - radius, y - radius, x + radius, y + radius))
+            self.assertEqual(black, sum(1 for pixel in answer_space.getdata() if pixel == 0))
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,49 @@
+import tempfile
+import unittest
+import cv2
+import numpy as np
+import paperstream.benchmark as benchmark
+import paperstream.extract_framed_area as frame
+
+class TestExtractFramedArea(unittest.TestCase):
+
+    def test_find_corners(self):
+        page = cv2.imread("test/input/template/test_template.png")
+        blurred_image = cv2.GaussianBlur(page, (11, 11), 10)
+        normalised_image = frame.normalize(cv2.cvtColor(blurred_image, cv2.COLOR_BGR2GRAY))
+        ret, binary_image = cv2.threshold(normalised_image, 127, 255, cv2.THRESH_BINARY)
+
+        corners = frame.find_corners(binary_image)
+        expected_corners = frame.get_corners(frame.get_contours(binary_image))
+        self.assertTrue(len(corners) == 4)
+        self.assertTrue(all(np.array_equal(corner, expected_corner)
+                            for corner, expected_corner in zip(corners, expected_corners)))
+
+    def test_find_corners_coarse_to_fine(self):
+        page = benchmark.create_synthetic_page(600, benchmark.get_synthetic_rubric(), set(), 0)
+        scale = frame.get_marker_search_scale(page)
+        self.assertTrue(scale < 1)
+
+        blurred_image = cv2.GaussianBlur(page, (11, 11), 10)
+        binary_image = frame.threshold_page(cv2.cvtColor(blurred_image, cv2.COLOR_BGR2GRAY))
+        expected_points = frame.order_points(frame.get_outmost_points(frame.find_corners(binary_image)))
+        points = frame.order_points(frame.get_outmost_points(frame.find_corners_coarse_to_fine(page, scale)))
+        self.assertTrue(np.abs(np.array(points) - np.array(expected_points)).max() <= 2)
+
+    def test_encode_coarse_to_fine(self):
+        # The answers of a 600 DPI diary encoded in coarse mode are the ones marked on its pages
+        with tempfile.TemporaryDirectory() as case_dir:
+            benchmark.prepare_case("encode_diary_coarse", case_dir, 600, 2)
+            result = benchmark.run_case("encode_diary_coarse", case_dir, 2)
+        self.assertTrue(result["correct_pages"] == 2)
+
+    def test_get_answer_area_grayscale(self):
+        # The scanned pages are bilevel, they are decoded and extracted as single channel images
+        page = next(frame.iter_pages("test/input/test_diary_png.zip"))
+        self.assertTrue(page.ndim == 2)
+        answer_area = frame.get_answer_area(page)
+        self.assertTrue(answer_area.shape == (frame.AREA_IMAGE_HEIGHT, frame.AREA_IMAGE_WIDTH))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import hashlib
+import os
+import shutil
+import unittest
+from pathlib import Path
+import paperstream.file_index as file_index
+
+class TestDirectoryIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.INDEX_DIR = Path("test/output/temporal/file_index/")
+        shutil.rmtree(str(self.INDEX_DIR), ignore_errors=True)
+        os.makedirs(str(self.INDEX_DIR / "batch"))
+        for name in ("diary10.zip", "diary2.zip", "batch/diary1.zip", "notes.txt"):
+            (self.INDEX_DIR / name).write_bytes(name.encode())
+
+    def test_get_files(self):
+        index = file_index.DirectoryIndex(self.INDEX_DIR)
+        names = [os.path.relpath(path, str(self.INDEX_DIR)) for path in index.get_files(".zip")]
+
+        self.assertTrue(names == [os.path.join("batch", "diary1.zip"), "diary2.zip", "diary10.zip"])
+
+    def test_refresh_after_changes(self):
+        index = file_index.DirectoryIndex(self.INDEX_DIR)
+        index.get_files(".zip")
+        (self.INDEX_DIR / "batch" / "diary3.zip").write_bytes(b"3")
+        os.remove(str(self.INDEX_DIR / "diary10.zip"))
+        names = [os.path.relpath(path, str(self.INDEX_DIR)) for path in index.get_files(".zip")]
+
+        self.assertTrue(names == [os.path.join("batch", "diary1.zip"), os.path.join("batch", "diary3.zip"),
+                                  "diary2.zip"])
+        self.assertTrue(index.refresh() is False)
+
+    @unittest.skipIf(os.name == "nt", "symbolic links and permissions need a POSIX file system")
+    def test_skip_links_and_unreadable_directories(self):
+        os.symlink("..", str(self.INDEX_DIR / "batch" / "up"))
+        os.makedirs(str(self.INDEX_DIR / "private"))
+        (self.INDEX_DIR / "private" / "diary4.zip").write_bytes(b"4")
+        os.chmod(str(self.INDEX_DIR / "private"), 0)
+        try:
+            index = file_index.DirectoryIndex(self.INDEX_DIR)
+            names = [os.path.relpath(path, str(self.INDEX_DIR)) for path in index.get_files(".zip")]
+        finally:
+            os.chmod(str(self.INDEX_DIR / "private"), 0o755)
+
+        expected = [os.path.join("batch", "diary1.zip"), "diary2.zip", "diary10.zip"]
+        if os.geteuid() == 0:
+            # Permissions do not apply to the superuser
+            expected.insert(3, os.path.join("private", "diary4.zip"))
+        self.assertTrue(names == expected)
+
+    def test_get_file_info(self):
+        index = file_index.DirectoryIndex(self.INDEX_DIR)
+        path = str(self.INDEX_DIR / "diary2.zip")
+        info = index.get_file_info(path)
+
+        self.assertTrue(info["size"] == len(b"diary2.zip"))
+        self.assertTrue(info["sha256"] == hashlib.sha256(b"diary2.zip").hexdigest())
+
+        Path(path).write_bytes(b"rescanned")
+        self.assertTrue(index.get_file_info(path)["sha256"] == hashlib.sha256(b"rescanned").hexdigest())
+
+
+if __name__ == '__main__':
+    unittest.main()
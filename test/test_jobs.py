@@ -0,0 +1,71 @@
+import os
+import shutil
+import time
+import unittest
+import paperstream.jobs as jobs
+
+def count_pages(pages, progress=None):
+    for page in range(1, pages + 1):
+        progress(page, pages)
+    return "{} pages".format(pages)
+
+def fail(progress=None):
+    raise ValueError("Template does not exist")
+
+class TestJobQueue(unittest.TestCase):
+
+    def wait_for_job(self, queue, job_id):
+        job = queue.get(job_id)
+        while job["state"] in (jobs.PENDING, jobs.RUNNING):
+            time.sleep(0.01)
+            job = queue.get(job_id)
+        return job
+
+    def test_job_done(self):
+        queue = jobs.JobQueue(workers=1)
+        job = self.wait_for_job(queue, queue.submit("count", count_pages, 3))
+
+        self.assertTrue(job["state"] == jobs.DONE)
+        self.assertTrue(job["result"] == "3 pages")
+        self.assertTrue((job["pages_done"], job["pages_total"]) == (3, 3))
+
+    def test_job_failed(self):
+        queue = jobs.JobQueue(workers=1)
+        job = self.wait_for_job(queue, queue.submit("fail", fail))
+
+        self.assertTrue(job["state"] == jobs.FAILED)
+        self.assertTrue(job["error"] == "Template does not exist")
+        self.assertTrue(queue.get("missing") is None)
+
+    def test_jobs_shared_in_database(self):
+        shutil.rmtree("test/output/temporal/jobs", ignore_errors=True)
+        database = "test/output/temporal/jobs/jobs.sqlite"
+        queue = jobs.JobQueue(workers=1, store=jobs.SQLiteJobStore(database))
+        job_id = queue.submit("count", count_pages, 3)
+
+        # Another server process polls the job started by this one
+        other_queue = jobs.JobQueue(workers=1, store=jobs.SQLiteJobStore(database))
+        job = self.wait_for_job(other_queue, job_id)
+        self.assertTrue(job["state"] == jobs.DONE)
+        self.assertTrue(job["result"] == "3 pages")
+        self.assertTrue(other_queue.get("missing") is None)
+        self.assertTrue(os.path.exists(database))
+
+    def test_fail_unfinished(self):
+        shutil.rmtree("test/output/temporal/jobs", ignore_errors=True)
+        store = jobs.SQLiteJobStore("test/output/temporal/jobs/jobs.sqlite")
+        for job_id, pid, state in (("running", 1, jobs.RUNNING), ("pending", 1, jobs.PENDING),
+                                   ("done", 1, jobs.DONE), ("other", 2, jobs.RUNNING)):
+            store.add({"id": job_id, "state": state, "error": None, "finished": None, "pid": pid})
+
+        # The jobs of a server process that died are not left running forever
+        failed = store.fail_unfinished(1, "The server process running the job stopped")
+        self.assertTrue(sorted(failed) == ["pending", "running"])
+        self.assertTrue(store.get("running")["state"] == jobs.FAILED)
+        self.assertTrue(store.get("running")["finished"] is not None)
+        self.assertTrue(store.get("done")["state"] == jobs.DONE)
+        self.assertTrue(store.get("other")["state"] == jobs.RUNNING)
+
+
+if __name__ == '__main__':
+    unittest.main()
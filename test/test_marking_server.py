@@ -0,0 +1,52 @@
+import hashlib
+import io
+import os
+import shutil
+import subprocess
+import sys
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+# Modules imported by the first request that encodes or creates diaries, not when the server starts
+HEAVY_MODULES = ("cv2", "numpy", "PIL", "PyPDF2", "reportlab")
+
+class TestMarkingServer(unittest.TestCase):
+
+    def test_startup_defers_heavy_imports(self):
+        check = ("import sys; import paperstream.marking_server; "
+                 "print(','.join(name for name in {} if name in sys.modules))".format(HEAVY_MODULES))
+        imported = subprocess.run([sys.executable, "-c", check], stdout=subprocess.PIPE,
+                                  universal_newlines=True, check=True).stdout.strip()
+
+        self.assertTrue(imported == "", imported)
+
+    def test_save_upload(self):
+        import paperstream.cache as cache
+        import paperstream.marking_server as server
+
+        upload_dir = Path("test/output/temporal/uploads/")
+        shutil.rmtree(str(upload_dir), ignore_errors=True)
+        os.makedirs(str(upload_dir))
+        content = os.urandom(3 * server.UPLOAD_CHUNK_SIZE + 1)
+        upload = SimpleNamespace(filename="../diary.zip", file=io.BytesIO(content))
+        path, sha256 = server.UploadFilesResource.save_upload(upload, str(upload_dir))
+
+        # The file is saved in the folder whatever its name and no temporary file is left behind
+        self.assertTrue(os.listdir(str(upload_dir)) == ["diary.zip"])
+        self.assertTrue(Path(path).read_bytes() == content)
+        self.assertTrue(sha256 == hashlib.sha256(content).hexdigest())
+        # Readable as the files copied to the folder, not only by the user as a temporary file
+        if os.name != "nt":
+            self.assertTrue(os.stat(path).st_mode & 0o777 == cache.FILE_PERMISSIONS)
+
+    def test_get_zip_name(self):
+        import paperstream.marking_server as server
+
+        self.assertTrue(server.DownloadFilesResource.get_zip_name(None) == "files.zip")
+        self.assertTrue(server.DownloadFilesResource.get_zip_name('../"answers"\r\n.zip') == "answers.zip")
+        self.assertTrue(server.DownloadFilesResource.get_zip_name("C:\\diaries\\") == "files.zip")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import json
+import os
+import shutil
+import unittest
+import paperstream.metrics as metrics
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_measure(self):
+        with metrics.measure("find_contours", pages=1):
+            pass
+        with metrics.measure("find_contours") as measurement:
+            measurement["pages"] = 2
+
+        stage = metrics.get_snapshot()["find_contours"]
+        self.assertTrue(stage["count"] == 2)
+        self.assertTrue(stage["pages"] == 3)
+        # Buckets are cumulative, the last one counts every measure
+        self.assertTrue(stage["buckets"][-1] == 2)
+
+    def test_timed_and_merge(self):
+        split_pages = metrics.timed("split_pages", pages=len)(lambda diary: [diary + "_0", diary + "_1"])
+        self.assertTrue(split_pages("diary") == ["diary_0", "diary_1"])
+
+        snapshot = metrics.get_snapshot()
+        metrics.merge(snapshot)
+        self.assertTrue(metrics.get_snapshot()["split_pages"]["pages"] == 4)
+
+        text = metrics.get_metrics_text()
+        self.assertTrue('paperstream_stage_wall_seconds_count{stage="split_pages"} 2' in text)
+        self.assertTrue('paperstream_stage_wall_seconds_bucket{stage="split_pages",le="+Inf"} 2' in text)
+
+    def test_shared_snapshot(self):
+        shared_dir = "test/output/temporal/metrics/"
+        shutil.rmtree(shared_dir, ignore_errors=True)
+        os.makedirs(shared_dir)
+        # Saved by another server process, or by one that stopped
+        other_snapshot = {"find_contours": dict(metrics.create_stage(), count=3, pages=3)}
+        with open(os.path.join(shared_dir, "0.json"), 'w') as snapshot_file:
+            json.dump(other_snapshot, snapshot_file)
+        with metrics.measure("find_contours", pages=1):
+            pass
+
+        stage = metrics.get_shared_snapshot(shared_dir)["find_contours"]
+        self.assertTrue((stage["count"], stage["pages"]) == (4, 4))
+        self.assertTrue(sorted(os.listdir(shared_dir)) == sorted(["0.json", "{}.json".format(os.getpid())]))
+
+
+if __name__ == '__main__':
+    unittest.main()